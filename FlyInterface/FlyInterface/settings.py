@@ -42,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'home.instrumentation.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -122,6 +123,88 @@ STATIC_URL = 'static/'
 MEDIA_URL = 'data/'
 MEDIA_ROOT = 'data/'
 
+# Blocking Flywheel SDK calls of the async views run on a thread pool of this size.
+FW_EXECUTOR_MAX_WORKERS = 64
+
+# Flywheel client pool shared by all requests of a process.
+# Idle clients are kept per API key for up to FW_CLIENT_POOL_IDLE_TIMEOUT seconds.
+FW_CLIENT_POOL_MAX_SIZE = 32
+FW_CLIENT_POOL_IDLE_TIMEOUT = 600
+
+# Cache of resolved Flywheel paths, keyed by (user, path).
+# Append ?refresh to a listing URL to bypass and refill it.
+FW_HIERARCHY_CACHE_TTL = 60
+FW_HIERARCHY_CACHE_MAX_ENTRIES = 256
+FW_HIERARCHY_CACHE_MAX_BYTES = 64 * 1024 * 1024
+FW_USER_CACHE_TTL = 600
+
+# Container listings are rendered FW_LISTING_PAGE_SIZE children at a time,
+# further pages are fetched from the JSON listing endpoint while scrolling.
+FW_LISTING_PAGE_SIZE = 200
+FW_LISTING_MAX_PAGE_SIZE = 1000
+
+# Files are streamed from Flywheel in chunks of FW_STREAM_CHUNK_SIZE bytes.
+# Viewer links carry a random token valid for FW_FILE_TOKEN_MAX_AGE seconds.
+FW_STREAM_CHUNK_SIZE = 256 * 1024
+FW_FILE_TOKEN_MAX_AGE = 3600
+
+# Downloaded files are cached under MEDIA_ROOT by Flywheel file id and version,
+# least recently used files are evicted past FW_DOWNLOAD_CACHE_MAX_BYTES.
+FW_DOWNLOAD_CACHE_DIR = os.path.join(BASE_DIR, MEDIA_ROOT)
+FW_DOWNLOAD_CACHE_MAX_BYTES = 10 * 1024 ** 3
+
+# Files of at least FW_DOWNLOAD_JOB_MIN_SIZE bytes opened in the viewer are
+# downloaded by background workers, at most FW_DOWNLOAD_JOB_PER_USER_LIMIT at a
+# time per API key. Finished jobs stay visible for FW_DOWNLOAD_JOB_RETENTION seconds.
+FW_DOWNLOAD_JOB_MIN_SIZE = 64 * 1024 ** 2
+FW_DOWNLOAD_JOB_WORKERS = 4
+FW_DOWNLOAD_JOB_MAX_QUEUE = 256
+FW_DOWNLOAD_JOB_PER_USER_LIMIT = 2
+FW_DOWNLOAD_JOB_RETENTION = 600
+
+# The search index is filled by `manage.py fw_sync`, resolving FW_SYNC_WORKERS
+# containers in parallel. Searches return at most FW_SEARCH_MAX_RESULTS nodes.
+FW_SYNC_WORKERS = 8
+FW_SEARCH_MAX_RESULTS = 200
+
+# Images with one of FW_TILE_EXTENSIONS and at most FW_TILE_MAX_SOURCE_BYTES are
+# shown in the viewer as a Deep Zoom pyramid of FW_TILE_SIZE px JPEG tiles, built
+# by FW_TILE_WORKERS processes and kept under FW_TILE_CACHE_DIR up to
+# FW_TILE_CACHE_MAX_BYTES. Listings show thumbnails of images up to
+# FW_THUMBNAIL_MAX_SOURCE_BYTES, built FW_THUMBNAIL_WORKERS at a time apart from
+# the viewer's download jobs. Their sources are downloaded to temporary files
+# under FW_THUMBNAIL_SPOOL_DIR (the system default if None), not to the download
+# cache, and past FW_THUMBNAIL_MAX_QUEUE waiting builds the oldest are dropped.
+FW_TILE_CACHE_DIR = os.path.join(BASE_DIR, 'tiles')
+FW_TILE_CACHE_MAX_BYTES = 5 * 1024 ** 3
+FW_TILE_WORKERS = 2
+FW_TILE_SIZE = 256
+FW_TILE_MAX_PIXELS = 1 << 30
+FW_TILE_EXTENSIONS = ('.tif', '.tiff', '.png', '.jpg', '.jpeg', '.bmp', '.gif')
+FW_TILE_MAX_SOURCE_BYTES = 4 * 1024 ** 3
+FW_THUMBNAIL_MAX_SOURCE_BYTES = 64 * 1024 ** 2
+FW_THUMBNAIL_WORKERS = 2
+FW_THUMBNAIL_MAX_QUEUE = 512
+FW_THUMBNAIL_SPOOL_DIR = None
+
+# ZIP exports fetch FW_EXPORT_WORKERS files at a time, each into memory up to
+# FW_EXPORT_BUFFER_MAX_BYTES and into a temporary file under
+# FW_EXPORT_SPOOL_DIR (None for the system default) above. The files being
+# fetched by one export add up to at most FW_EXPORT_SPOOL_MAX_BYTES, larger
+# files are streamed one by one at the end. An export covers at most
+# FW_EXPORT_MAX_FILES files.
+FW_EXPORT_WORKERS = 8
+FW_EXPORT_BUFFER_MAX_BYTES = 16 * 1024 ** 2
+FW_EXPORT_SPOOL_DIR = None
+FW_EXPORT_SPOOL_MAX_BYTES = 4 * 1024 ** 3
+FW_EXPORT_MAX_FILES = 10000
+
+# /home/stats/ and /home/metrics/ answer staff users, requests with an
+# "Authorization: Bearer <FW_MONITORING_TOKEN>" header (if a token is set) and
+# clients in FW_MONITORING_ALLOWED_NETWORKS; everyone else gets a 403.
+FW_MONITORING_TOKEN = None
+FW_MONITORING_ALLOWED_NETWORKS = ('127.0.0.0/8', '::1/128')
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/dev/ref/settings/#default-auto-field
 
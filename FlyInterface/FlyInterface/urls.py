@@ -15,13 +15,22 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import include, path
+from django.urls import include, path, re_path
 from django.shortcuts import redirect
-from django.conf.urls.static import static
+from home.views import media_file
 from . import settings
 
+import re
+
 urlpatterns = [
     path('', lambda request: redirect('home/', request=request)),
     path('home/', include('home.urls')),
     path('admin/', admin.site.urls),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+]
+
+# Same as static(), serving MEDIA_URL in development only, with validators
+if settings.DEBUG:
+    urlpatterns += [
+        re_path(r'^%s(?P<path>.*)$' % re.escape(settings.MEDIA_URL.lstrip('/')), media_file,
+                {'document_root': settings.MEDIA_ROOT}),
+    ]
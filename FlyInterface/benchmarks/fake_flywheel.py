@@ -0,0 +1,189 @@
+"""
+In-process stand-in for flywheel.Client used by the benchmarks.
+
+It serves a synthetic group/project/subject/session/acquisition hierarchy
+generated on the fly from the requested path, with a configurable latency per
+API call and a configurable file size, and implements only the SDK surface
+the home views use.
+"""
+
+import datetime
+import hashlib
+import threading
+import time
+
+import flywheel
+
+
+LEVELS = ('project', 'subject', 'session', 'acquisition')
+
+MODIFIED = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def _id(path):
+    return hashlib.sha1(path.encode()).hexdigest()[:24]
+
+
+class FakeUser:
+    def __init__(self, api_key) -> None:
+        self.id = 'user-' + _id(api_key)[:8]
+        self.firstname = 'Bench'
+        self.lastname = 'User'
+
+
+class FakeContainer:
+    def __init__(self, path, label, container_type, files=()) -> None:
+        self.id = _id(path)
+        self.label = label
+        self.container_type = container_type
+        self.modified = MODIFIED
+        self.files = list(files)
+
+
+class FakeFile:
+    def __init__(self, path, name, size) -> None:
+        self.id = _id(path)
+        self.file_id = self.id
+        self.name = name
+        self.size = size
+        self.type = 'image'
+        self.mimetype = 'image/tiff'
+        self.version = 1
+        self.modified = MODIFIED
+
+
+class FakeResolveResult:
+    def __init__(self, path, children) -> None:
+        self.path = path
+        self.children = children
+
+
+# Shape and timing of the fake Flywheel instance.
+#
+# fanout[i] is the number of children of each container at level i (group,
+# project, subject, session); acquisitions hold files_per_container files.
+class FakeHierarchy:
+    def __init__(self, group='wandell', fanout=(4, 4, 4, 4), files_per_container=8,
+                 file_size=1024 ** 2, latency=0.05, bandwidth=None) -> None:
+        self.group = group
+        self.fanout = fanout
+        self.files_per_container = files_per_container
+        self.file_size = file_size
+        self.latency = latency
+        self.bandwidth = bandwidth  # bytes per second, None for unlimited
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def resolve(self, path):
+        parts = [p for p in path.strip('/').split('/') if p]
+        if not parts or parts[0] != self.group or len(parts) > len(LEVELS) + 1:
+            raise flywheel.ApiException(404, 'Not Found')
+        nodes = [FakeContainer(self.group, self.group, 'group')]
+        for depth, label in enumerate(parts[1:]):
+            prefix = '/'.join(parts[:depth + 2])
+            if depth >= len(self.fanout) or label not in self._labels(depth):
+                raise flywheel.ApiException(404, 'Not Found')
+            nodes.append(FakeContainer(prefix, label, LEVELS[depth], self._files(prefix, depth)))
+        depth = len(parts) - 1
+        if depth < len(self.fanout):
+            children = [FakeContainer(path.strip('/') + '/' + label, label, LEVELS[depth])
+                        for label in self._labels(depth)]
+        else:
+            children = []
+        children += nodes[-1].files
+        return FakeResolveResult(nodes, children)
+
+    # Every path to a file, for picking viewer targets
+    def file_paths(self, limit=None):
+        paths = []
+        prefixes = [self.group]
+        for depth in range(len(self.fanout)):
+            prefixes = [p + '/' + label for p in prefixes for label in self._labels(depth)]
+        for prefix in prefixes:
+            paths += [prefix + '/' + f.name for f in self._files(prefix, len(self.fanout) - 1)]
+            if limit is not None and len(paths) >= limit:
+                return paths[:limit]
+        return paths
+
+    def container_paths(self):
+        paths = [self.group]
+        prefixes = [self.group]
+        for depth in range(len(self.fanout)):
+            prefixes = [p + '/' + label for p in prefixes for label in self._labels(depth)]
+            paths += prefixes
+        return paths
+
+    def _labels(self, depth):
+        return ['%s_%d' % (LEVELS[depth], i) for i in range(self.fanout[depth])]
+
+    def _files(self, prefix, depth):
+        if depth != len(self.fanout) - 1:
+            return []
+        return [FakeFile(prefix + '/file_%d.tif' % i, 'file_%d.tif' % i, self.file_size)
+                for i in range(self.files_per_container)]
+
+
+class FakeStreamedResponse:
+    def __init__(self, hierarchy, size) -> None:
+        self._hierarchy = hierarchy
+        self._size = size
+
+    def iter_content(self, chunk_size=65536):
+        block = bytes(chunk_size)
+        remaining = self._size
+        while remaining > 0:
+            n = min(chunk_size, remaining)
+            if self._hierarchy.bandwidth:
+                time.sleep(n / self._hierarchy.bandwidth)
+            remaining -= n
+            yield block[:n]
+
+    def close(self):
+        pass
+
+
+class FakeContainersApi:
+    def __init__(self, hierarchy) -> None:
+        self._hierarchy = hierarchy
+
+    def download_file_from_container_with_http_info(self, container_id, file_name, range=None, **kwargs):
+        self._hierarchy.count('download')
+        self._hierarchy.wait()
+        size = self._hierarchy.file_size
+        if range is not None:
+            first, last = range[len('bytes='):].split('-')
+            size = int(last) - int(first) + 1
+        return FakeStreamedResponse(self._hierarchy, size)
+
+
+class FakeClient:
+    def __init__(self, api_key, hierarchy) -> None:
+        # Stands for the auth handshake of flywheel.Client
+        hierarchy.count('client')
+        hierarchy.wait()
+        self._hierarchy = hierarchy
+        self._user = FakeUser(api_key)
+        self.containers_api = FakeContainersApi(hierarchy)
+
+    def get_current_user(self):
+        self._hierarchy.count('get_current_user')
+        self._hierarchy.wait()
+        return self._user
+
+    def resolve(self, path):
+        self._hierarchy.count('resolve')
+        self._hierarchy.wait()
+        return self._hierarchy.resolve(path)
+
+
+# Client factory for home.client_pool.client_pool
+def client_factory(hierarchy):
+    return lambda api_key: FakeClient(api_key, hierarchy)
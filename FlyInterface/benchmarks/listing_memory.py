@@ -0,0 +1,97 @@
+"""
+Memory footprint of a container listing held as Flywheel SDK objects versus
+the compact records of home.models.FwListing.
+
+A synthetic resolve() result with --children children (sessions and files) is
+built from the SDK models, then both representations are measured with
+tracemalloc after the objects they do not keep are released.
+
+Run from the FlyInterface directory:
+    python -m benchmarks.listing_memory --children 50000
+"""
+
+import argparse
+import datetime
+import gc
+import os
+import time
+import tracemalloc
+import types
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'FlyInterface.settings')
+django.setup()
+
+from flywheel.models import FileNode, SessionNode  # noqa: E402
+
+from home.models import FwListing  # noqa: E402
+
+
+def make_resolve_result(n_children, file_ratio):
+    modified = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    n_files = int(n_children * file_ratio)
+    children = [
+        SessionNode(id='%024x' % i, label='session_%06d' % i, modified=modified)
+        for i in range(n_children - n_files)
+    ]
+    children += [
+        FileNode(container_type='file', id='%024x' % i, file_id='%024x' % i, name='stack_%06d.tif' % i,
+                 type='image', mimetype='image/tiff', version=1, size=4 * 1024 ** 3, modified=modified)
+        for i in range(n_files)
+    ]
+    parent = SessionNode(id='%024x' % n_children, label='parent', modified=modified)
+    return types.SimpleNamespace(path=[parent], children=children)
+
+
+# Retained size and gc-tracked object count of build(), measured after the
+# temporaries it does not keep have been released, and its untraced run time.
+def measure(build, n_children, file_ratio):
+    result = make_resolve_result(n_children, file_ratio)
+    start = time.perf_counter()
+    build(result)
+    elapsed = time.perf_counter() - start
+    del result
+
+    gc.collect()
+    objects_before = len(gc.get_objects())
+    tracemalloc.start()
+    result = make_resolve_result(n_children, file_ratio)
+    kept = build(result)
+    del result
+    gc.collect()
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    objects = len(gc.get_objects()) - objects_before
+    del kept
+    return retained, objects, elapsed
+
+
+# What retrieveFWInfo kept before: the SDK children plus the filtered lists
+def build_sdk(result):
+    children = result.children
+    projects = [c for c in children if hasattr(c, 'label') and c.label is not None]
+    files = [c for c in children if hasattr(c, 'file_id')]
+    return children, projects, files
+
+
+def build_compact(result):
+    return FwListing.from_resolve(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--children', type=int, default=50000, help='number of children in the listing')
+    parser.add_argument('--file-ratio', type=float, default=0.8, help='fraction of children that are files')
+    args = parser.parse_args()
+
+    print(f'{args.children} children, {args.file_ratio:.0%} files')
+    print(f'{"representation":<16}{"retained MiB":>14}{"bytes/child":>13}{"gc objects":>12}{"build ms":>10}')
+    for name, build in (('sdk objects', build_sdk), ('FwListing', build_compact)):
+        retained, objects, elapsed = measure(build, args.children, args.file_ratio)
+        print(f'{name:<16}{retained / 1024 ** 2:>14.1f}{retained / args.children:>13.0f}'
+              f'{objects:>12}{elapsed * 1000:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
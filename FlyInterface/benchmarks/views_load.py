@@ -0,0 +1,187 @@
+"""
+Latency and throughput of the home views against a fake Flywheel backend.
+
+Each scenario sends --requests requests through Django's ASGI request path at
+every --concurrency level and reports latency percentiles, throughput and the
+peak resident memory of the process. The Flywheel client is replaced by the
+in-process fake of benchmarks.fake_flywheel, so no network access is needed.
+
+Scenarios:
+    index     GET /home/ (login page)
+    projects  GET /home/projects/<path> over all containers of the hierarchy
+    viewer    GET /home/viewer/<path> over the files of the hierarchy
+    files     GET /home/files/<path>, streaming the file body
+    export    GET /home/export/<path> of every session, streaming the ZIP
+
+Run from the FlyInterface directory, e.g.:
+    python -m benchmarks.views_load --concurrency 1,16,128 --latency-ms 50
+    python -m benchmarks.views_load --no-cache --max-p95-ms 500 --json results.json
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'FlyInterface.settings')
+django.setup()
+
+from django.test import AsyncClient  # noqa: E402
+from django.test.utils import override_settings  # noqa: E402
+
+from benchmarks.fake_flywheel import FakeHierarchy, client_factory  # noqa: E402
+
+SCENARIOS = ('index', 'projects', 'viewer', 'files', 'export')
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(p / 100 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def peak_rss_mib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def scenario_urls(name, hierarchy):
+    if name == 'index':
+        return ['/home/']
+    if name == 'projects':
+        return ['/home/projects/' + p for p in hierarchy.container_paths()]
+    if name == 'viewer':
+        return ['/home/viewer/' + p for p in hierarchy.file_paths(limit=1000)]
+    if name == 'files':
+        return ['/home/files/' + p for p in hierarchy.file_paths(limit=1000)]
+    return ['/home/export/' + p for p in hierarchy.container_paths() if p.count('/') == len(hierarchy.fanout) - 1]
+
+
+async def login(api_key):
+    client = AsyncClient()
+    response = await client.post('/home/', {'api_key': api_key})
+    assert response.status_code == 302, response.status_code
+    return client
+
+
+async def run_scenario(name, urls, n_requests, concurrency, api_key):
+    latencies = []
+    errors = 0
+    pending = itertools.islice(itertools.cycle(urls), n_requests)
+    clients = [await login(api_key) for _ in range(concurrency)]
+
+    async def worker(client):
+        nonlocal errors
+        for url in pending:
+            start = time.perf_counter()
+            response = await client.get(url)
+            if response.streaming:
+                async for _ in response.streaming_content:
+                    pass
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(c) for c in clients))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'scenario': name,
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+        'throughput_rps': len(latencies) / elapsed if elapsed else 0.0,
+        'peak_rss_mib': peak_rss_mib(),
+    }
+
+
+def reset_state(no_cache):
+    from home.cache import hierarchy_cache, user_cache
+    from home.client_pool import client_pool
+    from home.download_cache import download_cache
+
+    client_pool.clear()
+    hierarchy_cache.clear()
+    user_cache.clear()
+    download_cache.clear()
+    if no_cache:
+        hierarchy_cache.ttl = user_cache.ttl = 0
+
+
+async def main_async(args, hierarchy):
+    from home.client_pool import client_pool
+    client_pool.factory = client_factory(hierarchy)
+
+    results = []
+    print(f'{"scenario":<10}{"conc":>6}{"reqs":>7}{"err":>5}{"p50 ms":>9}{"p95 ms":>9}'
+          f'{"p99 ms":>9}{"max ms":>9}{"req/s":>9}{"rss MiB":>9}')
+    for name in args.scenarios:
+        urls = scenario_urls(name, hierarchy)
+        for concurrency in args.concurrency:
+            reset_state(args.no_cache)
+            r = await run_scenario(name, urls, args.requests, concurrency, 'bench-key')
+            results.append(r)
+            print(f'{r["scenario"]:<10}{r["concurrency"]:>6}{r["requests"]:>7}{r["errors"]:>5}'
+                  f'{r["p50_ms"]:>9.1f}{r["p95_ms"]:>9.1f}{r["p99_ms"]:>9.1f}{r["max_ms"]:>9.1f}'
+                  f'{r["throughput_rps"]:>9.1f}{r["peak_rss_mib"]:>9.1f}')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        type=lambda s: [x for x in s.split(',') if x], help='comma separated scenarios to run')
+    parser.add_argument('--concurrency', default=[1, 8, 32, 128],
+                        type=lambda s: [int(x) for x in s.split(',')], help='comma separated concurrency levels')
+    parser.add_argument('--requests', type=int, default=500, help='requests per scenario and concurrency level')
+    parser.add_argument('--latency-ms', type=float, default=50, help='latency of each fake Flywheel API call')
+    parser.add_argument('--fanout', default=(4, 4, 4, 4),
+                        type=lambda s: tuple(int(x) for x in s.split(',')),
+                        help='children per group,project,subject,session')
+    parser.add_argument('--files', type=int, default=8, help='files per acquisition')
+    parser.add_argument('--file-size', type=int, default=1024 ** 2, help='size of every file in bytes')
+    parser.add_argument('--bandwidth', type=float, default=None, help='download bandwidth in bytes/s')
+    parser.add_argument('--no-cache', action='store_true', help='disable the hierarchy and user caches')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--max-p95-ms', type=float, default=None,
+                        help='exit with status 1 if any scenario has a higher p95 latency')
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: ' + ', '.join(sorted(unknown)))
+
+    hierarchy = FakeHierarchy(fanout=args.fanout, files_per_container=args.files, file_size=args.file_size,
+                              latency=args.latency_ms / 1000, bandwidth=args.bandwidth)
+    with tempfile.TemporaryDirectory() as cache_dir, override_settings(
+            ALLOWED_HOSTS=['testserver'],
+            SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies',
+            FW_DOWNLOAD_CACHE_DIR=cache_dir):
+        results = asyncio.run(main_async(args, hierarchy))
+
+    print('fake Flywheel calls:', ', '.join(f'{k}={v}' for k, v in sorted(hierarchy.calls.items())))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results, 'calls': hierarchy.calls}, f, indent=2)
+    if args.max_p95_ms is not None:
+        slow = [r for r in results if r['p95_ms'] > args.max_p95_ms]
+        for r in slow:
+            print(f'p95 of {r["scenario"]} at concurrency {r["concurrency"]} is {r["p95_ms"]:.1f} ms '
+                  f'> {args.max_p95_ms} ms', file=sys.stderr)
+        if slow:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+# In-process LRU cache with a per-entry time to live.
+#
+# The cache is bounded both by number of entries and by an approximate byte
+# size; the size of a value is given by the `sizeof` callable (or passed to
+# set() explicitly) since Flywheel SDK objects have no cheap exact size.
+class TTLCache:
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024, ttl=60, sizeof=None) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._sizeof = sizeof or (lambda value: 0)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, size, expires_at)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            if entry[2] <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size=None):
+        if size is None:
+            size = self._sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic() + self.ttl)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    # Drop every entry whose key matches the predicate.
+    def invalidate_matching(self, predicate):
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+    # Must be called with the lock held.
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+
+# Container listings (home.models.FwListing) keyed by (user id, path)
+hierarchy_cache = TTLCache(
+    max_entries=getattr(settings, 'FW_HIERARCHY_CACHE_MAX_ENTRIES', 256),
+    max_bytes=getattr(settings, 'FW_HIERARCHY_CACHE_MAX_BYTES', 64 * 1024 * 1024),
+    ttl=getattr(settings, 'FW_HIERARCHY_CACHE_TTL', 60),
+    sizeof=lambda listing: 256 + listing.nbytes)
+
+# Current user profile keyed by API key
+user_cache = TTLCache(
+    max_entries=getattr(settings, 'FW_CLIENT_POOL_MAX_SIZE', 32) * 4,
+    ttl=getattr(settings, 'FW_USER_CACHE_TTL', 600),
+    sizeof=lambda user: 1024)
@@ -0,0 +1,124 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+
+from django.conf import settings
+
+from .executor import run_blocking
+from .instrumentation import InstrumentedClient, timed_call
+
+import flywheel
+
+
+# Process-wide pool of Flywheel clients keyed by API key.
+#
+# Building a flywheel.Client performs the auth handshake and sets up a fresh
+# HTTP session, so views check clients out of this pool instead and hand them
+# back once the request is done. Idle clients are kept per API key (most
+# recently used last) and dropped when they exceed the idle timeout or when the
+# pool grows past its max size. Clients are handed out wrapped in an
+# InstrumentedClient so every SDK call is timed.
+class FlywheelClientPool:
+    def __init__(self, max_size=32, idle_timeout=600, factory=flywheel.Client) -> None:
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.factory = factory
+        self._lock = threading.Lock()
+        self._idle = OrderedDict()  # api_key -> [(client, last_used), ...]
+        self._idle_count = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def checkout(self, api_key):
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            clients = self._idle.get(api_key)
+            if clients:
+                client, _ = clients.pop()
+                self._idle_count -= 1
+                if not clients:
+                    del self._idle[api_key]
+                self.hits += 1
+                return client
+            self.misses += 1
+        # Create outside the lock, the handshake is a network round trip.
+        return InstrumentedClient(timed_call('client', self.factory, api_key))
+
+    def checkin(self, api_key, client):
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            self._idle.setdefault(api_key, []).append((client, now))
+            self._idle.move_to_end(api_key)
+            self._idle_count += 1
+            while self._idle_count > self.max_size:
+                # Drop the oldest client of the least recently used key.
+                lru_key, clients = next(iter(self._idle.items()))
+                clients.pop(0)
+                self._idle_count -= 1
+                self.evictions += 1
+                if not clients:
+                    del self._idle[lru_key]
+
+    @contextmanager
+    def client(self, api_key):
+        fw_client = self.checkout(api_key)
+        try:
+            yield fw_client
+        finally:
+            self.checkin(api_key, fw_client)
+
+    # Async variant of client(), a new client is created on the executor.
+    @asynccontextmanager
+    async def aclient(self, api_key):
+        fw_client = await run_blocking(self.checkout, api_key)
+        try:
+            yield fw_client
+        finally:
+            self.checkin(api_key, fw_client)
+
+    def discard(self, api_key):
+        with self._lock:
+            clients = self._idle.pop(api_key, [])
+            self._idle_count -= len(clients)
+
+    def clear(self):
+        with self._lock:
+            self._idle.clear()
+            self._idle_count = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self._idle_count,
+                'keys': len(self._idle),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+    # Must be called with the lock held.
+    def _expire(self, now):
+        deadline = now - self.idle_timeout
+        for api_key in list(self._idle):
+            clients = self._idle[api_key]
+            fresh = [entry for entry in clients if entry[1] >= deadline]
+            expired = len(clients) - len(fresh)
+            if expired:
+                self._idle_count -= expired
+                self.expirations += expired
+                if fresh:
+                    self._idle[api_key] = fresh
+                else:
+                    del self._idle[api_key]
+
+
+client_pool = FlywheelClientPool(
+    max_size=getattr(settings, 'FW_CLIENT_POOL_MAX_SIZE', 32),
+    idle_timeout=getattr(settings, 'FW_CLIENT_POOL_IDLE_TIMEOUT', 600))
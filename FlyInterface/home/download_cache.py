@@ -0,0 +1,267 @@
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+_ENTRY_RE = re.compile(r'^(?P<file_id>[0-9A-Za-z]+)-v(?P<version>\d+)(?P<suffix>\.[^/]*)?$')
+
+
+# Bounded on-disk cache of downloaded Flywheel files.
+#
+# Entries are keyed by (file id, version) so files with the same name in
+# different containers never collide, and are evicted least recently used
+# first once the cache grows past max_bytes. Downloads are written to a
+# temporary file and renamed into place on success, and only one download per
+# key runs at a time: concurrent requests for a key in flight wait for it
+# instead of fetching the file again.
+class DownloadCache:
+    def __init__(self, root, max_bytes=10 * 1024 ** 3, wait_timeout=600) -> None:
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.wait_timeout = wait_timeout
+        self._tmp_dir = os.path.join(self.root, '.tmp')
+        self._pinned_dir = os.path.join(self.root, '.pinned')
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (path, size)
+        self._bytes = 0
+        self._inflight = {}  # key -> threading.Event
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+        self.bytes_downloaded = 0
+        self._load()
+
+    def path_for(self, key, suffix=''):
+        file_id, version = key
+        return os.path.join(self.root, '%s-v%d%s' % (file_id, version, suffix))
+
+    # Whether a file of this size fits in the cache at all.
+    def accepts(self, size):
+        return size is not None and size <= self.max_bytes
+
+    # Whether key is cached, without counting a lookup.
+    def contains(self, key):
+        with self._lock:
+            return key in self._entries
+
+    # Path of a cached file, or None on a miss.
+    def lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.bytes_saved += entry[1]
+            return entry[0]
+
+    # Cached file opened for reading, or None on a miss. Evicted files are
+    # only removed after they left the index, so a file opened under the lock
+    # exists, and stays readable however long the caller holds it.
+    def open(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            f = open(entry[0], 'rb')
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.bytes_saved += entry[1]
+            return f
+
+    # Hard link to the cached file of key that eviction does not remove, for
+    # readers in other processes, or None on a miss. Release it with unpin().
+    def pin(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            path = os.path.join(self._pinned_dir, uuid.uuid4().hex + '-' + os.path.basename(entry[0]))
+            os.link(entry[0], path)
+            self._entries.move_to_end(key)
+            return path
+
+    def unpin(self, path):
+        _remove_file(path)
+
+    # Start downloading key into the cache.
+    # Returns None if another download of the same key is already in flight.
+    def open_writer(self, key, suffix=''):
+        with self._lock:
+            if key in self._inflight or key in self._entries:
+                return None
+            self._inflight[key] = threading.Event()
+        try:
+            return CacheWriter(self, key, suffix)
+        except Exception:
+            self._finish(key)
+            raise
+
+    # Wait for an in-flight download of key, returns its path or None. With
+    # open_file, the file opened for reading as by open().
+    def wait(self, key, timeout=None, open_file=False):
+        with self._lock:
+            event = self._inflight.get(key)
+        if event is not None:
+            event.wait(self.wait_timeout if timeout is None else timeout)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            result = open(entry[0], 'rb') if open_file else entry[0]
+            self._entries.move_to_end(key)
+            self.coalesced += 1
+            self.bytes_saved += entry[1]
+            return result
+
+    # Return the cached path of key, downloading it with download(writer) on
+    # a miss. Concurrent callers for the same key share a single download.
+    def fetch(self, key, download, suffix=''):
+        while True:
+            path = self.lookup(key)
+            if path is not None:
+                return path
+            writer = self.open_writer(key, suffix)
+            if writer is None:
+                path = self.wait(key)
+                if path is not None:
+                    return path
+                continue
+            try:
+                download(writer)
+            except BaseException:
+                writer.abort()
+                raise
+            return writer.commit()
+
+    # Drop every cached file, downloads in flight are left alone.
+    def clear(self):
+        with self._lock:
+            paths = [path for path, _ in self._entries.values()]
+            self._entries.clear()
+            self._bytes = 0
+        for path in paths:
+            _remove_file(path)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'in_flight': len(self._inflight),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'hit_rate': (self.hits + self.coalesced) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'bytes_saved': self.bytes_saved,
+                'bytes_downloaded': self.bytes_downloaded,
+            }
+
+    def _commit(self, key, tmp_path, suffix, size):
+        path = self.path_for(key, suffix)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._entries[key] = (path, size)
+            self._bytes += size
+            self.bytes_downloaded += size
+            evicted = self._evict()
+        for old_path in evicted:
+            _remove_file(old_path)
+        self._finish(key)
+        return path
+
+    def _finish(self, key):
+        with self._lock:
+            event = self._inflight.pop(key, None)
+        if event is not None:
+            event.set()
+
+    # Must be called with the lock held, returns the paths to delete.
+    def _evict(self):
+        evicted = []
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            _, (path, size) = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            evicted.append(path)
+        return evicted
+
+    # Index files left by a previous run, oldest access first.
+    def _load(self):
+        os.makedirs(self._tmp_dir, exist_ok=True)
+        os.makedirs(self._pinned_dir, exist_ok=True)
+        # Pins of readers that are gone with the previous run.
+        for entry in os.scandir(self._pinned_dir):
+            _remove_file(entry.path)
+        # Temporary files of downloads that can no longer be running.
+        stale = time.time() - self.wait_timeout
+        for entry in os.scandir(self._tmp_dir):
+            if entry.stat().st_mtime < stale:
+                _remove_file(entry.path)
+        found = []
+        for entry in os.scandir(self.root):
+            match = _ENTRY_RE.match(entry.name)
+            if match is None or not entry.is_file():
+                continue
+            stat = entry.stat()
+            key = (match.group('file_id'), int(match.group('version')))
+            found.append((stat.st_atime, key, entry.path, stat.st_size))
+        for _, key, path, size in sorted(found):
+            self._entries[key] = (path, size)
+            self._bytes += size
+        for path in self._evict():
+            _remove_file(path)
+
+
+# Temporary file receiving one download, see DownloadCache.open_writer.
+class CacheWriter:
+    def __init__(self, cache, key, suffix) -> None:
+        self.key = key
+        self.size = 0
+        self._cache = cache
+        self._suffix = suffix
+        fd, self._tmp_path = tempfile.mkstemp(dir=cache._tmp_dir)
+        self._file = os.fdopen(fd, 'wb')
+
+    def write(self, chunk):
+        self._file.write(chunk)
+        self.size += len(chunk)
+
+    def commit(self):
+        try:
+            self._file.close()
+            return self._cache._commit(self.key, self._tmp_path, self._suffix, self.size)
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self):
+        if not self._file.closed:
+            self._file.close()
+        _remove_file(self._tmp_path)
+        self._cache._finish(self.key)
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+download_cache = DownloadCache(
+    getattr(settings, 'FW_DOWNLOAD_CACHE_DIR', os.path.join(settings.BASE_DIR, settings.MEDIA_ROOT)),
+    max_bytes=getattr(settings, 'FW_DOWNLOAD_CACHE_MAX_BYTES', 10 * 1024 ** 3))
@@ -0,0 +1,23 @@
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+
+# Bounded thread pool for the blocking Flywheel SDK calls of the async views.
+# Requests beyond the worker count queue here instead of each pinning a
+# server thread while they wait on the network.
+fw_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'FW_EXECUTOR_MAX_WORKERS', 64),
+    thread_name_prefix='flywheel')
+
+
+# Run func(*args, **kwargs) on the Flywheel executor from a coroutine.
+# Context variables of the caller are visible to func.
+async def run_blocking(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        fw_executor, functools.partial(context.run, func, *args, **kwargs))
@@ -0,0 +1,146 @@
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+ERRORS_NAME = 'export_errors.txt'
+
+
+# One file of an export: its name in the archive and how to get its content.
+# fetch() returns a binary file object holding the whole file; files larger
+# than the spool budget of iter_zip_export are streamed through stream()
+# instead.
+class ExportEntry:
+    __slots__ = ('arcname', 'size', 'modified', 'fetch', 'stream')
+
+    def __init__(self, arcname, size, modified, fetch, stream) -> None:
+        self.arcname = arcname
+        self.size = size
+        self.modified = modified
+        self.fetch = fetch
+        self.stream = stream
+
+
+# Write sink collecting what zipfile writes until it is drained
+class _ZipBuffer:
+    def __init__(self) -> None:
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+# Stream a ZIP archive of entries.
+#
+# Up to `workers` files are fetched concurrently and each is added to the
+# archive as soon as its fetch completes, so the archive comes out in
+# completion order. zipfile writes to the unseekable buffer with data
+# descriptors, nothing but the files being fetched and one chunk of output
+# is held at a time. The files being fetched add up to at most
+# max_fetch_bytes, files larger than that on their own are streamed one after the other at the end. Files that could not be
+# fetched or broke off while streaming are listed in ERRORS_NAME instead of
+# breaking the download halfway.
+def iter_zip_export(entries, workers=8, chunk_size=256 * 1024, max_fetch_bytes=None):
+    buffer = _ZipBuffer()
+    archive = zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED, allowZip64=True)
+    pending = iter(entries)
+    next_entry = None
+    running = {}
+    fetch_bytes = 0
+    streamed = []
+    errors = []
+    executor = ThreadPoolExecutor(workers, thread_name_prefix='fw-export')
+
+    # Start fetches while a worker and enough of the byte budget are free.
+    def submit():
+        nonlocal next_entry, fetch_bytes
+        while len(running) < workers:
+            if next_entry is None:
+                next_entry = next(pending, None)
+                if next_entry is None:
+                    return
+                if max_fetch_bytes is not None and next_entry.size > max_fetch_bytes:
+                    streamed.append(next_entry)
+                    next_entry = None
+                    continue
+            if max_fetch_bytes is not None and fetch_bytes + next_entry.size > max_fetch_bytes:
+                return
+            running[executor.submit(next_entry.fetch)] = next_entry
+            fetch_bytes += next_entry.size
+            next_entry = None
+
+    try:
+        submit()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                entry = running.pop(future)
+                try:
+                    source = future.result()
+                except Exception as e:
+                    errors.append('%s: %s' % (entry.arcname, e))
+                    source = None
+                if source is not None:
+                    with source:
+                        yield from _write_entry(archive, buffer, entry,
+                                                iter(lambda: source.read(chunk_size), b''), errors)
+                # Written out, its bytes are free for the next fetch.
+                fetch_bytes -= entry.size
+                submit()
+        for entry in streamed:
+            try:
+                chunks = entry.stream()
+            except Exception as e:
+                errors.append('%s: %s' % (entry.arcname, e))
+                continue
+            yield from _write_entry(archive, buffer, entry, chunks, errors)
+        if errors:
+            archive.writestr(ERRORS_NAME, '\n'.join(errors) + '\n')
+        archive.close()
+        data = buffer.drain()
+        if data:
+            yield data
+    finally:
+        for future in running:
+            future.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+        # Close whatever finished fetching after the consumer went away.
+        for future in running:
+            if future.done() and not future.cancelled() and future.exception() is None and future.result():
+                future.result().close()
+
+
+# Add one member from chunks. A source failing partway leaves the member
+# truncated (the bytes before are on their way to the client already) and is
+# recorded in errors.
+def _write_entry(archive, buffer, entry, chunks, errors):
+    info = zipfile.ZipInfo(entry.arcname, entry.modified.timetuple()[:6] if entry.modified else (1980, 1, 1, 0, 0, 0))
+    info.compress_type = zipfile.ZIP_STORED
+    info.file_size = entry.size
+    written = 0
+    try:
+        with archive.open(info, 'w') as member:
+            try:
+                for chunk in chunks:
+                    member.write(chunk)
+                    written += len(chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            except Exception as e:
+                errors.append('%s: truncated after %d of %d bytes: %s' % (entry.arcname, written, entry.size, e))
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+    data = buffer.drain()
+    if data:
+        yield data
@@ -0,0 +1,211 @@
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+# Cumulative histograms keyed by a label value, in the Prometheus sense
+class Histogram:
+    def __init__(self, name, help, label, buckets=DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}  # label value -> [bucket counts..., count, sum]
+
+    def observe(self, label_value, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += seconds
+
+    def exposition(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            series = {k: list(v) for k, v in self._series.items()}
+        for value, counts in sorted(series.items()):
+            label = '%s="%s"' % (self.label, _escape(value))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append('%s_bucket{%s,le="%s"} %d' % (self.name, label, bound, cumulative))
+            cumulative += counts[len(self.buckets)]
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (self.name, label, cumulative))
+            lines.append('%s_sum{%s} %.6f' % (self.name, label, counts[-1]))
+            lines.append('%s_count{%s} %d' % (self.name, label, cumulative))
+        return lines
+
+
+flywheel_calls = Histogram(
+    'flyinterface_flywheel_call_seconds', 'Duration of Flywheel SDK calls.', 'call')
+template_renders = Histogram(
+    'flyinterface_render_seconds', 'Duration of template rendering.', 'template')
+request_durations = Histogram(
+    'flyinterface_request_seconds', 'Duration of requests until the response headers.', 'view')
+
+
+# Durations recorded while serving one request, for the Server-Timing header.
+# Flywheel calls run on executor threads, hence the lock.
+class RequestTimings:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.entries = {}  # name -> [count, seconds]
+
+    def add(self, name, seconds):
+        with self._lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                self.entries[name] = [1, seconds]
+            else:
+                entry[0] += 1
+                entry[1] += seconds
+
+    def header(self, total):
+        with self._lock:
+            entries = sorted(self.entries.items())
+        parts = ['%s;dur=%.1f;desc="%d call%s"' % (name, seconds * 1000, count, '' if count == 1 else 's')
+                 for name, (count, seconds) in entries]
+        parts.append('total;dur=%.1f' % (total * 1000))
+        return ', '.join(parts)
+
+
+_current_timings = contextvars.ContextVar('flyinterface_request_timings', default=None)
+
+
+def _record(histogram, label_value, seconds, timing_name=None):
+    histogram.observe(label_value, seconds)
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.add(timing_name or label_value, seconds)
+
+
+# Time a block of code into histogram and the current request's timings,
+# where it shows up as timing_name (default: the label value)
+@contextmanager
+def timed(histogram, label_value, timing_name=None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(histogram, label_value, time.perf_counter() - start, timing_name)
+
+
+def timed_call(name, func, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _record(flywheel_calls, name, time.perf_counter() - start)
+
+
+# Thin wrapper timing every method call made on a Flywheel client.
+# Nested API objects such as containers_api are wrapped as well, with their
+# name as prefix of the call name.
+class InstrumentedClient:
+    def __init__(self, client, prefix='') -> None:
+        self._client = client
+        self._prefix = prefix
+        self._wrappers = {}
+
+    def __getattr__(self, name):
+        wrapper = self._wrappers.get(name)
+        if wrapper is not None:
+            return wrapper
+        attr = getattr(self._client, name)
+        if name.startswith('_') or isinstance(attr, (str, bytes, int, float, bool, type(None))):
+            return attr
+        if callable(attr):
+            call_name = self._prefix + name
+
+            def wrapper(*args, **kwargs):
+                return timed_call(call_name, attr, *args, **kwargs)
+        elif name.endswith('_api'):
+            wrapper = InstrumentedClient(attr, self._prefix + name + '.')
+        else:
+            return attr
+        self._wrappers[name] = wrapper
+        return wrapper
+
+
+# Adds a Server-Timing header with the Flywheel calls and template rendering
+# of each request, and feeds the request duration histogram.
+class ServerTimingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response) -> None:
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timings = RequestTimings()
+        token = _current_timings.set(timings)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_timings.reset(token)
+        return self._finish(request, response, timings, start)
+
+    async def __acall__(self, request):
+        timings = RequestTimings()
+        token = _current_timings.set(timings)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current_timings.reset(token)
+        return self._finish(request, response, timings, start)
+
+    def _finish(self, request, response, timings, start):
+        total = time.perf_counter() - start
+        match = getattr(request, 'resolver_match', None)
+        request_durations.observe(match.url_name if match is not None and match.url_name else 'unknown', total)
+        response['Server-Timing'] = timings.header(total)
+        return response
+
+
+# Stats fields that only ever grow, exported as counters; every other numeric
+# field is a point-in-time value such as a queue depth or cache size.
+COUNTER_FIELDS = frozenset([
+    'hits', 'misses', 'evictions', 'expirations', 'coalesced', 'bytes_saved', 'bytes_downloaded',
+    'completed', 'failed', 'wait_seconds_total', 'builds', 'build_failures', 'build_seconds',
+    'submitted', 'dropped', 'built',
+])
+
+
+# Prometheus text exposition of the histograms plus the numeric fields of
+# the given {component: stats dict} mapping, as counters with a _total suffix
+# for COUNTER_FIELDS and as gauges otherwise.
+def exposition(stats):
+    lines = []
+    for histogram in (request_durations, flywheel_calls, template_renders):
+        lines += histogram.exposition()
+    for component, values in sorted(stats.items()):
+        for key, value in sorted(values.items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                name = 'flyinterface_%s_%s' % (component, key)
+                if key in COUNTER_FIELDS:
+                    name = name.removesuffix('_total') + '_total'
+                    lines.append('# TYPE %s counter' % name)
+                else:
+                    lines.append('# TYPE %s gauge' % name)
+                lines.append('%s %s' % (name, value))
+    return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,184 @@
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+from django.conf import settings
+
+from .download_cache import download_cache
+from .streaming import FlywheelFileStream
+
+
+class QueueFull(Exception):
+    pass
+
+
+# One background download of a Flywheel file into the download cache
+class DownloadJob:
+    def __init__(self, key, api_key, container_id, file_name, size) -> None:
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.api_key = api_key
+        self.api_keys = {api_key}  # everyone who asked for this file
+        self.container_id = container_id
+        self.file_name = file_name
+        self.status = 'queued'
+        self.bytes_done = 0
+        self.bytes_total = size
+        self.error = None
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'bytes_done': self.bytes_done,
+            'bytes_total': self.bytes_total,
+            'error': self.error,
+        }
+
+
+# Bounded queue of download jobs served by a fixed set of worker threads.
+#
+# Jobs for a file already queued or running are deduplicated, and a worker
+# skips over jobs of users that already have per_user_limit downloads running
+# so one user opening many files cannot starve the others.
+class DownloadJobQueue:
+    def __init__(self, workers=4, max_queue=256, per_user_limit=2, retention=600) -> None:
+        self.workers = workers
+        self.max_queue = max_queue
+        self.per_user_limit = per_user_limit
+        self.retention = retention
+        self._cond = threading.Condition()
+        self._pending = deque()
+        self._jobs = {}  # job id -> job
+        self._by_key = {}  # cache key -> unfinished job
+        self._running = {}  # api key -> number of running jobs
+        self._threads = []
+        self.completed = 0
+        self.failed = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.busy_seconds = 0.0
+        self.bytes_downloaded = 0
+
+    def submit(self, key, api_key, container_id, file_name, size):
+        with self._cond:
+            self._prune()
+            job = self._by_key.get(key)
+            if job is not None:
+                job.api_keys.add(api_key)
+                return job
+            if len(self._pending) >= self.max_queue:
+                raise QueueFull()
+            job = DownloadJob(key, api_key, container_id, file_name, size)
+            self._jobs[job.id] = job
+            self._by_key[key] = job
+            self._pending.append(job)
+            self._start_workers()
+            self._cond.notify()
+            return job
+
+    # Job by id, only visible to the API keys that submitted it.
+    def get(self, job_id, api_key):
+        with self._cond:
+            job = self._jobs.get(job_id)
+        if job is None or api_key not in job.api_keys:
+            return None
+        return job
+
+    def stats(self):
+        with self._cond:
+            return {
+                'queued': len(self._pending),
+                'running': sum(self._running.values()),
+                'workers': self.workers,
+                'max_queue': self.max_queue,
+                'completed': self.completed,
+                'failed': self.failed,
+                'wait_seconds_total': self.wait_seconds,
+                'wait_seconds_max': self.max_wait_seconds,
+                'bytes_downloaded': self.bytes_downloaded,
+                'throughput_bytes_per_s': self.bytes_downloaded / self.busy_seconds if self.busy_seconds else 0.0,
+            }
+
+    # Must be called with the lock held.
+    def _start_workers(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name='download-job-%d' % len(self._threads), daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    # Must be called with the lock held.
+    def _prune(self):
+        deadline = time.monotonic() - self.retention
+        for job_id in [j.id for j in self._jobs.values() if j.finished and j.finished_at < deadline]:
+            del self._jobs[job_id]
+
+    # Must be called with the lock held.
+    def _next_job(self):
+        for job in self._pending:
+            if self._running.get(job.api_key, 0) < self.per_user_limit:
+                self._pending.remove(job)
+                return job
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+                self._running[job.api_key] = self._running.get(job.api_key, 0) + 1
+                job.status = 'running'
+                job.started_at = time.monotonic()
+                wait = job.started_at - job.enqueued_at
+                self.wait_seconds += wait
+                self.max_wait_seconds = max(self.max_wait_seconds, wait)
+
+            try:
+                download_cache.fetch(job.key, lambda writer: self._download(job, writer),
+                                     os.path.splitext(job.file_name)[1])
+                status, error = 'done', None
+            except Exception as e:
+                status, error = 'failed', str(e)
+
+            with self._cond:
+                job.status = status
+                job.error = error
+                job.finished_at = time.monotonic()
+                self.busy_seconds += job.finished_at - job.started_at
+                if status == 'done':
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                self._running[job.api_key] -= 1
+                del self._by_key[job.key]
+                # A slot of this user freed up, a skipped job may now run.
+                self._cond.notify_all()
+
+    def _download(self, job, writer):
+        stream = FlywheelFileStream(job.api_key, job.container_id, job.file_name)
+        try:
+            for chunk in stream:
+                writer.write(chunk)
+                job.bytes_done += len(chunk)
+        finally:
+            stream.close()
+        with self._cond:
+            self.bytes_downloaded += job.bytes_done
+
+
+download_jobs = DownloadJobQueue(
+    workers=getattr(settings, 'FW_DOWNLOAD_JOB_WORKERS', 4),
+    max_queue=getattr(settings, 'FW_DOWNLOAD_JOB_MAX_QUEUE', 256),
+    per_user_limit=getattr(settings, 'FW_DOWNLOAD_JOB_PER_USER_LIMIT', 2),
+    retention=getattr(settings, 'FW_DOWNLOAD_JOB_RETENTION', 600))
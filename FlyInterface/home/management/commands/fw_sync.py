@@ -0,0 +1,30 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from home.search_index import HierarchySync
+
+
+class Command(BaseCommand):
+    help = ('Mirror a Flywheel subtree into the local search index. Only containers whose '
+            'modified time changed since the last sync are walked again, unless --full is given.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('root_path', nargs='?', default='wandell', help='Flywheel path to sync')
+        parser.add_argument('--api-key', default=os.environ.get('FW_API_KEY'),
+                            help='Flywheel API key, defaults to $FW_API_KEY')
+        parser.add_argument('--workers', type=int, default=getattr(settings, 'FW_SYNC_WORKERS', 8),
+                            help='containers resolved in parallel')
+        parser.add_argument('--full', action='store_true', help='walk every container')
+
+    def handle(self, *args, **options):
+        if not options['api_key']:
+            raise CommandError('Pass --api-key or set FW_API_KEY')
+        sync = HierarchySync(options['api_key'], workers=options['workers'], full=options['full'])
+        stats = sync.run(options['root_path'])
+        for path, error in sync.errors:
+            self.stderr.write('%s: %s' % (path, error))
+        self.stdout.write(
+            'walked {walked} containers, skipped {skipped} unchanged, {added} added, {updated} updated, '
+            '{removed} removed, {errors} errors in {seconds:.1f}s'.format(**stats))
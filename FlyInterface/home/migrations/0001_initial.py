@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FwIndexNode',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fw_id', models.CharField(max_length=64)),
+                ('type', models.CharField(max_length=16)),
+                ('label', models.CharField(max_length=512)),
+                ('path', models.TextField(unique=True)),
+                ('size', models.BigIntegerField(null=True)),
+                ('modified', models.DateTimeField(null=True)),
+                ('synced_modified', models.DateTimeField(null=True)),
+                ('parent', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='children', to='home.fwindexnode')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['parent', 'label'], name='home_fwinde_parent__b9efe7_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+from django.db import migrations
+
+
+# FTS5 index over the labels of home_fwindexnode, kept in sync with the table
+# by triggers. The label is tokenized on punctuation so that a file name like
+# sub-01_T1w.nii.gz matches "T1w", and prefix indexes make "T1*" cheap.
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=[
+                """CREATE VIRTUAL TABLE home_fwindexnode_fts USING fts5(
+                       label, content='home_fwindexnode', content_rowid='id',
+                       tokenize='unicode61', prefix='2 3')""",
+                """CREATE TRIGGER home_fwindexnode_fts_insert AFTER INSERT ON home_fwindexnode BEGIN
+                       INSERT INTO home_fwindexnode_fts(rowid, label) VALUES (new.id, new.label);
+                   END""",
+                """CREATE TRIGGER home_fwindexnode_fts_delete AFTER DELETE ON home_fwindexnode BEGIN
+                       INSERT INTO home_fwindexnode_fts(home_fwindexnode_fts, rowid, label)
+                       VALUES ('delete', old.id, old.label);
+                   END""",
+                """CREATE TRIGGER home_fwindexnode_fts_update AFTER UPDATE OF label ON home_fwindexnode BEGIN
+                       INSERT INTO home_fwindexnode_fts(home_fwindexnode_fts, rowid, label)
+                       VALUES ('delete', old.id, old.label);
+                       INSERT INTO home_fwindexnode_fts(rowid, label) VALUES (new.id, new.label);
+                   END""",
+            ],
+            reverse_sql=[
+                'DROP TRIGGER home_fwindexnode_fts_update',
+                'DROP TRIGGER home_fwindexnode_fts_delete',
+                'DROP TRIGGER home_fwindexnode_fts_insert',
+                'DROP TABLE home_fwindexnode_fts',
+            ],
+        ),
+    ]
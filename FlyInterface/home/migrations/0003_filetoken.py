@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0002_fwindexnode_fts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=64, unique=True)),
+                ('session_key', models.TextField()),
+                ('path', models.TextField()),
+                ('expires', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
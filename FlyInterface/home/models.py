@@ -1,5 +1,8 @@
 from django.db import models
 
+import hashlib
+import sys
+
 
 class FwUserInfo:
     def __init__(self) -> None:
@@ -11,4 +14,128 @@ class FwContextInfo:
         self.user = FwUserInfo()
         self.projects = []
         self.files = []
-        self.current_path = 'wandell/'
\ No newline at end of file
+        self.current_path = 'wandell/'
+        # projects and files hold one page of the listing, sub containers first
+        self.total_projects = 0
+        self.total_files = 0
+        self.next_offset = None
+        # names of the files in files shown with a thumbnail
+        self.thumbnails = set()
+        # ETag of the page, see retrieveFWInfo
+        self.etag = None
+
+
+# Compact records of a container listing. The template and the file proxy only
+# need a handful of fields, so the listing keeps these instead of the full
+# Flywheel SDK objects returned by resolve.
+class FwContainerEntry:
+    __slots__ = ('id', 'label', 'type', 'modified')
+
+    def __init__(self, id, label, type, modified) -> None:
+        self.id = id
+        self.label = label
+        self.type = type
+        self.modified = modified
+
+
+class FwFileEntry:
+    __slots__ = ('id', 'name', 'size', 'type', 'mimetype', 'version', 'modified')
+
+    def __init__(self, id, name, size, type, mimetype, version, modified) -> None:
+        self.id = id
+        self.name = name
+        self.size = size
+        self.type = type
+        self.mimetype = mimetype
+        self.version = version
+        self.modified = modified
+
+
+class FwListing:
+    __slots__ = ('container_id', 'containers', 'files', 'nbytes', '_digest')
+
+    def __init__(self, container_id, containers, files, nbytes=0) -> None:
+        self.container_id = container_id
+        self.containers = containers
+        self.files = files
+        # Approximate memory footprint, used to bound the hierarchy cache
+        self.nbytes = nbytes
+        self._digest = None
+
+    # Hex digest of the ids, names, versions and modified times of the
+    # children, computed once per listing. Used to build ETags.
+    @property
+    def digest(self):
+        if self._digest is None:
+            h = hashlib.blake2b(str(self.container_id).encode(), digest_size=16)
+            for c in self.containers:
+                h.update(('\0c%s\0%s\0%s' % (c.id, c.label, c.modified)).encode())
+            for f in self.files:
+                h.update(('\0f%s\0%s\0%s\0%s\0%s' % (f.id, f.name, f.version, f.size, f.modified)).encode())
+            self._digest = h.hexdigest()
+        return self._digest
+
+    # Build the listing of a resolve() result in a single pass over its children
+    @classmethod
+    def from_resolve(cls, result):
+        containers = []
+        files = []
+        nbytes = 0
+        for child in result.children:
+            if hasattr(child, 'file_id'):
+                files.append(FwFileEntry(
+                    child.file_id, child.name, child.size, getattr(child, 'type', None),
+                    getattr(child, 'mimetype', None), child.version, child.modified))
+                nbytes += _FILE_ENTRY_BYTES + len(child.name)
+            elif getattr(child, 'label', None) is not None:
+                containers.append(FwContainerEntry(
+                    child.id, child.label, getattr(child, 'container_type', None), child.modified))
+                nbytes += _CONTAINER_ENTRY_BYTES + len(child.label)
+        container_id = result.path[-1].id if result.path else None
+        return cls(container_id, containers, files, nbytes)
+
+    def find_file(self, name):
+        for file_entry in self.files:
+            if file_entry.name == name:
+                return file_entry
+        return None
+
+
+# Local mirror of the Flywheel hierarchy, kept up to date by the fw_sync
+# management command (home.search_index.HierarchySync) and searched through the
+# home_fwindexnode_fts FTS5 table created in migration 0002.
+class FwIndexNode(models.Model):
+    fw_id = models.CharField(max_length=64)
+    parent = models.ForeignKey('self', null=True, on_delete=models.CASCADE, related_name='children')
+    type = models.CharField(max_length=16)
+    label = models.CharField(max_length=512)
+    path = models.TextField(unique=True)
+    size = models.BigIntegerField(null=True)
+    modified = models.DateTimeField(null=True)
+    # modified time of the container when its children were last synced
+    synced_modified = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['parent', 'label'])]
+
+    def __str__(self):
+        return self.path
+
+
+# Opaque token that lets the ImageJ iframe fetch one file without the session
+# cookie, see home.streaming.make_file_token. Only the random token leaves the
+# server; the session it stands for stays here.
+class FileToken(models.Model):
+    token = models.CharField(max_length=64, unique=True)
+    session_key = models.TextField()
+    path = models.TextField()
+    expires = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.path
+
+
+# Per-record overhead: the slotted object, its list slot, the modified datetime,
+# the str header and for files the size int
+_CONTAINER_ENTRY_BYTES = sys.getsizeof(FwContainerEntry(None, '', None, None)) + 8 + 48 + 49
+_FILE_ENTRY_BYTES = sys.getsizeof(FwFileEntry(None, '', 0, None, None, 0, None)) + 8 + 48 + 49 + 28
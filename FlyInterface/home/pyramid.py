@@ -0,0 +1,86 @@
+import math
+import os
+import shutil
+import uuid
+
+
+DZI_TEMPLATE = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="jpeg" '
+                'Overlap="{overlap}" TileSize="{tile_size}"><Size Width="{width}" Height="{height}"/></Image>\n')
+
+
+# Cut the first frame of source into a Deep Zoom pyramid under dest:
+#
+#   dest/image.dzi                 Deep Zoom descriptor
+#   dest/image_files/<level>/<col>_<row>.jpeg
+#   dest/thumbnail.jpeg
+#
+# Level max_level is the full resolution image, each level below halves it
+# down to a single pixel at level 0. Runs in a worker process of
+# home.tiles.TileCache, so it only depends on Pillow. Returns the bytes written.
+def build_pyramid(source, dest, tile_size=256, overlap=1, quality=85, thumbnail_size=256, max_pixels=None):
+    from PIL import Image
+
+    Image.MAX_IMAGE_PIXELS = max_pixels
+    tmp = '%s.tmp-%s' % (dest, uuid.uuid4().hex)
+    try:
+        with Image.open(source) as image:
+            image.seek(0)
+            image = _display_image(image)
+        width, height = image.size
+        max_level = math.ceil(math.log2(max(width, height, 1)))
+        thumbnail = None
+        nbytes = 0
+        for level in range(max_level, -1, -1):
+            if thumbnail is None and max(image.size) <= 2 * thumbnail_size:
+                thumbnail = image.copy()
+                thumbnail.thumbnail((thumbnail_size, thumbnail_size))
+            nbytes += _write_tiles(image, os.path.join(tmp, 'image_files', str(level)), tile_size, overlap, quality)
+            if level:
+                image = image.resize(((image.width + 1) // 2, (image.height + 1) // 2), Image.Resampling.BOX)
+        thumbnail_path = os.path.join(tmp, 'thumbnail.jpeg')
+        thumbnail.save(thumbnail_path, 'JPEG', quality=quality)
+        nbytes += os.path.getsize(thumbnail_path)
+        with open(os.path.join(tmp, 'image.dzi'), 'w') as f:
+            nbytes += f.write(DZI_TEMPLATE.format(overlap=overlap, tile_size=tile_size, width=width, height=height))
+        with open(os.path.join(tmp, '.size'), 'w') as f:
+            f.write(str(nbytes))
+        try:
+            os.rename(tmp, dest)
+        except OSError:
+            # Built meanwhile by another server process.
+            if not os.path.isdir(dest):
+                raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return nbytes
+
+
+# 8 bit grayscale or RGB version of image; high bit depth grayscale (16 bit
+# TIFF stacks, float images) is stretched over its value range.
+def _display_image(image):
+    if image.mode in ('L', 'RGB'):
+        return image.copy()
+    if image.mode.startswith('I') or image.mode == 'F':
+        image = image.convert('I').convert('F') if image.mode.startswith('I;16') else image.convert('F')
+        low, high = image.getextrema()
+        scale = 255.0 / (high - low) if high > low else 0.0
+        return image.point(lambda v: (v - low) * scale).convert('L')
+    if image.mode == '1':
+        return image.convert('L')
+    return image.convert('RGB')
+
+
+def _write_tiles(image, directory, tile_size, overlap, quality):
+    os.makedirs(directory)
+    nbytes = 0
+    for col in range(math.ceil(image.width / tile_size)):
+        left = max(col * tile_size - overlap, 0)
+        right = min((col + 1) * tile_size + overlap, image.width)
+        for row in range(math.ceil(image.height / tile_size)):
+            top = max(row * tile_size - overlap, 0)
+            bottom = min((row + 1) * tile_size + overlap, image.height)
+            path = os.path.join(directory, '%d_%d.jpeg' % (col, row))
+            image.crop((left, top, right, bottom)).save(path, 'JPEG', quality=quality)
+            nbytes += os.path.getsize(path)
+    return nbytes
@@ -0,0 +1,179 @@
+import re
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.db import transaction
+
+from .client_pool import client_pool
+from .models import FwIndexNode, FwListing
+
+
+# Mirrors a Flywheel subtree into FwIndexNode rows.
+#
+# Containers are resolved in parallel on a thread pool, one resolve per
+# container, while all database writes happen on the calling thread. A
+# container already in the index is only walked again when its Flywheel
+# modified time differs from the one recorded at its last sync (or with
+# full=True), so a sync after a few uploads touches a few subtrees only.
+class HierarchySync:
+    def __init__(self, api_key, workers=8, full=False) -> None:
+        self.api_key = api_key
+        self.workers = workers
+        self.full = full
+        self.walked = 0
+        self.skipped = 0
+        self.added = 0
+        self.updated = 0
+        self.removed = 0
+        self.errors = []
+
+    def run(self, root_path):
+        start = time.monotonic()
+        root_path = root_path.strip('/')
+        with ThreadPoolExecutor(self.workers, thread_name_prefix='fw-sync') as executor:
+            pending = {executor.submit(self._resolve, root_path): (None, root_path)}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node, path = pending.pop(future)
+                    try:
+                        container, listing = future.result()
+                    except Exception as e:
+                        # Left unsynced, the next run retries this subtree.
+                        self.errors.append((path, str(e)))
+                        continue
+                    if node is None:
+                        node = self._root_node(path, container)
+                    for child in self._apply(node, container.modified, listing):
+                        pending[executor.submit(self._resolve, child.path)] = (child, child.path)
+        return self.stats(time.monotonic() - start)
+
+    def stats(self, seconds=0.0):
+        return {
+            'walked': self.walked,
+            'skipped': self.skipped,
+            'added': self.added,
+            'updated': self.updated,
+            'removed': self.removed,
+            'errors': len(self.errors),
+            'seconds': seconds,
+        }
+
+    # Runs on the executor.
+    def _resolve(self, path):
+        with client_pool.client(self.api_key) as fw_client:
+            result = fw_client.resolve(path)
+        return result.path[-1], FwListing.from_resolve(result)
+
+    def _root_node(self, path, container):
+        node = FwIndexNode.objects.filter(path=path).first()
+        if node is None or node.fw_id != container.id:
+            FwIndexNode.objects.filter(path=path).delete()
+            node = FwIndexNode.objects.create(
+                fw_id=container.id, type=getattr(container, 'container_type', None) or 'group',
+                label=path.rsplit('/', 1)[-1], path=path, modified=container.modified)
+            self.added += 1
+        return node
+
+    # Bring the children of node in line with listing and return the child
+    # containers that need to be walked.
+    @transaction.atomic
+    def _apply(self, node, modified, listing):
+        self.walked += 1
+        existing = {child.label: child for child in node.children.all()}
+        prefix = node.path + '/'
+        stale = []
+        created = []
+        changed = []
+        to_walk = []
+
+        for entry in listing.containers:
+            child = existing.pop(entry.label, None)
+            if child is not None and (child.fw_id != entry.id or child.type == 'file'):
+                stale.append(child)
+                child = None
+            if child is None:
+                created.append(FwIndexNode(
+                    fw_id=entry.id, parent=node, type=entry.type or 'container', label=entry.label,
+                    path=prefix + entry.label, modified=entry.modified))
+            elif self.full or child.synced_modified != entry.modified:
+                child.modified = entry.modified
+                changed.append(child)
+                to_walk.append(child)
+            else:
+                self.skipped += 1
+
+        for entry in listing.files:
+            child = existing.pop(entry.name, None)
+            if child is not None and child.type != 'file':
+                stale.append(child)
+                child = None
+            if child is None:
+                created.append(FwIndexNode(
+                    fw_id=entry.id, parent=node, type='file', label=entry.name, path=prefix + entry.name,
+                    size=entry.size, modified=entry.modified))
+            elif (child.fw_id, child.size, child.modified) != (entry.id, entry.size, entry.modified):
+                child.fw_id, child.size, child.modified = entry.id, entry.size, entry.modified
+                changed.append(child)
+
+        stale += existing.values()
+        if stale:
+            # Containers take their whole subtree along.
+            FwIndexNode.objects.filter(id__in=[child.id for child in stale]).delete()
+            self.removed += len(stale)
+        FwIndexNode.objects.bulk_create(created)
+        FwIndexNode.objects.bulk_update(changed, ['fw_id', 'size', 'modified'])
+        self.added += len(created)
+        self.updated += len(changed)
+
+        node.modified = node.synced_modified = modified
+        node.save(update_fields=['modified', 'synced_modified'])
+        return to_walk + [child for child in created if child.type != 'file']
+
+
+# Labels of the groups the index holds nodes of under root_path.
+def index_groups(root_path=''):
+    root_path = root_path.strip('/')
+    if root_path:
+        return [root_path.split('/', 1)[0]]
+    roots = FwIndexNode.objects.filter(parent=None).values_list('path', flat=True)
+    return sorted({path.split('/', 1)[0] for path in roots})
+
+
+# Full-text search of the index: nodes under root_path whose label contains
+# words starting with every word of query, files and containers alike.
+#
+# The index is built with a single API key, so results can be limited to what
+# a caller sees: projects maps each group label the caller can resolve to the
+# labels of the projects visible to them, and nodes in other groups or other
+# projects are left out before the limit is applied.
+def search_index(query, root_path='', limit=None, projects=None):
+    terms = re.findall(r'\w+', query)
+    if not terms:
+        return []
+    match = ' '.join('"%s"*' % term for term in terms)
+    limit = limit or getattr(settings, 'FW_SEARCH_MAX_RESULTS', 200)
+    sql = ('SELECT n.* FROM home_fwindexnode_fts f JOIN home_fwindexnode n ON n.id = f.rowid '
+           'WHERE home_fwindexnode_fts MATCH %s')
+    params = [match]
+    root_path = root_path.strip('/')
+    if root_path:
+        # Everything strictly below root_path: '0' sorts right after '/'.
+        sql += ' AND n.path > %s AND n.path < %s'
+        params += [root_path + '/', root_path + '0']
+    if projects is not None:
+        scopes = []
+        for group, labels in sorted(projects.items()):
+            scopes.append('n.path = %s')
+            params.append(group)
+            for label in sorted(labels):
+                project = group + '/' + label
+                scopes.append('n.path = %s OR (n.path > %s AND n.path < %s)')
+                params += [project, project + '/', project + '0']
+        if not scopes:
+            return []
+        sql += ' AND (%s)' % ' OR '.join(scopes)
+    sql += ' ORDER BY n.path LIMIT %s'
+    params.append(limit)
+    return list(FwIndexNode.objects.raw(sql, params))
@@ -0,0 +1,180 @@
+import datetime
+import mimetypes
+import os
+import re
+import secrets
+from importlib import import_module
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.utils import timezone
+
+from .client_pool import client_pool
+from .executor import run_blocking
+from .models import FileToken
+
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+# Parse a single-range `Range: bytes=...` header into an inclusive (start, end).
+# Returns None when the whole file should be served; multi-range and
+# malformed headers are ignored, as RFC 7233 allows.
+def parse_range_header(header, size):
+    if not header:
+        return None
+    match = _RANGE_RE.match(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes.
+        length = int(last)
+        if length == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or end < start:
+        raise RangeNotSatisfiable()
+    return start, min(end, size - 1)
+
+
+def content_type_for(file_entry):
+    return (getattr(file_entry, 'mimetype', None)
+            or mimetypes.guess_type(file_entry.name)[0]
+            or 'application/octet-stream')
+
+
+# Random, short lived token that lets the ImageJ iframe fetch one file without
+# the session cookie (the iframe origin is not ours, so the cookie is not sent).
+# The token ends up in a third-party URL, so it carries nothing but its random
+# id; the session and path it grants are kept in the FileToken table.
+def make_file_token(request, file_path):
+    if request.session.session_key is None:
+        request.session.save()
+    now = timezone.now()
+    FileToken.objects.filter(expires__lte=now).delete()
+    token = secrets.token_urlsafe(32)
+    FileToken.objects.create(
+        token=token, session_key=request.session.session_key, path=file_path,
+        expires=now + datetime.timedelta(seconds=getattr(settings, 'FW_FILE_TOKEN_MAX_AGE', 3600)))
+    return token
+
+
+# API key of the request, from the session or from a file token for file_path
+def api_key_for_file(request, file_path):
+    if 'api_key' in request.session:
+        return request.session['api_key']
+    token = request.GET.get('token')
+    if not token:
+        return None
+    file_token = FileToken.objects.filter(token=token, path=file_path, expires__gt=timezone.now()).first()
+    if file_token is None:
+        return None
+    session = import_module(settings.SESSION_ENGINE).SessionStore(session_key=file_token.session_key)
+    return session.get('api_key')
+
+
+# Bytes [start, end] of a local file, given by path or as a binary file
+# object that is closed at the end, read in chunks.
+def iter_file_range(source, byte_range=None, chunk_size=None):
+    chunk_size = chunk_size or getattr(settings, 'FW_STREAM_CHUNK_SIZE', 256 * 1024)
+    with (open(source, 'rb') if isinstance(source, (str, bytes, os.PathLike)) else source) as f:
+        if byte_range is None:
+            remaining = None
+        else:
+            f.seek(byte_range[0])
+            remaining = byte_range[1] - byte_range[0] + 1
+        while remaining is None or remaining > 0:
+            chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+
+# Iterable over the bytes of a Flywheel file, read from the API as they arrive.
+#
+# The Flywheel client stays checked out of the pool until the stream is closed
+# so its HTTP connection is not shared with another request mid-transfer.
+# With a cache_writer the bytes are also written to the download cache, and
+# the entry is committed only if the whole file went through.
+class FlywheelFileStream:
+    def __init__(self, api_key, container_id, file_name, byte_range=None, chunk_size=None,
+                 cache_writer=None) -> None:
+        self.chunk_size = chunk_size or getattr(settings, 'FW_STREAM_CHUNK_SIZE', 256 * 1024)
+        self._cache_writer = cache_writer
+        self._api_key = api_key
+        self._response = None
+        self._client = None
+        kwargs = {'view': True, '_return_http_data_only': True, '_preload_content': False}
+        if byte_range is not None:
+            kwargs['range'] = 'bytes=%d-%d' % byte_range
+        try:
+            self._client = client_pool.checkout(api_key)
+            self._response = self._client.containers_api.download_file_from_container_with_http_info(
+                container_id, file_name, **kwargs)
+        except Exception:
+            self.close()
+            raise
+
+    def __iter__(self):
+        for chunk in self._response.iter_content(self.chunk_size):
+            if chunk:
+                if self._cache_writer is not None:
+                    self._cache_writer.write(chunk)
+                yield chunk
+        if self._cache_writer is not None:
+            writer, self._cache_writer = self._cache_writer, None
+            writer.commit()
+
+    def close(self):
+        if self._cache_writer is not None:
+            self._cache_writer.abort()
+            self._cache_writer = None
+        if self._response is not None:
+            self._response.close()
+            self._response = None
+        self._release()
+
+    def _release(self):
+        if self._client is not None:
+            client_pool.checkin(self._api_key, self._client)
+            self._client = None
+
+
+# Async iterator advancing a blocking iterable on the Flywheel executor.
+class AsyncStream:
+    def __init__(self, iterable) -> None:
+        self._iterable = iterable
+        self._iterator = iter(iterable)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await run_blocking(next, self._iterator, None)
+        if chunk is None:
+            raise StopAsyncIteration
+        return chunk
+
+    def close(self):
+        close = getattr(self._iterable, 'close', None)
+        if close is not None:
+            close()
+
+
+# Streaming body suited to the server the request came through. Under ASGI
+# Django would collect a synchronous iterator in full before sending it.
+def streaming_body(request, iterable):
+    if isinstance(request, ASGIRequest):
+        return AsyncStream(iterable)
+    return iterable
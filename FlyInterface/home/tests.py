@@ -1,3 +1,711 @@
-from django.test import TestCase
+import datetime
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import Future
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from benchmarks.fake_flywheel import FakeHierarchy, client_factory
+
+from . import views
+from .cache import TTLCache, hierarchy_cache, user_cache
+from .client_pool import client_pool
+from .download_cache import DownloadCache
+from .export import ERRORS_NAME, ExportEntry, iter_zip_export
+from .instrumentation import exposition
+from .models import FileToken, FwContainerEntry, FwContextInfo, FwFileEntry, FwIndexNode, FwListing
+from .search_index import HierarchySync, index_groups, search_index
+from .streaming import RangeNotSatisfiable, iter_file_range, parse_range_header
+from .tiles import ThumbnailQueue, TileCache
+
+MODIFIED = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+# Base of the view tests: Flywheel is replaced by the fake of the benchmarks
+# (benchmarks.fake_flywheel) and the download cache by a temporary one.
+@override_settings(SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+class FakeFlywheelTestCase(TestCase):
+    ACQUISITION = 'wandell/project_0/subject_0/session_0/acquisition_0'
+
+    def setUp(self):
+        self.hierarchy = FakeHierarchy(fanout=(1, 1, 1, 1), files_per_container=2, file_size=1000, latency=0)
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, True)
+        for patcher in (mock.patch.object(client_pool, 'factory', client_factory(self.hierarchy)),
+                        mock.patch.object(views, 'download_cache', DownloadCache(root))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for clear in (client_pool.clear, hierarchy_cache.clear, user_cache.clear):
+            clear()
+            self.addCleanup(clear)
+        self.client.post('/home/', {'api_key': 'test-key'})
+
+    def body(self, response):
+        return b''.join(response.streaming_content) if response.streaming else response.content
+
+
+class FakeBackendTests(FakeFlywheelTestCase):
+    def test_pages_of_the_fake_hierarchy(self):
+        for url in ('/home/projects/wandell', '/home/projects/' + self.ACQUISITION,
+                    '/home/viewer/%s/file_0.tif' % self.ACQUISITION):
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url).status_code, 200)
+        # One pooled client serves every request.
+        self.assertEqual(self.hierarchy.calls['client'], 1)
+
+
+class TTLCacheTests(SimpleTestCase):
+    def test_entries_expire(self):
+        cache = TTLCache(ttl=10)
+        with mock.patch('home.cache.time.monotonic', return_value=100.0):
+            cache.set('a', 1)
+        with mock.patch('home.cache.time.monotonic', return_value=109.0):
+            self.assertEqual(cache.get('a'), 1)
+        with mock.patch('home.cache.time.monotonic', return_value=110.0):
+            self.assertIsNone(cache.get('a'))
+            self.assertEqual(cache.get('a', 'default'), 'default')
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['expirations'], stats['entries']), (1, 2, 1, 0))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = TTLCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_byte_bound(self):
+        cache = TTLCache(max_bytes=100, sizeof=len)
+        cache.set('a', 'x' * 60)
+        cache.set('b', 'y' * 60)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['bytes'], 60)
+        # Values larger than the whole cache are not stored at all.
+        cache.set('c', 'z' * 200)
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual(cache.get('b'), 'y' * 60)
+
+    def test_invalidate_matching(self):
+        cache = TTLCache()
+        for key in (('u1', 'a'), ('u1', 'b'), ('u2', 'a')):
+            cache.set(key, key)
+        cache.invalidate_matching(lambda key: key[0] == 'u1')
+        self.assertEqual(cache.stats()['entries'], 1)
+        self.assertEqual(cache.get(('u2', 'a')), ('u2', 'a'))
+
+
+class HierarchyCacheTests(FakeFlywheelTestCase):
+    def test_listing_resolves_once(self):
+        url = '/home/projects/' + self.ACQUISITION
+        self.client.get(url)
+        self.client.get(url)
+        self.assertEqual(self.hierarchy.calls['resolve'], 1)
+        self.assertEqual(self.hierarchy.calls['get_current_user'], 1)
+        self.client.get(url + '?refresh')
+        self.assertEqual(self.hierarchy.calls['resolve'], 2)
+
+
+class ParseRangeHeaderTests(SimpleTestCase):
+    def test_no_header_serves_whole_file(self):
+        self.assertIsNone(parse_range_header(None, 100))
+        self.assertIsNone(parse_range_header('', 100))
+
+    def test_closed_and_open_ranges(self):
+        self.assertEqual(parse_range_header('bytes=0-9', 100), (0, 9))
+        self.assertEqual(parse_range_header('bytes=90-', 100), (90, 99))
+        self.assertEqual(parse_range_header(' bytes=10-20 ', 100), (10, 20))
+
+    def test_end_is_clamped_to_file(self):
+        self.assertEqual(parse_range_header('bytes=50-500', 100), (50, 99))
+
+    def test_suffix_range(self):
+        self.assertEqual(parse_range_header('bytes=-10', 100), (90, 99))
+        self.assertEqual(parse_range_header('bytes=-500', 100), (0, 99))
+
+    def test_malformed_and_multi_range_are_ignored(self):
+        for header in ('bytes=-', 'items=0-9', 'bytes=0-9,20-29', 'bytes=a-b', '0-9'):
+            with self.subTest(header=header):
+                self.assertIsNone(parse_range_header(header, 100))
+
+    def test_unsatisfiable(self):
+        for header in ('bytes=100-', 'bytes=200-300', 'bytes=20-10', 'bytes=-0'):
+            with self.subTest(header=header):
+                with self.assertRaises(RangeNotSatisfiable):
+                    parse_range_header(header, 100)
+
+
+class IterFileRangeTests(SimpleTestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(bytes(range(256)))
+        self.addCleanup(os.remove, self.path)
+
+    def test_whole_file_in_chunks(self):
+        chunks = list(iter_file_range(self.path, chunk_size=100))
+        self.assertEqual([len(c) for c in chunks], [100, 100, 56])
+        self.assertEqual(b''.join(chunks), bytes(range(256)))
+
+    def test_range_of_open_file_closes_it(self):
+        f = open(self.path, 'rb')
+        self.assertEqual(b''.join(iter_file_range(f, (10, 19), chunk_size=3)), bytes(range(10, 20)))
+        self.assertTrue(f.closed)
+
+
+class FileProxyTests(FakeFlywheelTestCase):
+    def url(self, name='file_0.tif'):
+        return '/home/files/%s/%s' % (self.ACQUISITION, name)
+
+    def test_whole_file(self):
+        response = self.client.get(self.url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], '1000')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(len(self.body(response)), 1000)
+
+    def test_range(self):
+        response = self.client.get(self.url(), HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 100-199/1000')
+        self.assertEqual(len(self.body(response)), 100)
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get(self.url(), HTTP_RANGE='bytes=5000-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */1000')
+
+    def test_unknown_file(self):
+        self.assertEqual(self.client.get(self.url('missing.tif')).status_code, 404)
+
+    def test_needs_a_session(self):
+        self.client.cookies.clear()
+        self.assertEqual(self.client.get(self.url()).status_code, 403)
+
+    def test_file_token(self):
+        file_url = self.client.get('/home/viewer/%s/file_0.tif' % self.ACQUISITION).context['file_url']
+        token = file_url.split('?token=')[1]
+        # The token leaves the site in the ImageJ URL, it must not carry the session.
+        self.assertNotIn(self.client.session.session_key, token)
+        self.client.cookies.clear()
+        self.assertEqual(self.client.get(file_url).status_code, 200)
+        self.assertEqual(self.client.get(self.url('file_1.tif'), {'token': token}).status_code, 403)
+        self.assertEqual(self.client.get(self.url(), {'token': token + 'x'}).status_code, 403)
+        FileToken.objects.update(expires=MODIFIED)
+        self.assertEqual(self.client.get(file_url).status_code, 403)
+
+
+class DownloadCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+
+    def put(self, cache, key, data):
+        writer = cache.open_writer(key, '.tif')
+        writer.write(data)
+        return writer.commit()
+
+    def test_concurrent_fetches_share_one_download(self):
+        cache = DownloadCache(self.root)
+        release = threading.Event()
+        downloads = []
+
+        def download(writer):
+            downloads.append(threading.current_thread().name)
+            release.wait(5)
+            writer.write(b'data')
+
+        paths = []
+        threads = [threading.Thread(target=lambda: paths.append(cache.fetch(('f', 1), download, '.tif')))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(downloads), 1)
+        self.assertEqual(len(set(paths)), 1)
+        with open(paths[0], 'rb') as f:
+            self.assertEqual(f.read(), b'data')
+        self.assertEqual(cache.stats()['bytes_downloaded'], 4)
+
+    def test_failed_download_is_not_cached(self):
+        cache = DownloadCache(self.root)
+
+        def download(writer):
+            writer.write(b'partial')
+            raise OSError('connection reset')
+
+        with self.assertRaises(OSError):
+            cache.fetch(('f', 1), download)
+        self.assertFalse(cache.contains(('f', 1)))
+        self.assertEqual(os.listdir(os.path.join(self.root, '.tmp')), [])
+        # The key is free again for the next attempt.
+        self.assertIsNotNone(cache.open_writer(('f', 1)))
+
+    def test_least_recently_used_file_is_evicted(self):
+        cache = DownloadCache(self.root, max_bytes=10)
+        a = self.put(cache, ('a', 1), b'1234')
+        b = self.put(cache, ('b', 1), b'1234')
+        self.assertEqual(cache.lookup(('a', 1)), a)
+        self.put(cache, ('c', 1), b'1234')
+        self.assertFalse(cache.contains(('b', 1)))
+        self.assertFalse(os.path.exists(b))
+        self.assertTrue(cache.contains(('a', 1)))
+        stats = cache.stats()
+        self.assertEqual((stats['entries'], stats['bytes'], stats['evictions']), (2, 8, 1))
+
+    def test_open_file_survives_eviction(self):
+        cache = DownloadCache(self.root, max_bytes=10)
+        self.put(cache, ('a', 1), b'12345678')
+        f = cache.open(('a', 1))
+        self.put(cache, ('b', 1), b'12345678')
+        self.assertFalse(cache.contains(('a', 1)))
+        with f:
+            self.assertEqual(f.read(), b'12345678')
+        self.assertIsNone(cache.open(('a', 1)))
+
+    def test_files_of_a_previous_run_are_indexed(self):
+        path = self.put(DownloadCache(self.root), ('abc', 3), b'1234')
+        cache = DownloadCache(self.root)
+        self.assertEqual(cache.lookup(('abc', 3)), path)
+        self.assertEqual(cache.stats()['bytes'], 4)
+
+
+class CachedFileProxyTests(FakeFlywheelTestCase):
+    def test_repeat_downloads_are_served_from_the_cache(self):
+        url = '/home/files/%s/file_0.tif' % self.ACQUISITION
+        self.assertEqual(len(self.body(self.client.get(url))), 1000)
+        self.assertEqual(len(self.body(self.client.get(url))), 1000)
+        self.assertEqual(self.hierarchy.calls['download'], 1)
+        # Ranges of a cached file are read from disk too.
+        self.assertEqual(len(self.body(self.client.get(url, HTTP_RANGE='bytes=0-9'))), 10)
+        self.assertEqual(self.hierarchy.calls['download'], 1)
+
+
+def _listing(n_containers, n_files):
+    containers = [FwContainerEntry('c%d' % i, 'container_%d' % i, 'session', MODIFIED)
+                  for i in range(n_containers)]
+    files = [FwFileEntry('f%d' % i, 'file_%d.tif' % i, 1024, 'image', 'image/tiff', 1, MODIFIED)
+             for i in range(n_files)]
+    return FwListing('parent', containers, files)
+
+
+class PageFWChildrenTests(SimpleTestCase):
+    def page(self, listing, offset, limit):
+        info = FwContextInfo()
+        views.pageFWChildren(info, listing, offset, limit)
+        return info
+
+    def test_containers_come_before_files(self):
+        listing = _listing(3, 5)
+        pages = [self.page(listing, offset, 3) for offset in (0, 3, 6)]
+        self.assertEqual([c.label for c in pages[0].projects], ['container_0', 'container_1', 'container_2'])
+        self.assertEqual(pages[0].files, [])
+        self.assertEqual(pages[1].projects, [])
+        self.assertEqual([f.name for f in pages[1].files], ['file_0.tif', 'file_1.tif', 'file_2.tif'])
+        self.assertEqual([f.name for f in pages[2].files], ['file_3.tif', 'file_4.tif'])
+        self.assertEqual([p.next_offset for p in pages], [3, 6, None])
+        self.assertEqual((pages[0].total_projects, pages[0].total_files), (3, 5))
+
+    def test_page_across_the_boundary(self):
+        info = self.page(_listing(3, 5), 2, 3)
+        self.assertEqual([c.label for c in info.projects], ['container_2'])
+        self.assertEqual([f.name for f in info.files], ['file_0.tif', 'file_1.tif'])
+        self.assertEqual(info.next_offset, 5)
+
+    @override_settings(FW_LISTING_PAGE_SIZE=4)
+    def test_default_page_size(self):
+        info = self.page(_listing(0, 10), 0, None)
+        self.assertEqual(len(info.files), 4)
+        self.assertEqual(info.next_offset, 4)
+
+
+class ChildrenPageTests(FakeFlywheelTestCase):
+    def test_pages_of_files(self):
+        url = '/home/api/children/' + self.ACQUISITION
+        page = self.client.get(url, {'limit': 1}).json()
+        self.assertEqual([f['name'] for f in page['files']], ['file_0.tif'])
+        self.assertEqual((page['total_files'], page['next_offset']), (2, 1))
+        page = self.client.get(url, {'offset': 1, 'limit': 1}).json()
+        self.assertEqual([f['name'] for f in page['files']], ['file_1.tif'])
+        self.assertIsNone(page['next_offset'])
+
+
+class ExpositionTests(SimpleTestCase):
+    def test_counters_and_gauges(self):
+        text = exposition({'download_jobs': {'queued': 3, 'completed': 5, 'wait_seconds_total': 1.5,
+                                             'paused': True}})
+        self.assertIn('# TYPE flyinterface_download_jobs_queued gauge\nflyinterface_download_jobs_queued 3\n', text)
+        self.assertIn('# TYPE flyinterface_download_jobs_completed_total counter\n'
+                      'flyinterface_download_jobs_completed_total 5\n', text)
+        self.assertIn('# TYPE flyinterface_download_jobs_wait_seconds_total counter\n', text)
+        self.assertNotIn('paused', text)
+
+
+class MonitoringAccessTests(TestCase):
+    def test_loopback_is_allowed(self):
+        self.assertEqual(self.client.get('/home/stats/').status_code, 200)
+        self.assertEqual(self.client.get('/home/metrics/').status_code, 200)
+
+    @override_settings(FW_MONITORING_TOKEN='secret')
+    def test_other_addresses_need_the_token(self):
+        for url in ('/home/stats/', '/home/metrics/'):
+            with self.assertLogs('django.request', 'WARNING'):
+                self.assertEqual(self.client.get(url, REMOTE_ADDR='203.0.113.5').status_code, 403)
+            with self.assertLogs('django.request', 'WARNING'):
+                response = self.client.get(url, REMOTE_ADDR='203.0.113.5', HTTP_AUTHORIZATION='Bearer wrong')
+            self.assertEqual(response.status_code, 403)
+            response = self.client.get(url, REMOTE_ADDR='203.0.113.5', HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, 200)
+
+    @override_settings(FW_MONITORING_ALLOWED_NETWORKS=('10.0.0.0/8',))
+    def test_allowed_networks_and_staff(self):
+        self.assertEqual(self.client.get('/home/stats/', REMOTE_ADDR='10.1.2.3').status_code, 200)
+        with self.assertLogs('django.request', 'WARNING'):
+            self.assertEqual(self.client.get('/home/stats/').status_code, 403)
+        self.client.force_login(User.objects.create(username='admin', is_staff=True))
+        self.assertEqual(self.client.get('/home/stats/').status_code, 200)
+
+
+class SearchIndexTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        paths = ['wandell', 'wandell/retina', 'wandell/retina/scan_1.tif', 'wandell/retina2',
+                 'wandell/retina2/scan_2.tif', 'wandell/cortex', 'wandell/cortex/scan_3.tif', 'other',
+                 'other/retina', 'other/retina/scan_4.tif']
+        nodes = {}
+        for path in paths:
+            parent, _, label = path.rpartition('/')
+            nodes[path] = FwIndexNode.objects.create(
+                fw_id=path, parent=nodes.get(parent), type='file' if label.endswith('.tif') else 'container',
+                label=label, path=path)
+
+    def paths(self, nodes):
+        return [node.path for node in nodes]
+
+    def test_prefix_match_of_every_word(self):
+        self.assertEqual(self.paths(search_index('scan')), [
+            'other/retina/scan_4.tif', 'wandell/cortex/scan_3.tif', 'wandell/retina/scan_1.tif',
+            'wandell/retina2/scan_2.tif'])
+        self.assertEqual(self.paths(search_index('ret')), ['other/retina', 'wandell/retina', 'wandell/retina2'])
+        self.assertEqual(search_index('!!'), [])
+
+    def test_root_path_scoping(self):
+        # wandell/retina2 shares the prefix of wandell/retina but is not below it.
+        self.assertEqual(self.paths(search_index('scan', 'wandell/retina')), ['wandell/retina/scan_1.tif'])
+        self.assertEqual(self.paths(search_index('retina', '/wandell/')), ['wandell/retina', 'wandell/retina2'])
+
+    def test_limit(self):
+        self.assertEqual(len(search_index('scan', limit=2)), 2)
+
+    def test_project_scoping(self):
+        projects = {'wandell': {'retina'}}
+        self.assertEqual(self.paths(search_index('scan', projects=projects)), ['wandell/retina/scan_1.tif'])
+        self.assertEqual(self.paths(search_index('retina', projects=projects)), ['wandell/retina'])
+        self.assertEqual(self.paths(search_index('wandell', projects=projects)), ['wandell'])
+        self.assertEqual(search_index('scan', projects={}), [])
+        # Hidden nodes sorting first do not use up the limit.
+        self.assertEqual(self.paths(search_index('scan', limit=1, projects={'wandell': {'retina2'}})),
+                         ['wandell/retina2/scan_2.tif'])
+
+    def test_index_groups(self):
+        self.assertEqual(index_groups(), ['other', 'wandell'])
+        self.assertEqual(index_groups('/wandell/retina'), ['wandell'])
+
+
+class HierarchySyncTests(TestCase):
+    def setUp(self):
+        hierarchy = FakeHierarchy(fanout=(2, 1, 1, 1), files_per_container=2, latency=0)
+        patcher = mock.patch.object(client_pool, 'factory', client_factory(hierarchy))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(client_pool.clear)
+
+    def test_sync_mirrors_the_hierarchy(self):
+        stats = HierarchySync('key', workers=2).run('wandell')
+        self.assertEqual(stats['errors'], 0)
+        # the group, and under each of its 2 projects a subject, session and
+        # acquisition holding 2 files
+        self.assertEqual(FwIndexNode.objects.count(), 1 + 2 * 6)
+        self.assertEqual(len(search_index('file_1', 'wandell/project_1')), 1)
+
+        stats = HierarchySync('key', workers=2).run('wandell')
+        self.assertEqual((stats['added'], stats['removed'], stats['walked']), (0, 0, 1))
+
+
+class SearchViewTests(FakeFlywheelTestCase):
+    def test_results_are_scoped_to_visible_projects(self):
+        for path in ('wandell', 'wandell/project_0', 'wandell/hidden', 'other'):
+            parent, _, label = path.rpartition('/')
+            FwIndexNode.objects.create(fw_id=path, parent=FwIndexNode.objects.filter(path=parent).first(),
+                                       type='container', label=label, path=path)
+        response = self.client.get('/home/search/', {'q': 'project_0'})
+        self.assertEqual([r['node'].path for r in response.context['results']], ['wandell/project_0'])
+        response = self.client.get('/home/search/', {'q': 'hidden'})
+        self.assertEqual(response.context['results'], [])
+        response = self.client.get('/home/search/', {'q': 'other'})
+        self.assertEqual(response.context['results'], [])
+
+
+class PinnedDownloadTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+        self.cache = DownloadCache(self.root, max_bytes=10)
+        writer = self.cache.open_writer(('a', 1), '.tif')
+        writer.write(b'12345678')
+        writer.commit()
+
+    def test_pin_survives_eviction(self):
+        pinned = self.cache.pin(('a', 1))
+        writer = self.cache.open_writer(('b', 1), '.tif')
+        writer.write(b'12345678')
+        writer.commit()
+        self.assertFalse(self.cache.contains(('a', 1)))
+        with open(pinned, 'rb') as f:
+            self.assertEqual(f.read(), b'12345678')
+        self.cache.unpin(pinned)
+        self.assertFalse(os.path.exists(pinned))
+        self.assertIsNone(self.cache.pin(('a', 1)))
+
+    def test_pins_of_a_previous_run_are_removed(self):
+        pinned = self.cache.pin(('a', 1))
+        DownloadCache(self.root)
+        self.assertFalse(os.path.exists(pinned))
+
+
+class TileCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+
+    def test_missing_source_is_not_marked_failed(self):
+        cache = TileCache(self.root, workers=1)
+        release = mock.Mock()
+        future = cache.build(('f', 1), os.path.join(self.root, 'missing.png'), release=release)
+        with self.assertRaises(FileNotFoundError):
+            future.result(60)
+        release.assert_called_once_with()
+        self.assertFalse(cache.failed(('f', 1)))
+        self.assertEqual(cache.stats()['building'], 0)
+
+
+class ThumbnailTests(FakeFlywheelTestCase):
+    def test_unbuilt_thumbnail_is_queued(self):
+        url = '/home/thumbnails/%s/file_0.tif?v=1' % self.ACQUISITION
+        with mock.patch.object(views.tile_cache, 'lookup', return_value=None), \
+                mock.patch.object(views.thumbnail_queue, 'submit') as submit, \
+                mock.patch.object(views.download_jobs, 'submit') as download_submit, \
+                self.assertLogs('django.request', 'ERROR'):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('no-store', response['Cache-Control'])
+        self.assertEqual(submit.call_count, 1)
+        self.assertEqual(download_submit.call_count, 0)
+
+    def test_queue_builds_without_download_cache(self):
+        sources = []
+
+        def build(key, source, release=None):
+            with open(source, 'rb') as f:
+                sources.append(f.read())
+            release()
+            future = Future()
+            future.set_result('pyramid')
+            return future
+
+        spool = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool, True)
+        queue = ThumbnailQueue(workers=1, spool_dir=spool)
+        tile_cache = mock.Mock(contains=mock.Mock(return_value=False), failed=mock.Mock(return_value=False),
+                               build=mock.Mock(side_effect=build))
+        url = '/home/thumbnails/%s/file_0.tif?v=1' % self.ACQUISITION
+        with mock.patch.object(views.tile_cache, 'lookup', return_value=None), \
+                mock.patch.object(views, 'thumbnail_queue', queue), \
+                mock.patch('home.tiles.tile_cache', tile_cache), \
+                self.assertLogs('django.request', 'ERROR'):
+            self.client.get(url)
+            for _ in range(500):
+                if queue.stats()['built']:
+                    break
+                time.sleep(0.01)
+        self.assertEqual(queue.stats()['built'], 1)
+        self.assertEqual(len(sources), 1)
+        self.assertEqual(len(sources[0]), 1000)
+        self.assertEqual(os.listdir(spool), [])
+        self.assertEqual(views.download_cache.stats()['entries'], 0)
+
+    def test_queue_serves_newest_and_drops_oldest(self):
+        queue = ThumbnailQueue(workers=0, max_queue=2)
+        for key in ('a', 'b', 'b', 'c'):
+            queue.submit(key, 'key', 'container', key + '.tif')
+        self.assertEqual([job[0] for job in queue._pending], ['b', 'c'])
+        self.assertEqual(queue.stats()['dropped'], 1)
+        self.assertEqual(queue.stats()['submitted'], 3)
+
+
+class ExportFileTests(SimpleTestCase):
+    def read(self, size):
+        entry = FwFileEntry('f', 'file.tif', size, None, None, 1, MODIFIED)
+        stream = mock.MagicMock()
+        stream.__iter__.return_value = [b'x' * (size - 3), b'abc']
+        with mock.patch.object(views, 'FlywheelFileStream', return_value=stream) as stream_class, \
+                mock.patch.object(views, 'download_cache') as cache:
+            f = views.readFWExportFile('key', 'container', entry)
+        stream_class.assert_called_once_with('key', 'container', 'file.tif')
+        stream.close.assert_called_once_with()
+        self.assertEqual(cache.mock_calls, [])
+        self.addCleanup(f.close)
+        self.assertEqual(f.read(), b'x' * (size - 3) + b'abc')
+        return f
+
+    @override_settings(FW_EXPORT_BUFFER_MAX_BYTES=1024)
+    def test_small_files_stay_in_memory(self):
+        self.assertFalse(self.read(100)._rolled)
+
+    @override_settings(FW_EXPORT_BUFFER_MAX_BYTES=10)
+    def test_large_files_are_spooled_to_disk(self):
+        self.assertTrue(self.read(100)._rolled)
+
+
+def _entry(name, size, fetch=None, stream=None):
+    return ExportEntry(name, size, MODIFIED, fetch or (lambda: io.BytesIO(b'x' * size)),
+                       stream or (lambda: iter([b'y' * size])))
+
+
+class IterZipExportTests(SimpleTestCase):
+    def archive(self, entries, **kwargs):
+        return zipfile.ZipFile(io.BytesIO(b''.join(iter_zip_export(entries, **kwargs))))
+
+    def test_fetches_stay_within_the_byte_budget(self):
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def fetch(size):
+            def fetch():
+                with lock:
+                    running.append(size)
+                    peak.append(sum(running))
+                threading.Event().wait(0.01)
+                with lock:
+                    running.remove(size)
+                return io.BytesIO(b'x' * size)
+            return fetch
+
+        entries = [_entry('f%d' % i, 40, fetch(40)) for i in range(6)] + [_entry('big', 500)]
+        archive = self.archive(entries, workers=4, max_fetch_bytes=100)
+        self.assertLessEqual(max(peak), 80)
+        self.assertGreater(max(peak), 40)
+        # Over the budget on its own, streamed at the end.
+        self.assertEqual(archive.namelist()[-1], 'big')
+        self.assertEqual(archive.read('big'), b'y' * 500)
+        self.assertEqual(len(archive.namelist()), 7)
+
+    def test_failures_are_listed(self):
+        def fail():
+            raise OSError('gone')
+
+        def broken_stream():
+            yield b'y' * 10
+            raise OSError('reset')
+
+        entries = [_entry('ok', 10), _entry('missing', 10, fail), _entry('big', 30, stream=broken_stream),
+                   _entry('unreachable', 30, stream=fail)]
+        archive = self.archive(entries, workers=2, max_fetch_bytes=20)
+        self.assertEqual(archive.read('ok'), b'x' * 10)
+        errors = archive.read(ERRORS_NAME).decode().splitlines()
+        self.assertEqual(errors, ['missing: gone', 'big: truncated after 10 of 30 bytes: reset',
+                                  'unreachable: gone'])
+        self.assertNotIn('unreachable', archive.namelist())
+
+
+class ExportViewTests(FakeFlywheelTestCase):
+    def test_archive_of_a_subtree(self):
+        response = self.client.get('/home/export/wandell/project_0')
+        self.assertEqual(response.status_code, 200)
+        archive = zipfile.ZipFile(io.BytesIO(self.body(response)))
+        prefix = 'project_0/subject_0/session_0/acquisition_0/'
+        self.assertEqual(sorted(archive.namelist()), [prefix + 'file_0.tif', prefix + 'file_1.tif'])
+        self.assertEqual(archive.read(prefix + 'file_1.tif'), bytes(1000))
+        self.assertEqual(views.download_cache.stats()['entries'], 0)
+
+    @override_settings(FW_EXPORT_MAX_FILES=1)
+    def test_file_limit(self):
+        self.assertEqual(self.client.get('/home/export/wandell').status_code, 413)
+
+
+class ConditionalRequestTests(FakeFlywheelTestCase):
+    def test_digest_follows_file_versions(self):
+        listing = _listing(1, 2)
+        changed = _listing(1, 2)
+        changed.files[1].version = 2
+        self.assertEqual(listing.digest, _listing(1, 2).digest)
+        self.assertNotEqual(listing.digest, changed.digest)
+
+    def test_listing_not_modified(self):
+        url = '/home/projects/' + self.ACQUISITION
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertIn('no-cache', response['Cache-Control'])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+
+        url = '/home/api/children/' + self.ACQUISITION
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_listing_etag_follows_thumbnails(self):
+        url = '/home/projects/' + self.ACQUISITION
+        etag = self.client.get(url)['ETag']
+        with mock.patch.object(views.tile_cache, 'contains', return_value=True):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        with mock.patch.object(views.tile_cache, 'failed', return_value=True):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(b'/home/thumbnails/', response.content)
+
+    def test_file_not_modified(self):
+        url = '/home/files/%s/file_0.tif' % self.ACQUISITION
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.body(response)), 1000)
+        etag = response['ETag']
+        downloads = self.hierarchy.calls['download']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.hierarchy.calls['download'], downloads)
+
+    def test_if_range(self):
+        url = '/home/files/%s/file_1.tif' % self.ACQUISITION
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.body(response)
+
+        response = self.client.get(url, HTTP_RANGE='bytes=100-199', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(len(self.body(response)), 100)
+
+        # A stale validator gets the whole current file.
+        response = self.client.get(url, HTTP_RANGE='bytes=100-199', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.body(response)), 1000)
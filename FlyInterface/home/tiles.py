@@ -0,0 +1,311 @@
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from django.conf import settings
+
+from .cache import TTLCache
+from .download_cache import download_cache
+from .pyramid import build_pyramid
+from .streaming import FlywheelFileStream
+
+_ENTRY_RE = re.compile(r'^(?P<file_id>[^/]+)-v(?P<version>\d+)$')
+
+
+# Bounded on-disk cache of Deep Zoom pyramids keyed by (file id, version).
+#
+# Pyramids are built by home.pyramid.build_pyramid in a pool of worker
+# processes, one build per key at a time however many requests ask for it.
+# Whole pyramids are evicted least recently used first once the cache grows
+# past max_bytes. Keys whose build failed (unreadable or oversized images) are
+# remembered for a while so thumbnails of such files are not retried on every
+# listing.
+class TileCache:
+    def __init__(self, root, max_bytes=5 * 1024 ** 3, workers=2, tile_size=256, max_pixels=1 << 30) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.tile_size = tile_size
+        self.max_pixels = max_pixels
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (directory, size)
+        self._building = {}  # key -> Future of the directory
+        self._failed = TTLCache(max_entries=1024, ttl=600)
+        self._executor = None
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.builds = 0
+        self.build_failures = 0
+        self.build_seconds = 0.0
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    def path_for(self, key):
+        return os.path.join(self.root, '%s-v%d' % key)
+
+    # Whether the pyramid of key is built, without counting a lookup.
+    def contains(self, key):
+        with self._lock:
+            return key in self._entries
+
+    # Pyramid directory of key if it is built, marking it recently used.
+    def lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def failed(self, key):
+        return self._failed.get(key) is not None
+
+    # Future of the pyramid directory of key, built from the image at source
+    # unless it is built or being built already. release, if given, is called
+    # once source is no longer needed.
+    def build(self, key, source, release=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            future = self._building.get(key)
+            if entry is not None:
+                future = Future()
+                future.set_result(entry[0])
+            if future is not None:
+                if release is not None:
+                    release()
+                return future
+            if self._executor is None:
+                # Spawned workers do not inherit the server's threads and locks.
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            future = Future()
+            self._building[key] = future
+        started = time.monotonic()
+        try:
+            build = self._executor.submit(build_pyramid, source, self.path_for(key), tile_size=self.tile_size,
+                                          max_pixels=self.max_pixels)
+        except BaseException:
+            with self._lock:
+                del self._building[key]
+            if release is not None:
+                release()
+            raise
+        build.add_done_callback(lambda build: self._built(key, future, build, started, release))
+        return future
+
+    def clear(self):
+        with self._lock:
+            paths = [path for path, _ in self._entries.values()]
+            self._entries.clear()
+            self._bytes = 0
+        for path in paths:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'building': len(self._building),
+                'hits': self.hits,
+                'misses': self.misses,
+                'builds': self.builds,
+                'build_failures': self.build_failures,
+                'build_seconds': self.build_seconds,
+            }
+
+    def _built(self, key, future, build, started, release=None):
+        if release is not None:
+            release()
+        error = build.exception()
+        path = self.path_for(key)
+        with self._lock:
+            del self._building[key]
+            self.build_seconds += time.monotonic() - started
+            if error is None:
+                self.builds += 1
+                self._entries[key] = (path, build.result())
+                self._bytes += build.result()
+                evicted = self._evict()
+            else:
+                self.build_failures += 1
+                evicted = []
+        for evicted_path in evicted:
+            shutil.rmtree(evicted_path, ignore_errors=True)
+        if error is None:
+            future.set_result(path)
+        else:
+            # A source missing is not a fault of the image, the next request
+            # fetches it again.
+            if not isinstance(error, FileNotFoundError):
+                self._failed.set(key, True)
+            future.set_exception(error)
+
+    # Must be called with the lock held. Returns the directories to remove.
+    def _evict(self):
+        evicted = []
+        # The newest pyramid stays even if it alone exceeds max_bytes.
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            _, (path, size) = self._entries.popitem(last=False)
+            self._bytes -= size
+            evicted.append(path)
+        return evicted
+
+    def _load(self):
+        found = []
+        for entry in os.scandir(self.root):
+            match = _ENTRY_RE.match(entry.name)
+            if match is None or not entry.is_dir():
+                # Leftovers of builds interrupted by a restart.
+                if '.tmp-' in entry.name:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                continue
+            try:
+                with open(os.path.join(entry.path, '.size')) as f:
+                    size = int(f.read())
+            except (OSError, ValueError):
+                shutil.rmtree(entry.path, ignore_errors=True)
+                continue
+            key = (match.group('file_id'), int(match.group('version')))
+            found.append((entry.stat().st_atime, key, entry.path, size))
+        for _, key, path, size in sorted(found):
+            self._entries[key] = (path, size)
+            self._bytes += size
+        for path in self._evict():
+            shutil.rmtree(path, ignore_errors=True)
+
+
+# Background thumbnail builds for listing pages.
+#
+# Kept apart from the viewer's download jobs (home.jobs) so a page of
+# thumbnails never queues ahead of a file the user opened. A few worker
+# threads download the source of each queued image into a temporary file,
+# not the download cache, where thumbnail sources would evict the files users
+# opened, and build its pyramid from that file. The newest requests are served
+# first, as they belong to the page being looked at, and past max_queue the
+# oldest requests are dropped; their listings ask again.
+class ThumbnailQueue:
+    def __init__(self, workers=2, max_queue=512, spool_dir=None) -> None:
+        self.workers = workers
+        self.max_queue = max_queue
+        self.spool_dir = spool_dir
+        self._cond = threading.Condition()
+        self._pending = deque()  # (key, api_key, container_id, file_name), newest last
+        self._keys = set()  # keys queued or being built
+        self._threads = []
+        self.submitted = 0
+        self.dropped = 0
+        self.built = 0
+        self.failed = 0
+
+    # Queue a build of the pyramid of key unless it is queued or running.
+    def submit(self, key, api_key, container_id, file_name):
+        with self._cond:
+            if key in self._keys:
+                return
+            self._keys.add(key)
+            self._pending.append((key, api_key, container_id, file_name))
+            self.submitted += 1
+            while len(self._pending) > self.max_queue:
+                self._keys.discard(self._pending.popleft()[0])
+                self.dropped += 1
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name='thumbnail-%d' % len(self._threads), daemon=True)
+                self._threads.append(thread)
+                thread.start()
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'queued': len(self._pending),
+                'running': len(self._keys) - len(self._pending),
+                'workers': self.workers,
+                'max_queue': self.max_queue,
+                'submitted': self.submitted,
+                'dropped': self.dropped,
+                'built': self.built,
+                'failed': self.failed,
+            }
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                key, api_key, container_id, file_name = self._pending.pop()
+            try:
+                self._build(key, api_key, container_id, file_name)
+                built = True
+            except Exception:
+                # The tile cache remembers images that cannot be built; after
+                # a failed download the next listing asks again.
+                built = False
+            with self._cond:
+                self._keys.discard(key)
+                if built:
+                    self.built += 1
+                else:
+                    self.failed += 1
+
+    def _build(self, key, api_key, container_id, file_name):
+        if tile_cache.contains(key) or tile_cache.failed(key):
+            return
+        fd, path = tempfile.mkstemp(suffix=os.path.splitext(file_name)[1], dir=self.spool_dir)
+        try:
+            stream = FlywheelFileStream(api_key, container_id, file_name)
+            with os.fdopen(fd, 'wb') as f:
+                try:
+                    for chunk in stream:
+                        f.write(chunk)
+                finally:
+                    stream.close()
+        except BaseException:
+            os.remove(path)
+            raise
+        tile_cache.build(key, path, release=lambda: os.remove(path)).result()
+
+
+# Build the pyramid of key from a pinned copy of its file in the download
+# cache. Returns the Future of the build, or None if the file is not cached.
+def build_from_download_cache(key):
+    source = download_cache.pin(key)
+    if source is None:
+        return None
+    return tile_cache.build(key, source, release=lambda: download_cache.unpin(source))
+
+
+# Whether the viewer can show file_entry as a tiled image
+def tileable(file_entry):
+    return (os.path.splitext(file_entry.name)[1].lower() in settings.FW_TILE_EXTENSIONS
+            and file_entry.size <= settings.FW_TILE_MAX_SOURCE_BYTES and download_cache.accepts(file_entry.size))
+
+
+# Whether listings show a thumbnail of file_entry. Building one downloads the
+# whole file, so this is limited to smaller files, and thumbnails are built in
+# the background by thumbnail_queue.
+def has_thumbnail(file_entry):
+    return (file_entry.size <= settings.FW_THUMBNAIL_MAX_SOURCE_BYTES and tileable(file_entry)
+            and not tile_cache.failed((file_entry.id, file_entry.version)))
+
+
+tile_cache = TileCache(
+    getattr(settings, 'FW_TILE_CACHE_DIR', os.path.join(settings.BASE_DIR, 'tiles')),
+    max_bytes=getattr(settings, 'FW_TILE_CACHE_MAX_BYTES', 5 * 1024 ** 3),
+    workers=getattr(settings, 'FW_TILE_WORKERS', 2),
+    tile_size=getattr(settings, 'FW_TILE_SIZE', 256),
+    max_pixels=getattr(settings, 'FW_TILE_MAX_PIXELS', 1 << 30))
+
+thumbnail_queue = ThumbnailQueue(
+    workers=getattr(settings, 'FW_THUMBNAIL_WORKERS', 2),
+    max_queue=getattr(settings, 'FW_THUMBNAIL_MAX_QUEUE', 512),
+    spool_dir=getattr(settings, 'FW_THUMBNAIL_SPOOL_DIR', None))
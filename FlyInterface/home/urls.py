@@ -4,5 +4,16 @@ from . import views
 urlpatterns = [
     path('', views.index, name='index'),
     path('projects/<path:root_path>', views.index, name='project-sites'),
-    path('viewer/<path:file_path>', views.imagej_viewer, name="imagej-viewer")
+    path('export/<path:root_path>', views.export, name='export'),
+    path('viewer/<path:file_path>', views.imagej_viewer, name="imagej-viewer"),
+    path('api/children/<path:root_path>', views.children_page, name='children-page'),
+    path('search/', views.search, name='search-root'),
+    path('search/<path:root_path>', views.search, name='search'),
+    path('files/<path:file_path>', views.file_proxy, name='file-proxy'),
+    path('tiles/<path:file_path>.dzi', views.tile_descriptor, name='tile-descriptor'),
+    path('tiles/<path:file_path>_files/<int:level>/<int:col>_<int:row>.jpeg', views.tile, name='tile'),
+    path('thumbnails/<path:file_path>', views.thumbnail, name='thumbnail'),
+    path('jobs/<str:job_id>', views.download_job, name='download-job'),
+    path('stats/', views.stats, name='stats'),
+    path('metrics/', views.metrics, name='metrics'),
 ]
\ No newline at end of file
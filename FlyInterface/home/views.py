@@ -1,56 +1,597 @@
-from django.http import HttpResponse, Http404
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import PermissionDenied, SuspiciousFileOperation
+from django.http import HttpResponse, Http404, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect
 from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import content_disposition_header, http_date
+from django.utils._os import safe_join
+from django.views import static
 
-from .models import FwContextInfo
+from .cache import hierarchy_cache, user_cache
+from .client_pool import client_pool
+from .download_cache import download_cache
+from .executor import run_blocking
+from .export import ExportEntry, iter_zip_export
+from .instrumentation import exposition, template_renders, timed
+from .jobs import QueueFull, download_jobs
+from .models import FwContextInfo, FwListing
+from .search_index import index_groups, search_index
+from .tiles import build_from_download_cache, has_thumbnail, thumbnail_queue, tile_cache, tileable
+from .streaming import (FlywheelFileStream, RangeNotSatisfiable, api_key_for_file,
+                        content_type_for, iter_file_range, make_file_token, parse_range_header,
+                        streaming_body)
 
+import asyncio
 import flywheel
+import functools
+import hashlib
+import hmac
+import ipaddress
+import posixpath
 import os
-import pathlib
+import tempfile
 
-# Retrieve information from Flywheel client
-def retrieveFWInfo(fw: flywheel.Client, root_path=''):
+# Session reads and writes may hit the database, keep them off the event loop.
+@sync_to_async
+def _session_api_key(request):
+    return request.session.get('api_key')
+
+
+@sync_to_async
+def _set_session_api_key(request, api_key):
+    if api_key is None:
+        request.session.pop('api_key', None)
+    else:
+        request.session['api_key'] = api_key
+
+
+# Key of a resolved path in the hierarchy cache
+def hierarchyKey(user, root_path):
+    return (user.id, root_path.strip('/'))
+
+
+# Current Flywheel user of an API key, cached per process
+async def getFWUser(fw: flywheel.Client, api_key, refresh=False):
+    user = None if refresh else user_cache.get(api_key)
+    if user is None:
+        user = await run_blocking(fw.get_current_user)
+        user_cache.set(api_key, user)
+    return user
+
+
+# Resolve a Flywheel path into a compact listing of its children
+def fetchFWListing(fw: flywheel.Client, root_path):
+    return FwListing.from_resolve(fw.resolve(root_path))
+
+
+# Listing of a Flywheel path, served from the hierarchy cache when possible
+async def resolveFWPath(fw: flywheel.Client, user, root_path, refresh=False):
+    key = hierarchyKey(user, root_path)
+    listing = None if refresh else hierarchy_cache.get(key)
+    if listing is None:
+        listing = await run_blocking(fetchFWListing, fw, root_path)
+        hierarchy_cache.set(key, listing)
+    return listing
+
+
+# Labels of the projects the user can see in each of groups, resolved
+# concurrently; groups the user cannot resolve are left out.
+async def visibleFWProjects(fw: flywheel.Client, user, groups):
+    async def projects_of(group):
+        try:
+            listing = await resolveFWPath(fw, user, group)
+        except flywheel.ApiException:
+            return None
+        return {container.label for container in listing.containers}
+    found = await asyncio.gather(*(projects_of(group) for group in groups))
+    return {group: labels for group, labels in zip(groups, found) if labels is not None}
+
+
+# Retrieve information from Flywheel client.
+# Without a cached user, the user lookup and the resolve run concurrently.
+async def retrieveFWInfo(fw: flywheel.Client, root_path='', api_key=None, refresh=False,
+                         offset=0, limit=None):
     if fw is None:
         return None
     info = FwContextInfo()
-    info.user.first_name = fw.get_current_user().firstname
-    info.user.last_name = fw.get_current_user().lastname
-    results = fw.resolve(root_path)
-    info.projects = [c for c in results.children if hasattr(c, 'label') and c.label is not None]
-    info.files = [c for c in results.children if hasattr(c, 'file_id')]
+    user = None if refresh else user_cache.get(api_key)
+    if user is None:
+        user, listing = await asyncio.gather(
+            getFWUser(fw, api_key, refresh=True),
+            run_blocking(fetchFWListing, fw, root_path))
+        hierarchy_cache.set(hierarchyKey(user, root_path), listing)
+    else:
+        listing = await resolveFWPath(fw, user, root_path, refresh)
+    info.user.first_name = user.firstname
+    info.user.last_name = user.lastname
+    pageFWChildren(info, listing, offset, limit)
+    # Thumbnails come and go with the tile cache, not with the listing.
+    thumbnails = [f for f in info.files if has_thumbnail(f)]
+    info.thumbnails = {f.name for f in thumbnails}
+    built = [f.name for f in thumbnails if tile_cache.contains((f.id, f.version))]
+    info.etag = _etag(listing.digest, user.id, user.firstname, user.lastname, offset, limit,
+                      sorted(info.thumbnails), sorted(built))
     return info
 
 
-def imagej_viewer(request, file_path):
-    if request.method == 'POST' or 'api_key' not in request.session:
+# Fill info with one page of a container listing.
+# Sub containers come first, then files; offset and limit apply to both in turn.
+def pageFWChildren(info, listing, offset=0, limit=None):
+    projects = listing.containers
+    files = listing.files
+    end = offset + (limit or settings.FW_LISTING_PAGE_SIZE)
+    info.projects = projects[offset:end]
+    info.files = files[max(offset - len(projects), 0):max(end - len(projects), 0)]
+    info.total_projects = len(projects)
+    info.total_files = len(files)
+    info.next_offset = end if end < len(projects) + len(files) else None
+
+
+# Download a Flywheel file into the download cache and return its local path
+def fetchFWFile(api_key, container_id, file_entry):
+    def download(writer):
+        stream = FlywheelFileStream(api_key, container_id, file_entry.name)
+        try:
+            for chunk in stream:
+                writer.write(chunk)
+        finally:
+            stream.close()
+    return download_cache.fetch((file_entry.id, file_entry.version), download,
+                                os.path.splitext(file_entry.name)[1])
+
+
+# Download a Flywheel file into the download cache and start building its
+# pyramid from a pinned copy, so eviction cannot remove the source before the
+# build process opens it. Returns the Future of the build.
+def buildFWPyramid(api_key, container_id, file_entry):
+    while True:
+        fetchFWFile(api_key, container_id, file_entry)
+        future = build_from_download_cache((file_entry.id, file_entry.version))
+        if future is not None:
+            return future
+        # Evicted between the fetch and the pin, fetch again.
+
+
+# Read a Flywheel file of an export into a spooled temporary file: in memory
+# up to FW_EXPORT_BUFFER_MAX_BYTES, on disk under FW_EXPORT_SPOOL_DIR above.
+# Exports bypass the download cache so a large subtree does not evict what
+# others have cached.
+def readFWExportFile(api_key, container_id, file_entry):
+    spool = tempfile.SpooledTemporaryFile(settings.FW_EXPORT_BUFFER_MAX_BYTES, dir=settings.FW_EXPORT_SPOOL_DIR)
+    stream = FlywheelFileStream(api_key, container_id, file_entry.name)
+    try:
+        for chunk in stream:
+            spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    finally:
+        stream.close()
+    spool.seek(0)
+    return spool
+
+
+# Every file of the subtree at root_path as (path relative to root_path,
+# container id, file entry), sorted by path, or None when there are more than
+# max_files. Containers resolve concurrently as soon as their parent is
+# listed, and the walk stops as soon as the limit is passed.
+async def walkFWTree(fw: flywheel.Client, user, root_path, max_files=None):
+    files = []
+    pending = {}
+
+    def resolve(relative_path, path):
+        pending[asyncio.ensure_future(resolveFWPath(fw, user, path))] = (relative_path, path)
+
+    resolve('', root_path.strip('/'))
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                relative_path, path = pending.pop(task)
+                listing = task.result()
+                files += [(relative_path + f.name, listing.container_id, f) for f in listing.files]
+                for c in listing.containers:
+                    resolve(relative_path + c.label + '/', path + '/' + c.label)
+            if max_files is not None and len(files) > max_files:
+                return None
+    finally:
+        for task in pending:
+            task.cancel()
+    files.sort(key=lambda f: f[0])
+    return files
+
+
+# Strong ETag over the given parts
+def _etag(*parts):
+    return '"%s"' % hashlib.blake2b('\0'.join(map(str, parts)).encode(), digest_size=16).hexdigest()
+
+
+# Set the validators and Cache-Control directives of a response
+def _set_cache_headers(response, etag, last_modified=None, **cache_control):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    patch_cache_control(response, **cache_control)
+    return response
+
+
+# 304 (or 412) response when the conditional headers of the request match,
+# None when the full response has to be built
+def _not_modified(request, etag, last_modified=None, **cache_control):
+    response = get_conditional_response(
+        request, etag=etag, last_modified=int(last_modified.timestamp()) if last_modified else None)
+    if response is not None:
+        _set_cache_headers(response, etag, last_modified, **cache_control)
+    return response
+
+
+# Pages and files addressed by Flywheel path depend on the session and may
+# change, browsers keep them but revalidate every time. URLs that carry the file
+# version (?v=) never change.
+REVALIDATE_CACHE_CONTROL = {'private': True, 'no_cache': True}
+IMMUTABLE_CACHE_CONTROL = {'private': True, 'max_age': 365 * 24 * 3600, 'immutable': True}
+
+
+# render() timed into the Server-Timing header and the render histogram
+def _render(request, template_name, context):
+    name = os.path.basename(template_name)
+    with timed(template_renders, name, 'render.' + name):
+        return render(request, template_name, context)
+
+
+# Non-negative integer query parameter
+def _int_param(request, name, default):
+    try:
+        return max(int(request.GET.get(name, default)), 0)
+    except ValueError:
+        return default
+
+
+async def imagej_viewer(request, file_path):
+    api_key = await _session_api_key(request)
+    if request.method == 'POST' or api_key is None:
         response = redirect('/')
         return response
 
-    project_root = pathlib.Path(__file__).parent.parent.resolve()
-    fw_client = flywheel.Client(request.session['api_key'])
     base_path, file_name = os.path.split(file_path)
-    result = fw_client.resolve(base_path)
-    project = result.path[-1]
-    project.download_file(file_name, os.path.join(project_root, 'data', file_name))
-    return render(request, 'home/imagej_viewer.html', {'image_file': file_name})
+    async with client_pool.aclient(api_key) as fw_client:
+        user = await getFWUser(fw_client, api_key)
+        listing = await resolveFWPath(fw_client, user, base_path)
+    file_entry = listing.find_file(file_name)
+    if file_entry is None:
+        raise Http404('File not found: ' + file_path)
+
+    # The page renders right away. Small files are streamed to ImageJ through
+    # file_proxy; large ones are first fetched into the download cache by a
+    # background job that the page polls before opening ImageJ.
+    job = None
+    cache_key = (file_entry.id, file_entry.version)
+    if (file_entry.size >= settings.FW_DOWNLOAD_JOB_MIN_SIZE and download_cache.accepts(file_entry.size)
+            and not download_cache.contains(cache_key)):
+        try:
+            job = download_jobs.submit(cache_key, api_key, listing.container_id, file_name, file_entry.size)
+        except QueueFull:
+            pass
+    file_url = request.build_absolute_uri(reverse('file-proxy', args=[file_path]))
+    file_url += '?token=' + await sync_to_async(make_file_token)(request, file_path)
+    # Images open as a tiled view that only loads the visible tiles, ImageJ
+    # (and the full download) is one click away.
+    tile_source_url = None
+    if tileable(file_entry) and not tile_cache.failed(cache_key):
+        tile_source_url = reverse('tile-descriptor', args=[file_path]) + '?v=%d' % file_entry.version
+    return _render(request, 'home/imagej_viewer.html', {
+        'image_file': file_name, 'file_url': file_url, 'job': job, 'tile_source_url': tile_source_url})
+
+
+# Progress of a background download job, polled by imagej_viewer.html
+async def download_job(request, job_id):
+    api_key = await _session_api_key(request)
+    job = download_jobs.get(job_id, api_key) if api_key is not None else None
+    if job is None:
+        raise Http404('Unknown download job')
+    return JsonResponse(job.as_dict())
+
+
+# Stream a Flywheel file through to the client, honouring Range requests.
+# Complete downloads are kept in the download cache and served from disk.
+async def file_proxy(request, file_path):
+    api_key = await sync_to_async(api_key_for_file)(request, file_path)
+    if api_key is None:
+        raise PermissionDenied
+
+    base_path, file_name = os.path.split(file_path)
+    async with client_pool.aclient(api_key) as fw_client:
+        user = await getFWUser(fw_client, api_key)
+        listing = await resolveFWPath(fw_client, user, base_path)
+    file_entry = listing.find_file(file_name)
+    if file_entry is None:
+        raise Http404('File not found: ' + file_path)
+
+    # A Flywheel file version never changes, its id and version make a strong ETag.
+    etag = _etag(file_entry.id, file_entry.version)
+    response = _not_modified(request, etag, file_entry.modified, **REVALIDATE_CACHE_CONTROL)
+    if response is not None:
+        response['Access-Control-Allow-Origin'] = '*'
+        return response
+
+    size = file_entry.size
+    # A Range with a stale If-Range validator gets the whole file.
+    if_range = request.headers.get('If-Range')
+    range_header = request.headers.get('Range') if if_range is None or if_range == etag else None
+    try:
+        byte_range = parse_range_header(range_header, size)
+    except RangeNotSatisfiable:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+        return response
+
+    if request.method == 'HEAD':
+        response = HttpResponse(content_type=content_type_for(file_entry))
+    else:
+        cache_key = (file_entry.id, file_entry.version)
+        cache_writer = None
+        # Opened right away, an eviction before the body is sent cannot
+        # remove the file from under the response.
+        cached_file = await run_blocking(download_cache.open, cache_key)
+        if cached_file is None and byte_range is None and download_cache.accepts(size):
+            cache_writer = download_cache.open_writer(cache_key, os.path.splitext(file_name)[1])
+            if cache_writer is None:
+                # Someone else is downloading this file, wait for their copy;
+                # without one (failed or evicted already) stream from Flywheel.
+                cached_file = await run_blocking(download_cache.wait, cache_key, open_file=True)
+        if cached_file is not None:
+            stream = iter_file_range(cached_file, byte_range)
+        else:
+            stream = await run_blocking(FlywheelFileStream, api_key, listing.container_id, file_name,
+                                        byte_range, cache_writer=cache_writer)
+        response = StreamingHttpResponse(streaming_body(request, stream),
+                                         content_type=content_type_for(file_entry))
+    if byte_range is None:
+        response['Content-Length'] = size
+    else:
+        response.status_code = 206
+        response['Content-Range'] = 'bytes %d-%d/%d' % (byte_range[0], byte_range[1], size)
+        response['Content-Length'] = byte_range[1] - byte_range[0] + 1
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Disposition'] = content_disposition_header(False, file_name)
+    response['Access-Control-Allow-Origin'] = '*'
+    response['Access-Control-Expose-Headers'] = 'Accept-Ranges, Content-Length, Content-Range, ETag, Last-Modified'
+    return _set_cache_headers(response, etag, file_entry.modified, **REVALIDATE_CACHE_CONTROL)
+
+
+# File of the tile pyramid of an image (see home.pyramid), which is built on
+# first access, in the background for thumbnails. Tiles and thumbnails are a
+# few KB, they are read in one go.
+async def _pyramid_file(request, file_path, name, content_type, thumbnail_only=False):
+    api_key = await _session_api_key(request)
+    if api_key is None:
+        raise PermissionDenied
+
+    base_path, file_name = os.path.split(file_path)
+    async with client_pool.aclient(api_key) as fw_client:
+        user = await getFWUser(fw_client, api_key)
+        listing = await resolveFWPath(fw_client, user, base_path)
+    file_entry = listing.find_file(file_name)
+    if file_entry is None or not tileable(file_entry):
+        raise Http404('No tiles for: ' + file_path)
+
+    key = (file_entry.id, file_entry.version)
+    etag = _etag(file_entry.id, file_entry.version, name)
+    if request.GET.get('v') == str(file_entry.version):
+        cache_control = IMMUTABLE_CACHE_CONTROL
+    else:
+        cache_control = REVALIDATE_CACHE_CONTROL
+    response = _not_modified(request, etag, **cache_control)
+    if response is not None:
+        return response
+
+    pyramid = tile_cache.lookup(key)
+    if pyramid is None:
+        if tile_cache.failed(key):
+            raise Http404('No tiles for: ' + file_path)
+        if thumbnail_only:
+            # Listings ask for many thumbnails at once: download and build
+            # them on the thumbnail queue instead of inside the request.
+            if not has_thumbnail(file_entry):
+                raise Http404('No thumbnail for: ' + file_path)
+            thumbnail_queue.submit(key, api_key, listing.container_id, file_name)
+            response = HttpResponse('Thumbnail not built yet.', status=503)
+            response['Retry-After'] = '5'
+            patch_cache_control(response, no_store=True)
+            return response
+        try:
+            future = await run_blocking(buildFWPyramid, api_key, listing.container_id, file_entry)
+            pyramid = await asyncio.wrap_future(future)
+        except Exception:
+            raise Http404('No tiles for: ' + file_path)
+    try:
+        with open(os.path.join(pyramid, name), 'rb') as f:
+            response = HttpResponse(f.read(), content_type=content_type)
+    except FileNotFoundError:
+        raise Http404()
+    return _set_cache_headers(response, etag, **cache_control)
+
+
+# Deep Zoom descriptor of an image
+async def tile_descriptor(request, file_path):
+    return await _pyramid_file(request, file_path, 'image.dzi', 'application/xml')
+
+
+async def tile(request, file_path, level, col, row):
+    return await _pyramid_file(request, file_path, os.path.join('image_files', str(level), '%d_%d.jpeg' % (col, row)),
+                               'image/jpeg')
+
+
+async def thumbnail(request, file_path):
+    return await _pyramid_file(request, file_path, 'thumbnail.jpeg', 'image/jpeg', thumbnail_only=True)
+
+
+# ZIP archive of every file under a container, streamed while the files are
+# fetched concurrently
+async def export(request, root_path):
+    api_key = await _session_api_key(request)
+    if api_key is None:
+        raise PermissionDenied
+
+    async with client_pool.aclient(api_key) as fw_client:
+        user = await getFWUser(fw_client, api_key)
+        files = await walkFWTree(fw_client, user, root_path, settings.FW_EXPORT_MAX_FILES)
+    if files is None:
+        return HttpResponse('More than %d files under %s, export a smaller subtree.'
+                            % (settings.FW_EXPORT_MAX_FILES, root_path), status=413)
+
+    name = root_path.strip('/').rsplit('/', 1)[-1]
+    entries = [
+        ExportEntry(name + '/' + relative_path, f.size, f.modified,
+                    functools.partial(readFWExportFile, api_key, container_id, f),
+                    functools.partial(FlywheelFileStream, api_key, container_id, f.name))
+        for relative_path, container_id, f in files]
+    stream = iter_zip_export(entries, settings.FW_EXPORT_WORKERS, settings.FW_STREAM_CHUNK_SIZE,
+                             settings.FW_EXPORT_SPOOL_MAX_BYTES)
+    response = StreamingHttpResponse(streaming_body(request, stream), content_type='application/zip')
+    response['Content-Disposition'] = content_disposition_header(True, name + '.zip')
+    return response
 
 
 # Base home view
-def index(request, root_path=''):
+async def index(request, root_path=''):
     if request.method == 'POST':
-        request.session['api_key'] = request.POST['api_key']
+        await _set_session_api_key(request, request.POST['api_key'])
         response = redirect('/home/projects/wandell')
         return response
     
-    if not root_path and 'api_key' in request.session:
-        del request.session['api_key']
+    api_key = await _session_api_key(request)
+    if not root_path and api_key is not None:
+        user_cache.invalidate(api_key)
+        await _set_session_api_key(request, None)
+        api_key = None
     
-    if 'api_key' in request.session:
-        fw_client = flywheel.Client(request.session['api_key'])
-        info = retrieveFWInfo(fw_client, root_path)
+    if api_key is not None:
+        refresh = 'refresh' in request.GET
+        offset = _int_param(request, 'offset', 0)
+        async with client_pool.aclient(api_key) as fw_client:
+            info = await retrieveFWInfo(fw_client, root_path, api_key, refresh, offset)
+        response = _not_modified(request, info.etag, **REVALIDATE_CACHE_CONTROL)
+        if response is not None:
+            return response
         info.current_path = root_path + '/'
-        return render(
+        response = _render(
             request,
             'home/home_page.html',
             {'context': info})
-    return render(request, 'home/index.html', {})
\ No newline at end of file
+        return _set_cache_headers(response, info.etag, **REVALIDATE_CACHE_CONTROL)
+    return _render(request, 'home/index.html', {})
+
+
+# JSON page of a container listing, loaded by home_page.html as the user scrolls
+async def children_page(request, root_path):
+    api_key = await _session_api_key(request)
+    if api_key is None:
+        raise PermissionDenied
+
+    offset = _int_param(request, 'offset', 0)
+    limit = min(_int_param(request, 'limit', settings.FW_LISTING_PAGE_SIZE) or 1,
+                settings.FW_LISTING_MAX_PAGE_SIZE)
+    async with client_pool.aclient(api_key) as fw_client:
+        info = await retrieveFWInfo(fw_client, root_path, api_key, offset=offset, limit=limit)
+    response = _not_modified(request, info.etag, **REVALIDATE_CACHE_CONTROL)
+    if response is not None:
+        return response
+    current_path = root_path.rstrip('/') + '/'
+    response = JsonResponse({
+        'projects': [{'label': c.label, 'url': reverse('project-sites', args=[current_path + c.label])}
+                     for c in info.projects],
+        'files': [{'name': f.name, 'url': reverse('imagej-viewer', args=[current_path + f.name]),
+                   'thumbnail': (reverse('thumbnail', args=[current_path + f.name]) + '?v=%d' % f.version
+                                 if f.name in info.thumbnails else None)}
+                  for f in info.files],
+        'total_projects': info.total_projects,
+        'total_files': info.total_files,
+        'next_offset': info.next_offset,
+    })
+    return _set_cache_headers(response, info.etag, **REVALIDATE_CACHE_CONTROL)
+
+
+# Search of the local index built by `manage.py fw_sync`, limited to the
+# projects the caller's own API key can see
+async def search(request, root_path=''):
+    api_key = await _session_api_key(request)
+    if api_key is None:
+        return redirect('/')
+
+    query = request.GET.get('q', '').strip()
+    results = []
+    if query:
+        groups = await sync_to_async(index_groups)(root_path)
+        async with client_pool.aclient(api_key) as fw_client:
+            user = await getFWUser(fw_client, api_key)
+            projects = await visibleFWProjects(fw_client, user, groups)
+        nodes = await sync_to_async(search_index)(query, root_path, projects=projects)
+        for node in nodes:
+            view = 'imagej-viewer' if node.type == 'file' else 'project-sites'
+            results.append({'node': node, 'url': reverse(view, args=[node.path])})
+    return _render(request, 'home/search.html',
+                   {'query': query, 'root_path': root_path.strip('/'), 'results': results})
+
+
+# django.views.static.serve for MEDIA_URL in development, with an ETag next to
+# its Last-Modified and a Cache-Control header
+def media_file(request, path, document_root):
+    try:
+        stat = os.stat(safe_join(document_root, posixpath.normpath(path).lstrip('/')))
+    except (OSError, SuspiciousFileOperation):
+        return static.serve(request, path, document_root)
+    etag = '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+    response = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if response is None:
+        response = static.serve(request, path, document_root)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    patch_cache_control(response, private=True, max_age=3600)
+    return response
+
+
+def _component_stats():
+    return {
+        'client_pool': client_pool.stats(),
+        'hierarchy_cache': hierarchy_cache.stats(),
+        'user_cache': user_cache.stats(),
+        'download_cache': download_cache.stats(),
+        'download_jobs': download_jobs.stats(),
+        'thumbnail_queue': thumbnail_queue.stats(),
+        'tile_cache': tile_cache.stats(),
+    }
+
+
+# Monitoring endpoints are open to staff users, to requests carrying
+# FW_MONITORING_TOKEN as a bearer token and to clients in
+# FW_MONITORING_ALLOWED_NETWORKS.
+def _check_monitoring_access(request):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_staff:
+        return
+    token = getattr(settings, 'FW_MONITORING_TOKEN', None)
+    if token and hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token):
+        return
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        raise PermissionDenied
+    networks = getattr(settings, 'FW_MONITORING_ALLOWED_NETWORKS', ('127.0.0.0/8', '::1/128'))
+    if not any(address in ipaddress.ip_network(network) for network in networks):
+        raise PermissionDenied
+
+
+# Runtime counters of the shared Flywheel client pool and caches
+def stats(request):
+    _check_monitoring_access(request)
+    return JsonResponse(_component_stats())
+
+
+# Prometheus scrape endpoint: Flywheel call, render and request latency
+# histograms plus the counters of stats()
+def metrics(request):
+    _check_monitoring_access(request)
+    return HttpResponse(exposition(_component_stats()), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,291 @@
+"""
+Block motion vectors between two frames with NumPy, for machines without an NVIDIA GPU.
+
+For every block of the input frame the vector (dx, dy) minimizing the sum of absolute luma
+differences (SAD) to the reference block at (x + dx, y + dy) is searched within +-search_range
+pixels, the same convention as MV_NVENC. Three searches are available:
+  full          every candidate vector, one whole-frame array operation per candidate
+  diamond       large then small diamond pattern steps for all blocks at once
+  hierarchical  full search on a downscaled pyramid, refined level by level
+Frames are (h, w) grayscale or (h, w, 3 or 4) RGB(X) uint8 arrays, e.g. frames of the camera
+preview pipeline, or image files.
+
+Vector fields can be written as the PNG MV_NVENC writes: 2x2 pixels per 16x16 macroblock (one
+per 8x8 partition), R = mvx + 127, G = mvy + 127, B = 127, in whole pixels:
+    python3 block_matching.py ref.png in.png mv.png --method diamond
+    python3 block_matching.py --sequence frame_*.png --output-dir mv
+    python3 block_matching.py --compare mv.png mv_nvenc.png
+"""
+
+import argparse
+import glob
+import os
+
+import numpy as np
+
+METHODS = ("full", "diamond", "hierarchical")
+LARGE_DIAMOND = ((0, 0), (-2, 0), (2, 0), (0, -2), (0, 2), (-1, -1), (-1, 1), (1, -1), (1, 1))
+SMALL_DIAMOND = ((0, 0), (-1, 0), (1, 0), (0, -1), (0, 1))
+NVENC_PARTITION = 8  # MV_NVENC writes one vector per 8x8 partition of each 16x16 macroblock
+
+
+# Luma of a grayscale or RGB(X) uint8 frame, as uint8
+def luma(frame):
+    frame = np.asarray(frame)
+    if frame.ndim == 2:
+        return frame.astype(np.uint8, copy=False)
+    rgb = frame[..., :3].astype(np.uint16)
+    return ((77 * rgb[..., 0] + 150 * rgb[..., 1] + 29 * rgb[..., 2] + 128) >> 8).astype(np.uint8)
+
+
+class BlockMatcher:
+    """
+    Motion vectors of block_size blocks of an input frame against a reference frame.
+
+    estimate() returns an (rows, cols, 2) int16 field of (dx, dy) per block, rows and cols
+    rounded up to whole blocks. Frames are padded by repeating their edges, so every vector
+    within the search range has a complete candidate block. For a stream of frames, update()
+    keeps the previous frame as reference and starts diamond searches from the last field.
+    """
+
+    def __init__(self, block_size=8, search_range=16, method="diamond", levels=3):
+        if method not in METHODS:
+            raise ValueError("method must be one of %s" % ", ".join(METHODS))
+        self.block_size = block_size
+        self.search_range = search_range
+        self.method = method
+        self.levels = levels
+        self._previous = None
+        self._field = None
+
+    def estimate(self, reference, frame, init=None):
+        reference, frame = luma(reference), luma(frame)
+        if reference.shape != frame.shape:
+            raise ValueError("frames differ in size: %s and %s" % (reference.shape, frame.shape))
+        if self.method == "full":
+            return full_search(reference, frame, self.block_size, self.search_range)
+        if self.method == "diamond":
+            return diamond_search(reference, frame, self.block_size, self.search_range, init)
+        return hierarchical_search(reference, frame, self.block_size, self.search_range, self.levels)
+
+    def update(self, frame):
+        """Field of frame against the previous frame passed here, None for the first one."""
+        frame = luma(frame).copy()
+        field = None
+        if self._previous is not None and self._previous.shape == frame.shape:
+            field = self._field = self.estimate(self._previous, frame, init=self._field)
+        self._previous = frame
+        return field
+
+
+# Pad a 2D frame with its edges to whole blocks plus a margin on every side
+def _pad(frame, block_size, margin):
+    height, width = frame.shape
+    return np.pad(frame, ((margin, -height % block_size + margin), (margin, -width % block_size + margin)), "edge")
+
+
+# SAD sums of block_size blocks fit uint16 up to 16x16 blocks
+def _sad_dtype(block_size):
+    return np.uint16 if block_size * block_size * 255 < 1 << 16 else np.uint32
+
+
+def full_search(reference, frame, block_size=8, search_range=16):
+    """Exhaustive search: each candidate vector is one SAD pass over the whole frame."""
+    cur = _pad(frame, block_size, 0)
+    ref = _pad(reference, block_size, search_range)
+    height, width = cur.shape
+    rows, cols = height // block_size, width // block_size
+    dtype = _sad_dtype(block_size)
+    best = np.full((rows, cols), np.iinfo(dtype).max, dtype)
+    field = np.zeros((rows, cols, 2), np.int16)
+    diff = np.empty_like(cur)
+    low = np.empty_like(cur)
+    # Smallest vectors first, so ties keep the shortest one
+    offsets = sorted(((dx, dy) for dy in range(-search_range, search_range + 1)
+                      for dx in range(-search_range, search_range + 1)), key=lambda v: (abs(v[0]) + abs(v[1]), v))
+    for dx, dy in offsets:
+        candidate = ref[search_range + dy:search_range + dy + height, search_range + dx:search_range + dx + width]
+        # |cur - candidate| without leaving uint8
+        np.maximum(cur, candidate, out=diff)
+        np.minimum(cur, candidate, out=low)
+        diff -= low
+        sad = diff.reshape(rows, block_size, cols, block_size).sum(axis=(1, 3), dtype=dtype)
+        better = sad < best
+        best[better] = sad[better]
+        field[better] = (dx, dy)
+    return field
+
+
+class _Blocks:
+    """Blocks of one frame and a padded reference, with SADs of arbitrary per-block vectors."""
+
+    def __init__(self, reference, frame, block_size, search_range):
+        cur = _pad(frame, block_size, 0)
+        self.ref = _pad(reference, block_size, search_range).ravel()
+        height, width = cur.shape
+        self.rows, self.cols = height // block_size, width // block_size
+        self.stride = width + 2 * search_range
+        self.search_range = search_range
+        self.dtype = _sad_dtype(block_size)
+        self.blocks = cur.reshape(self.rows, block_size, self.cols, block_size).swapaxes(1, 2).reshape(
+            -1, block_size, block_size)
+        ys, xs = np.mgrid[0:height:block_size, 0:width:block_size]
+        # Flat index into the padded reference of every pixel of every block at vector (0, 0)
+        within = (np.arange(block_size)[:, None] * self.stride + np.arange(block_size)[None, :])
+        corners = (ys.ravel() + search_range) * self.stride + xs.ravel() + search_range
+        self.index = corners[:, None, None] + within[None]
+
+    def sad(self, selection, vectors):
+        """SAD of blocks[selection] at (n, 2) vectors."""
+        shift = vectors[:, 1].astype(np.intp) * self.stride + vectors[:, 0]
+        candidate = self.ref.take(self.index[selection] + shift[:, None, None])
+        cur = self.blocks[selection]
+        return (np.maximum(cur, candidate) - np.minimum(cur, candidate)).sum(axis=(1, 2), dtype=self.dtype)
+
+    # Move each selected block to the best of pattern around its vector, returning which moved
+    def step(self, field, selection, pattern):
+        vectors = field[selection]
+        candidates = np.clip(vectors[None] + np.array(pattern, np.int16)[:, None], -self.search_range,
+                             self.search_range)
+        sads = np.stack([self.sad(selection, candidate) for candidate in candidates])
+        # pattern[0] is the current vector, kept on ties
+        best = sads.argmin(axis=0)
+        field[selection] = candidates[best, np.arange(len(best))]
+        return best != 0
+
+
+def _refine(blocks, field, max_steps):
+    selection = np.arange(len(field))
+    for _ in range(max_steps):
+        moved = blocks.step(field, selection, LARGE_DIAMOND)
+        selection = selection[moved]
+        if not len(selection):
+            break
+    blocks.step(field, np.arange(len(field)), SMALL_DIAMOND)
+    return field
+
+
+def diamond_search(reference, frame, block_size=8, search_range=16, init=None):
+    """
+    Diamond search of all blocks in lockstep: large diamond steps until no block moves (blocks
+    stop individually), then one small diamond step. Starts at init, an earlier field, or zero.
+    """
+    blocks = _Blocks(reference, frame, block_size, search_range)
+    if init is not None and init.shape == (blocks.rows, blocks.cols, 2):
+        field = init.reshape(-1, 2).astype(np.int16)
+    else:
+        field = np.zeros((blocks.rows * blocks.cols, 2), np.int16)
+    return _refine(blocks, field, search_range).reshape(blocks.rows, blocks.cols, 2)
+
+
+def hierarchical_search(reference, frame, block_size=8, search_range=16, levels=3):
+    """
+    Full search of the top of a 2x pyramid with a range scaled down to match, then at each
+    finer level the doubled vectors are refined with a small diamond search.
+    """
+    pyramid = [(luma(reference), luma(frame))]
+    for _ in range(levels - 1):
+        ref, cur = pyramid[-1]
+        if min(cur.shape) < 2 * block_size:
+            break
+        pyramid.append((_half(ref), _half(cur)))
+    top = len(pyramid) - 1
+    field = full_search(*pyramid[top], block_size, max(search_range >> top, 1))
+    for level in range(top - 1, -1, -1):
+        blocks = _Blocks(*pyramid[level], block_size, search_range)
+        # A block at this level is a quarter of a block of the coarser one
+        coarse = np.repeat(np.repeat(field, 2, axis=0), 2, axis=1)
+        coarse = np.pad(coarse, ((0, max(blocks.rows - coarse.shape[0], 0)), (0, max(blocks.cols - coarse.shape[1], 0)),
+                                 (0, 0)), "edge")[:blocks.rows, :blocks.cols]
+        field = np.clip(2 * coarse, -search_range, search_range).reshape(-1, 2).astype(np.int16)
+        field = _refine(blocks, field, 2).reshape(blocks.rows, blocks.cols, 2)
+    return field
+
+
+def _half(frame):
+    frame = _pad(frame, 2, 0).astype(np.uint16)
+    return ((frame[0::2, 0::2] + frame[1::2, 0::2] + frame[0::2, 1::2] + frame[1::2, 1::2] + 2) >> 2).astype(np.uint8)
+
+
+def to_nvenc(field, block_size, size):
+    """
+    Field of a frame of size (width, height) resampled to MV_NVENC's output image: (2 *
+    ceil(h / 16), 2 * ceil(w / 16), 3) uint8, one pixel per 8x8 partition.
+    """
+    width, height = size
+    rows, cols = 2 * -(-height // 16), 2 * -(-width // 16)
+    # The block containing the center of each partition
+    ys = np.minimum((np.arange(rows) * NVENC_PARTITION + NVENC_PARTITION // 2) // block_size, field.shape[0] - 1)
+    xs = np.minimum((np.arange(cols) * NVENC_PARTITION + NVENC_PARTITION // 2) // block_size, field.shape[1] - 1)
+    image = np.full((rows, cols, 3), 127, np.uint8)
+    image[..., :2] = np.clip(field[ys[:, None], xs[None, :]].astype(np.int32) + 127, 0, 255)
+    return image
+
+
+def from_nvenc(image):
+    """(rows, cols, 2) field of whole-pixel vectors from an MV_NVENC output image."""
+    return np.asarray(image)[..., :2].astype(np.int16) - 127
+
+
+def compare(field, expected):
+    """Agreement of two fields of the same shape, e.g. from_nvenc() of this tool and of MV_NVENC."""
+    error = np.hypot(*(field.astype(np.float64) - expected).transpose(2, 0, 1))
+    return {
+        "vectors": error.size,
+        "exact": float(np.mean(error == 0)),
+        "within_1px": float(np.mean(error <= 1.5)),
+        "mean_error_px": float(error.mean()),
+    }
+
+
+def _load(path):
+    from PIL import Image
+
+    with Image.open(path) as image:
+        return np.asarray(image.convert("RGB"))
+
+
+def _save(path, image):
+    from PIL import Image
+
+    Image.fromarray(image).save(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", help="ref_file in_file output_file, as for mv_nvenc")
+    parser.add_argument("--method", choices=METHODS, default="diamond")
+    parser.add_argument("--block-size", type=int, default=8)
+    parser.add_argument("--range", dest="search_range", type=int, default=16, help="search range in pixels")
+    parser.add_argument("--levels", type=int, default=3, help="pyramid levels of the hierarchical search")
+    parser.add_argument("--sequence", nargs="+", help="images (or glob patterns) of a sequence, in order")
+    parser.add_argument("--output-dir", default=".", help="where --sequence writes mv_<n>.png")
+    parser.add_argument("--compare", nargs=2, metavar=("MV_PNG", "EXPECTED_PNG"),
+                        help="compare two MV_NVENC format vector images")
+    args = parser.parse_args()
+
+    if args.compare:
+        print(compare(from_nvenc(_load(args.compare[0])), from_nvenc(_load(args.compare[1]))))
+        return
+    matcher = BlockMatcher(args.block_size, args.search_range, args.method, args.levels)
+    if args.sequence:
+        paths = [path for pattern in args.sequence for path in sorted(glob.glob(pattern)) or [pattern]]
+        os.makedirs(args.output_dir, exist_ok=True)
+        for number, path in enumerate(paths):
+            frame = _load(path)
+            field = matcher.update(frame)
+            if field is not None:
+                output = os.path.join(args.output_dir, "mv_%04d.png" % number)
+                _save(output, to_nvenc(field, args.block_size, (frame.shape[1], frame.shape[0])))
+                print("Motion vector write to file: " + output)
+        return
+    if len(args.files) != 3:
+        parser.error("expected ref_file in_file output_file, --sequence or --compare")
+    reference, frame = _load(args.files[0]), _load(args.files[1])
+    field = matcher.estimate(reference, frame)
+    _save(args.files[2], to_nvenc(field, args.block_size, (frame.shape[1], frame.shape[0])))
+    print("Motion vector write to file: " + args.files[2])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Speed and accuracy of the block_matching.py searches.
+
+Each frame pair is a smooth random texture moved by a global shift, with a square moving the
+other way in front of it, so the true vector of every block is known. For every method and
+block size this reports blocks per second and, on MV_NVENC's 8x8 partition grid, how many
+vectors match the truth exactly and how many match the full search:
+    python3 mv_benchmark.py --sizes 640x480 1280x720
+Given an MV_NVENC run on the same pair, the fields of every method are compared to it too:
+    python3 mv_benchmark.py --nvenc ref.png in.png mv_nvenc.png
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from block_matching import METHODS, BlockMatcher, _load, compare, from_nvenc, to_nvenc
+
+BACKGROUND_MOTION = (5, -3)
+SQUARE_MOTION = (-7, 4)
+
+
+# Reference and input frames of size (width, height) and the true field on the NVENC grid
+def synthetic_pair(size, seed=0, scale=8):
+    from PIL import Image
+
+    width, height = size
+    margin = 32
+    rng = np.random.default_rng(seed)
+    noise = rng.integers(0, 256, ((height + 2 * margin) // scale + 2, (width + 2 * margin) // scale + 2), np.uint8)
+    texture = np.asarray(Image.fromarray(noise).resize((noise.shape[1] * scale, noise.shape[0] * scale),
+                                                       Image.Resampling.BICUBIC))
+    square = rng.integers(0, 256, (height // 3, height // 3), np.uint8)
+
+    # A frame shows texture at -offset, the input frame being the reference moved by the motion
+    def frame(background, square_at):
+        image = texture[margin - background[1]:margin - background[1] + height,
+                        margin - background[0]:margin - background[0] + width].copy()
+        x, y = square_at
+        image[y:y + square.shape[0], x:x + square.shape[1]] = square
+        return image
+
+    square_at = (width // 3, height // 3)
+    reference = frame((0, 0), square_at)
+    moved = (square_at[0] + SQUARE_MOTION[0], square_at[1] + SQUARE_MOTION[1])
+    frame_in = frame(BACKGROUND_MOTION, moved)
+
+    # Vectors point from the input block to where it was in the reference
+    rows, cols = 2 * -(-height // 16), 2 * -(-width // 16)
+    truth = np.empty((rows, cols, 2), np.int16)
+    truth[:] = (-BACKGROUND_MOTION[0], -BACKGROUND_MOTION[1])
+    ys, xs = np.mgrid[0:rows, 0:cols] * 8
+    inside = ((xs >= moved[0]) & (xs + 8 <= moved[0] + square.shape[1])
+              & (ys >= moved[1]) & (ys + 8 <= moved[1] + square.shape[0]))
+    truth[inside] = (-SQUARE_MOTION[0], -SQUARE_MOTION[1])
+    # Partitions straddling the square's edges or uncovered background have no single truth
+    known = inside | ~((xs + 8 > moved[0] - 16) & (xs < moved[0] + square.shape[1] + 16)
+                       & (ys + 8 > moved[1] - 16) & (ys < moved[1] + square.shape[0] + 16))
+    known[:2], known[-2:], known[:, :2], known[:, -2:] = False, False, False, False
+    return reference, frame_in, truth, known
+
+
+def run(matcher, reference, frame_in, repeat):
+    matcher.estimate(reference, frame_in)  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        field = matcher.estimate(reference, frame_in)
+    return field, (time.perf_counter() - start) / repeat
+
+
+def parse_size(value):
+    width, height = (int(v) for v in value.lower().split("x"))
+    return width, height
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=parse_size, nargs="+", default=((640, 480), (1280, 720)))
+    parser.add_argument("--block-sizes", type=int, nargs="+", default=(8, 16))
+    parser.add_argument("--range", dest="search_range", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--nvenc", nargs=3, metavar=("REF", "IN", "MV_PNG"),
+                        help="also compare every method with an MV_NVENC output for REF and IN")
+    args = parser.parse_args()
+
+    print(f"{'size':<11}{'method':<14}{'block':>6}{'ms/frame':>10}{'blocks/s':>12}{'truth':>8}{'=full':>8}")
+    for size in args.sizes:
+        reference, frame_in, truth, known = synthetic_pair(size)
+        for block_size in args.block_sizes:
+            full = None
+            for method in METHODS:
+                matcher = BlockMatcher(block_size, args.search_range, method)
+                field, seconds = run(matcher, reference, frame_in, args.repeat if method != "full" else 1)
+                grid = from_nvenc(to_nvenc(field, block_size, size))
+                full = grid if method == "full" else full
+                correct = np.mean((grid == truth).all(axis=2)[known])
+                agree = np.mean((grid == full).all(axis=2))
+                print(f"{'%dx%d' % size:<11}{method:<14}{block_size:>6}{1000 * seconds:>10.1f}"
+                      f"{field.shape[0] * field.shape[1] / seconds:>12.0f}{100 * correct:>7.1f}%{100 * agree:>7.1f}%")
+
+    if args.nvenc:
+        reference, frame_in = _load(args.nvenc[0]), _load(args.nvenc[1])
+        expected = from_nvenc(_load(args.nvenc[2]))
+        size = (frame_in.shape[1], frame_in.shape[0])
+        for method in METHODS:
+            field = BlockMatcher(8, args.search_range, method).estimate(reference, frame_in)
+            print("MV_NVENC vs %s: %s" % (method, compare(from_nvenc(to_nvenc(field, 8, size)), expected)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+"""
+Offline benchmark and regression checks of the PiTools BLE services, on a plain Linux box
+without Bluetooth hardware.
+
+Starts a private dbus-daemon, serves mock_bluez.py on it and runs gatt_server.py,
+gatt_server_simple.py and simple-agent.py with DBUS_SYSTEM_BUS_ADDRESS pointing at it. For each
+GATT server it measures the time from process start to the advertisement registered, the
+latency of GetManagedObjects and the throughput of reading every readable characteristic in
+MTU sized slices. For the agent it measures the rate it takes Device1 PropertiesChanged
+signals at during a burst mixed with adapter signals it should never see, how long an agent
+call waits behind the burst, and how long after a connection discoverable mode goes off. The
+mock ends discoverable mode after DiscoverableTimeout as bluetoothd does, scaled down to
+milliseconds, so a service that leaves the timeout at its default fails. Exits 1 when a check
+fails:
+    python3 ble_benchmark.py --signals 20000 --reads 2
+Needs the dbus-daemon binary and the dbus-python and PyGObject packages (e.g. apt install
+dbus python3-dbus python3-gi), for this script and for the services it starts.
+"""
+
+import argparse
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import dbus
+    import dbus.bus
+
+    from gatt import ATT_READ_HEADER, BLUEZ_SERVICE, DBUS_OM_IFACE, GATT_CHRC_IFACE
+    from mock_bluez import MOCK_IFACE, device_path
+except ImportError as e:
+    sys.exit("ble_benchmark.py needs dbus-python and PyGObject (apt install python3-dbus python3-gi): %s" % e)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVERS = ("gatt_server.py", "gatt_server_simple.py")
+AGENT = "simple-agent.py"
+AGENT_INTERFACE = "org.bluez.Agent1"
+DEBOUNCE = 0.5  # DEBOUNCE_MS of simple-agent.py
+TIME_SCALE = 0.001  # of the mock's DiscoverableTimeout, 180 s become 180 ms
+DEFAULT_DISCOVERABLE_TIMEOUT = 180
+AGENT_STATS = re.compile(r"signals_received (\d+) signals_acted_on (\d+) toggles (\d+) connected (\d+)")
+
+BUS_CONFIG = """<!DOCTYPE busconfig PUBLIC "-//freedesktop//DTD D-Bus Bus Configuration 1.0//EN"
+ "http://www.freedesktop.org/standards/dbus/1.0/busconfig.dtd">
+<busconfig>
+  <type>session</type>
+  <listen>unix:path=%s</listen>
+  <auth>EXTERNAL</auth>
+  <policy context="default">
+    <allow send_destination="*"/>
+    <allow own="*"/>
+  </policy>
+</busconfig>
+"""
+
+
+def start_bus(directory):
+    if shutil.which("dbus-daemon") is None:
+        raise RuntimeError("dbus-daemon not found on PATH (apt install dbus)")
+    config = os.path.join(directory, "bus.conf")
+    with open(config, "w") as f:
+        f.write(BUS_CONFIG % os.path.join(directory, "bus"))
+    daemon = subprocess.Popen(["dbus-daemon", "--config-file=" + config, "--nofork", "--print-address"],
+                              stdout=subprocess.PIPE, text=True)
+    address = daemon.stdout.readline().strip()
+    if not address:
+        raise RuntimeError("dbus-daemon did not start")
+    return daemon, address
+
+
+def start(script, env, stdout=subprocess.DEVNULL, stderr=None):
+    return subprocess.Popen([sys.executable, os.path.join(HERE, script)], env=env, stdout=stdout, stderr=stderr,
+                            text=True)
+
+
+def stop(process):
+    process.terminate()
+    try:
+        process.wait(5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+# Registrations of the mock once all of names are there
+def wait_for_registration(mock, process, names, timeout=10.0):
+    end = time.monotonic() + timeout
+    while True:
+        registrations = mock.Registrations()
+        if all(name in registrations for name in names):
+            return registrations
+        if process.poll() is not None:
+            raise RuntimeError("exited with status %d before registering" % process.returncode)
+        if time.monotonic() > end:
+            raise RuntimeError("not registered after %.0f s" % timeout)
+        time.sleep(0.005)
+
+
+# Discoverable mode has to outlast the adapter's default DiscoverableTimeout
+def check_stays_discoverable(mock, name, failures):
+    time.sleep(DEFAULT_DISCOVERABLE_TIMEOUT * TIME_SCALE + 0.2)
+    stats = mock.Stats()
+    if not stats["discoverable"]:
+        failures.append("%s: discoverable mode ended after DiscoverableTimeout (%d s)"
+                        % (name, stats["discoverable_timeout"]))
+
+
+def wait_until(predicate, timeout=5.0):
+    end = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return {
+        "p50": samples[len(samples) // 2],
+        "p99": samples[min(len(samples) - 1, len(samples) * 99 // 100)],
+        "max": samples[-1],
+    }
+
+
+# Reads and bytes per second reading each readable characteristic whole, in slices of
+# mtu - 1 bytes as BlueZ does; also returns characteristics whose slices did not add up to
+# the value in objects
+def read_throughput(bus, sender, objects, seconds, mtu):
+    characteristics = {}
+    for path, interfaces in objects.items():
+        properties = interfaces.get(GATT_CHRC_IFACE)
+        if properties and "read" in properties["Flags"]:
+            characteristics[path] = (bus.get_object(sender, path, introspect=False), bytes(properties["Value"]))
+    reads = read_bytes = 0
+    mismatched = set()
+    start_time = time.monotonic()
+    end = start_time + seconds
+    while time.monotonic() < end and characteristics:
+        for path, (characteristic, expected) in characteristics.items():
+            value = b""
+            while True:
+                chunk = characteristic.ReadValue({"offset": dbus.UInt16(len(value)), "mtu": dbus.UInt16(mtu)},
+                                                 dbus_interface=GATT_CHRC_IFACE)
+                reads += 1
+                read_bytes += len(chunk)
+                value += bytes(chunk)
+                if len(chunk) < mtu - ATT_READ_HEADER:
+                    break
+            if value != expected:
+                mismatched.add(path)
+    elapsed = time.monotonic() - start_time
+    return reads / elapsed, read_bytes / elapsed, len(characteristics), sorted(mismatched)
+
+
+def bench_server(bus, mock, env, script, args, failures):
+    mock.Reset()
+    started = time.monotonic()
+    process = start(script, env, stdout=None if args.verbose else subprocess.DEVNULL)
+    try:
+        registrations = wait_for_registration(mock, process, ("application", "advertisement"))
+        application = registrations["application"]
+        print("%s: advertising after %.0f ms (application registered after %.0f ms, %d objects)"
+              % (script, (registrations["advertisement"]["time"] - started) * 1000,
+                 (application["time"] - started) * 1000, application["objects"]))
+        stats = mock.Stats()
+        if not stats["powered"] or not stats["discoverable"]:
+            failures.append("%s: adapter not powered and discoverable" % script)
+        else:
+            check_stays_discoverable(mock, script, failures)
+
+        manager = dbus.Interface(bus.get_object(application["sender"], application["path"], introspect=False),
+                                 DBUS_OM_IFACE)
+        latencies = []
+        for _ in range(args.calls):
+            call_start = time.monotonic()
+            objects = manager.GetManagedObjects()
+            latencies.append(time.monotonic() - call_start)
+        print("  GetManagedObjects  p50 %.2f ms  p99 %.2f ms  max %.2f ms"
+              % tuple(value * 1000 for value in percentiles(latencies).values()))
+
+        reads, read_bytes, count, mismatched = read_throughput(bus, application["sender"], objects, args.reads,
+                                                               args.mtu)
+        print("  ReadValue          %.0f reads/s  %.0f bytes/s  (%d characteristics, MTU %d)"
+              % (reads, read_bytes, count, args.mtu))
+        for path in mismatched:
+            failures.append("%s: reading %s in slices does not give its value" % (script, path))
+    finally:
+        stop(process)
+
+
+class AgentLog(threading.Thread):
+    """Reads simple-agent.py's log, keeping the counters it logs on SIGUSR1."""
+
+    def __init__(self, process, verbose=False):
+        super().__init__(daemon=True)
+        self.process = process
+        self.verbose = verbose
+        self.stats = None
+        self.reports = 0
+        self._condition = threading.Condition()
+
+    def run(self):
+        for line in self.process.stderr:
+            if self.verbose:
+                sys.stderr.write(line)
+            match = AGENT_STATS.search(line)
+            if match:
+                with self._condition:
+                    self.stats = dict(zip(("signals_received", "signals_acted_on", "toggles", "connected"),
+                                          map(int, match.groups())))
+                    self.reports += 1
+                    self._condition.notify_all()
+
+    # Counters of the agent now
+    def request(self, timeout=60.0):
+        with self._condition:
+            reports = self.reports
+            self.process.send_signal(signal.SIGUSR1)
+            if not self._condition.wait_for(lambda: self.reports > reports, timeout):
+                raise RuntimeError("no statistics from the agent")
+            return self.stats
+
+
+def bench_agent(bus, mock, env, args, failures):
+    mock.Reset()
+    started = time.monotonic()
+    process = start(AGENT, env, stdout=None if args.verbose else subprocess.DEVNULL, stderr=subprocess.PIPE)
+    log = AgentLog(process, args.verbose)
+    log.start()
+    try:
+        registration = wait_for_registration(mock, process, ("agent",))["agent"]
+        print("%s: agent registered after %.0f ms" % (AGENT, (registration["time"] - started) * 1000))
+        if not wait_until(lambda: mock.Stats()["discoverable"]):
+            failures.append("%s: not discoverable without connections" % AGENT)
+        else:
+            check_stays_discoverable(mock, AGENT, failures)
+        agent = dbus.Interface(bus.get_object(registration["sender"], registration["path"], introspect=False),
+                               AGENT_INTERFACE)
+
+        before = log.request()
+        sets_before = mock.Stats()["discoverable_sets"]
+        burst_start = time.monotonic()
+        noise = mock.EmitSignals(args.signals, args.connect_every, args.noise, timeout=600)
+        # Queued behind the burst in the agent's connection
+        call_start = time.monotonic()
+        agent.RequestPinCode(dbus.ObjectPath(device_path(0)), timeout=600)
+        call_latency = time.monotonic() - call_start
+        wait_until(lambda: log.request()["signals_received"] - before["signals_received"] >= args.signals,
+                   timeout=600)
+        elapsed = time.monotonic() - burst_start
+        time.sleep(DEBOUNCE + 0.2)
+        after = log.request()
+        print("  PropertiesChanged  %d signals in %.2f s, %.0f signals/s, %d acted on, %d adapter signals filtered"
+              % (args.signals, elapsed, args.signals / elapsed,
+                 after["signals_acted_on"] - before["signals_acted_on"], noise))
+        print("  RequestPinCode     answered %.0f ms after the burst was sent" % (call_latency * 1000))
+        if after["signals_received"] - before["signals_received"] != args.signals:
+            failures.append("%s: received %d signals for %d device signals"
+                            % (AGENT, after["signals_received"] - before["signals_received"], args.signals))
+
+        # The burst's connections flap far faster than the debounce, so discoverable mode
+        # changes at most once, when device 0 is left connected, and once more on disconnecting
+        mock.SetConnected(0, False)
+        time.sleep(DEBOUNCE + 0.2)
+        burst_sets = mock.Stats()["discoverable_sets"] - sets_before
+        connected_at = mock.SetConnected(1, True)
+        if not wait_until(lambda: not mock.Stats()["discoverable"]):
+            failures.append("%s: still discoverable with a device connected" % AGENT)
+        delay = mock.Stats()["last_discoverable_set"] - connected_at
+        print("  Discoverable       %d changes for the burst, off %.0f ms after a connection (debounce %.0f ms)"
+              % (burst_sets, delay * 1000, DEBOUNCE * 1000))
+        if burst_sets > 2:
+            failures.append("%s: discoverable mode changed %d times for the burst" % (AGENT, burst_sets))
+        if not DEBOUNCE <= delay < DEBOUNCE + 0.25:
+            failures.append("%s: discoverable mode went off %.0f ms after a connection" % (AGENT, delay * 1000))
+        mock.SetConnected(1, False)
+        if not wait_until(lambda: mock.Stats()["discoverable"]):
+            failures.append("%s: not discoverable again after the disconnection" % AGENT)
+        else:
+            check_stays_discoverable(mock, AGENT, failures)
+    finally:
+        stop(process)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=1000, help="GetManagedObjects calls timed per server")
+    parser.add_argument("--reads", type=float, default=2.0, help="seconds of characteristic reads per server")
+    parser.add_argument("--mtu", type=int, default=247, help="ATT MTU of the reads")
+    parser.add_argument("--signals", type=int, default=20000, help="device signals in the agent's burst")
+    parser.add_argument("--connect-every", type=int, default=100,
+                        help="every how many signals of the burst a device connects or disconnects")
+    parser.add_argument("--noise", type=int, default=2, help="adapter signals sent along with each device signal")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the services")
+    args = parser.parse_args()
+
+    failures = []
+    processes = []
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            daemon, address = start_bus(directory)
+            processes.append(daemon)
+            env = dict(os.environ, DBUS_SYSTEM_BUS_ADDRESS=address, PYTHONUNBUFFERED="1")
+            mock_process = subprocess.Popen([sys.executable, os.path.join(HERE, "mock_bluez.py"),
+                                             "--time-scale", str(TIME_SCALE)],
+                                            env=env, stdout=subprocess.PIPE, text=True)
+            processes.append(mock_process)
+            if mock_process.stdout.readline().strip() != "ready":
+                raise RuntimeError("mock_bluez.py did not start")
+            bus = dbus.bus.BusConnection(address)
+            # Introspected, so plain ints go out with the signatures of the test interface
+            mock = dbus.Interface(bus.get_object(BLUEZ_SERVICE, "/org/bluez"), MOCK_IFACE)
+
+            for script in SERVERS:
+                try:
+                    bench_server(bus, mock, env, script, args, failures)
+                except (RuntimeError, dbus.exceptions.DBusException) as e:
+                    failures.append("%s: %s" % (script, e))
+            try:
+                bench_agent(bus, mock, env, args, failures)
+            except (RuntimeError, dbus.exceptions.DBusException) as e:
+                failures.append("%s: %s" % (AGENT, e))
+        except RuntimeError as e:
+            sys.exit("ble_benchmark.py: %s" % e)
+        finally:
+            for process in reversed(processes):
+                stop(process)
+
+    for failure in failures:
+        print("FAIL " + failure)
+    if failures:
+        sys.exit(1)
+    print("all checks passed")
+
+
+if __name__ == "__main__":
+    main()
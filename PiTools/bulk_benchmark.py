@@ -0,0 +1,90 @@
+"""
+Simulated throughput of the bulk transfer protocol for different MTUs and windows.
+
+BulkSender and BulkReceiver run unchanged over a model of a BLE connection: every connection
+interval the Pi sends up to `packets` link layer packets of queued notifications (split into
+link layer payloads of 27 bytes, or 251 with data length extension) and the host's control
+writes go the other way. BlueZ queues at most `queue` notifications and drops the rest, and
+each notification can be lost with probability `loss`, so credits and NAK recovery are
+exercised as well. The Pi caps windows at --max-window:
+    python3 bulk_benchmark.py --size 200000 --interval 15 --packets 6
+"""
+
+import argparse
+import collections
+import random
+
+from bulk_transfer import ATT_NOTIFY_HEADER, BulkReceiver, BulkSender
+
+L2CAP_HEADER = 4
+MTUS = (23, 185, 247, 517)
+WINDOWS = (1, 4, 8, 16, 32, 64)
+
+
+# Seconds to move payload of size bytes, with sender and receiver statistics
+def simulate(size, mtu, window, interval=0.015, packets=6, ll_payload=251, queue=64, loss=0.0, max_window=32,
+             seed=0):
+    rng = random.Random(seed)
+    payload = bytes(rng.getrandbits(8) for _ in range(size))
+    sender = BulkSender({"payload": lambda: payload}, max_window=max_window)
+    now = 0.0
+    receiver = BulkReceiver("payload", window=window, timeout=0.5, clock=lambda: now)
+    tx_queue = collections.deque()  # notifications queued in BlueZ, in link layer packets
+    to_pi = [receiver.open_message()]  # control writes for the next connection event
+    dropped = 0
+    while not receiver.done:
+        now += interval
+        if now > 3600:
+            raise RuntimeError("transfer stalled")
+        # Host to Pi: control writes of the last interval
+        control, data = [], []
+        for message in to_pi:
+            replies, chunks = sender.handle(message, mtu)
+            control += replies
+            data += chunks
+        to_pi = []
+        for is_control, notification in [(True, message) for message in control] + [(False, chunk) for chunk in data]:
+            if len(tx_queue) >= queue:
+                dropped += 1
+                continue
+            packets_needed = -(-(len(notification) + ATT_NOTIFY_HEADER + L2CAP_HEADER) // ll_payload)
+            tx_queue.append((is_control, notification, packets_needed))
+        # Pi to host: as many notifications as fit this connection event
+        budget = packets
+        while tx_queue and tx_queue[0][2] <= budget:
+            is_control, notification, packets_needed = tx_queue.popleft()
+            budget -= packets_needed
+            if rng.random() < loss:
+                continue
+            to_pi += receiver.on_control(notification) if is_control else receiver.on_data(notification)
+        to_pi += receiver.tick()
+    if bytes(receiver.data) != payload:
+        raise RuntimeError("payload corrupted")
+    return now, dict(sender.stats(), dropped=dropped, naks=receiver.naks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=100_000, help="payload bytes")
+    parser.add_argument("--mtus", type=int, nargs="+", default=MTUS)
+    parser.add_argument("--windows", type=int, nargs="+", default=WINDOWS)
+    parser.add_argument("--interval", type=float, default=15.0, help="connection interval in ms")
+    parser.add_argument("--packets", type=int, default=6, help="link layer packets per connection event")
+    parser.add_argument("--no-dle", action="store_true", help="27 byte link layer payloads (no data length extension)")
+    parser.add_argument("--queue", type=int, default=64, help="notifications BlueZ queues before dropping")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability a notification is lost")
+    parser.add_argument("--max-window", type=int, default=32, help="largest window the Pi grants")
+    args = parser.parse_args()
+
+    ll_payload = 27 if args.no_dle else 251
+    print(f"{'MTU':>5}{'window':>8}{'bytes/s':>10}{'seconds':>9}{'resent':>8}{'dropped':>9}{'NAKs':>6}")
+    for mtu in args.mtus:
+        for window in args.windows:
+            seconds, stats = simulate(args.size, mtu, window, args.interval / 1000, args.packets, ll_payload,
+                                      args.queue, args.loss, args.max_window)
+            print(f"{mtu:>5}{window:>8}{args.size / seconds:>10.0f}{seconds:>9.2f}{stats['resent_chunks']:>8}"
+                  f"{stats['dropped']:>9}{stats['naks']:>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Host side receiver of the bulk transfer service of gatt_server.py, using bleak
+(pip install bleak). Downloads a payload by name, e.g. a file shared with
+gatt_server.py --share log=/var/log/syslog:
+    python3 bulk_receiver.py AA:BB:CC:DD:EE:FF log -o syslog.txt
+When the connection drops, it reconnects and resumes where it stopped; --resume continues an
+earlier partial download of the output file.
+"""
+
+import argparse
+import asyncio
+import os
+import time
+
+from bulk_transfer import BULK_CONTROL_UUID, BULK_DATA_UUID, BulkError, BulkReceiver
+
+
+async def receive(address, receiver, retries=5):
+    from bleak import BleakClient
+
+    failures = 0
+    while not receiver.done:
+        try:
+            async with BleakClient(address) as client:
+                messages = asyncio.Queue()
+
+                async def write(replies):
+                    for reply in replies:
+                        await client.write_gatt_char(BULK_CONTROL_UUID, reply, response=False)
+
+                await client.start_notify(BULK_CONTROL_UUID, lambda _, data: messages.put_nowait((True, bytes(data))))
+                await client.start_notify(BULK_DATA_UUID, lambda _, data: messages.put_nowait((False, bytes(data))))
+                print(f"connected, MTU {client.mtu_size}, starting at byte {receiver.received}")
+                await write([receiver.open_message()])
+                while not receiver.done:
+                    try:
+                        is_control, data = await asyncio.wait_for(messages.get(), receiver.timeout / 4)
+                    except asyncio.TimeoutError:
+                        await write(receiver.tick())
+                        continue
+                    await write(receiver.on_control(data) if is_control else receiver.on_data(data))
+        except BulkError:
+            raise
+        except Exception as e:
+            failures += 1
+            if failures > retries:
+                raise
+            print(f"connection lost ({e}), resuming at byte {receiver.received}")
+            await asyncio.sleep(1.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("address", help="Bluetooth address of the Pi")
+    parser.add_argument("name", help="payload name shared by gatt_server.py")
+    parser.add_argument("-o", "--output", help="output file (default: the payload name)")
+    parser.add_argument("--window", type=int, default=16, help="chunks in flight")
+    parser.add_argument("--resume", action="store_true", help="append to a partial output file")
+    parser.add_argument("--retries", type=int, default=5, help="reconnections before giving up")
+    args = parser.parse_args()
+
+    output = args.output or args.name
+    resume = args.resume and os.path.exists(output)
+    with open(output, "ab" if resume else "wb") as sink:
+        receiver = BulkReceiver(args.name, window=args.window, sink=sink)
+        if resume:
+            receiver.received = os.path.getsize(output)
+        start = time.monotonic()
+        first = receiver.received
+        asyncio.run(receive(args.address, receiver, args.retries))
+    seconds = time.monotonic() - start
+    received = receiver.received - first
+    print(f"{output}: {received} bytes in {seconds:.1f} s, {received / seconds:.0f} bytes/s, "
+          f"{receiver.naks} NAKs, {receiver.opens} opens")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""
+Protocol of the GATT bulk transfer service, shared by gatt_server.py (BulkSender) and host side
+receivers (BulkReceiver). Plain Python, no D-Bus or BLE stack needed.
+
+A payload is streamed as notifications of the data characteristic, each one a 16 bit sequence
+number followed by up to chunk_size bytes. The host paces the stream with credits written to
+the control characteristic, so no more than `window` chunks are ever queued in BlueZ. The Pi
+caps the window the host asks for at what it is willing to queue:
+
+Control writes, host to Pi (little endian):
+    OPEN    0x01  u32 offset, u16 chunk_size (0: the most the MTU allows), u16 window, name (UTF-8)
+    ACK     0x02  u16 next_seq, u16 window   all chunks before next_seq arrived, send up to next_seq + window - 1
+    NAK     0x03  u16 next_seq, u16 window   as ACK, and chunk next_seq was lost: resend from it
+    CANCEL  0x04
+Control notifications, Pi to host:
+    INFO    0x81  u32 size, u32 offset, u16 chunk_size, u16 window   reply to OPEN
+    ERROR   0x82  message (UTF-8)
+
+Chunk n of a transfer holds payload bytes offset + n * chunk_size onwards. A transfer
+interrupted by a disconnection resumes with an OPEN at the number of bytes received.
+"""
+
+import struct
+import time
+
+BULK_SERVICE_UUID = "12345678-1234-5678-1234-56789abcdef1"
+BULK_CONTROL_UUID = "87654321-4321-6789-4321-56789abcdef1"
+BULK_DATA_UUID = "87654321-4321-6789-4321-56789abcdef2"
+
+OPEN = 0x01
+ACK = 0x02
+NAK = 0x03
+CANCEL = 0x04
+INFO = 0x81
+ERROR = 0x82
+
+ATT_NOTIFY_HEADER = 3  # opcode and handle in front of each notification
+SEQ_HEADER = 2
+DEFAULT_MTU = 23
+MAX_WINDOW = 0x7FFF  # sequence numbers wrap at 16 bits
+
+
+class BulkError(Exception):
+    pass
+
+
+# Largest chunk a notification carries at mtu
+def max_chunk_size(mtu):
+    return mtu - ATT_NOTIFY_HEADER - SEQ_HEADER
+
+
+def open_message(name, offset=0, chunk_size=0, window=16):
+    return struct.pack("<BIHH", OPEN, offset, chunk_size, window) + name.encode()
+
+
+def ack_message(next_seq, window, lost=False):
+    return struct.pack("<BHH", NAK if lost else ACK, next_seq & 0xFFFF, window)
+
+
+# Absolute chunk index of a 16 bit sequence number at or after base
+def _unwrap(seq, base):
+    return base + ((seq - base) & 0xFFFF)
+
+
+class _Transfer:
+    def __init__(self, payload, offset, chunk_size, window):
+        self.payload = payload
+        self.offset = offset
+        self.chunk_size = chunk_size
+        self.window = window
+        self.chunks = -(-(len(payload) - offset) // chunk_size)
+        self.acked = 0  # every chunk before this one arrived
+        self.next = 0  # next chunk to send
+
+    def chunk(self, index):
+        start = self.offset + index * self.chunk_size
+        return struct.pack("<H", index & 0xFFFF) + self.payload[start:start + self.chunk_size]
+
+
+class BulkSender:
+    """
+    Pi side of the protocol. payloads maps names to functions returning the bytes to send, called
+    on each OPEN. handle() takes a control write and returns the control notifications and the
+    data notifications to send in response; data only goes out within the host's credit, and
+    never more than max_window chunks past the last acknowledged one.
+    """
+
+    def __init__(self, payloads, max_window=32):
+        self.payloads = payloads
+        self.max_window = max_window
+        self.transfer = None
+        self.opened = 0
+        self.sent_chunks = 0
+        self.resent_chunks = 0
+        self.sent_bytes = 0
+
+    def handle(self, message, mtu=None):
+        if not message:
+            return [self._error("empty message")], []
+        opcode = message[0]
+        if opcode == OPEN:
+            return self._open(message, mtu)
+        if opcode in (ACK, NAK):
+            return [], self._credit(message)
+        if opcode == CANCEL:
+            self.transfer = None
+            return [], []
+        return [self._error("unknown opcode 0x%02x" % opcode)], []
+
+    def _open(self, message, mtu):
+        if len(message) < 9:
+            return [self._error("short OPEN")], []
+        offset, chunk_size, window = struct.unpack_from("<IHH", message, 1)
+        name = bytes(message[9:]).decode("utf-8", "replace")
+        provider = self.payloads.get(name)
+        if provider is None:
+            return [self._error("unknown payload %s" % name)], []
+        try:
+            payload = bytes(provider())
+        except Exception as e:
+            return [self._error("cannot read %s: %s" % (name, e))], []
+        if offset > len(payload):
+            return [self._error("offset %d past the end of %s (%d bytes)" % (offset, name, len(payload)))], []
+        limit = max_chunk_size(mtu or DEFAULT_MTU)
+        chunk_size = min(chunk_size, limit) if chunk_size else limit
+        self.transfer = _Transfer(payload, offset, chunk_size, self._window(window))
+        self.opened += 1
+        info = struct.pack("<BIIHH", INFO, len(payload), offset, chunk_size, self.transfer.window)
+        if not self.transfer.chunks:
+            self.transfer = None
+            return [info], []
+        return [info], self._ready()
+
+    def _credit(self, message):
+        transfer = self.transfer
+        if transfer is None or len(message) < 5:
+            return []
+        seq, window = struct.unpack_from("<HH", message, 1)
+        acked = _unwrap(seq, transfer.acked)
+        if acked > transfer.next:
+            return []  # not a sequence number of this transfer
+        transfer.acked = acked
+        transfer.window = self._window(window)
+        if message[0] == NAK:
+            # Go back N: everything from the lost chunk on is sent again
+            self.resent_chunks += transfer.next - acked
+            transfer.next = acked
+        if acked >= transfer.chunks:
+            self.transfer = None
+            return []
+        return self._ready()
+
+    # Chunks the credit allows now
+    def _ready(self):
+        transfer = self.transfer
+        end = min(transfer.acked + transfer.window, transfer.chunks)
+        chunks = [transfer.chunk(index) for index in range(transfer.next, end)]
+        transfer.next = max(transfer.next, end)
+        self.sent_chunks += len(chunks)
+        self.sent_bytes += sum(len(chunk) for chunk in chunks)
+        return chunks
+
+    def _window(self, requested):
+        return max(1, min(requested, self.max_window, MAX_WINDOW))
+
+    def _error(self, text):
+        return bytes([ERROR]) + text.encode()
+
+    def stats(self):
+        return {
+            "opened": self.opened,
+            "sent_chunks": self.sent_chunks,
+            "resent_chunks": self.resent_chunks,
+            "sent_bytes": self.sent_bytes,
+        }
+
+
+class BulkReceiver:
+    """
+    Host side of the protocol, independent of the BLE library. Write open_message() to the
+    control characteristic, then pass its notifications to on_control() and those of the data
+    characteristic to on_data(); write back whatever they return, and whatever tick() returns
+    when called every now and then. After a disconnection, open_message() resumes at the bytes
+    received so far.
+    """
+
+    def __init__(self, name, window=16, chunk_size=0, timeout=1.0, sink=None, clock=time.monotonic):
+        self.name = name
+        self.window = window
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.sink = sink  # optional file object the payload is written to as it arrives
+        self.clock = clock
+        self.data = bytearray() if sink is None else None
+        self.size = None
+        self.received = 0  # bytes of the payload received, where a resume starts
+        self.duplicates = 0
+        self.naks = 0
+        self.opens = 0
+        self._granted = None  # window of the current OPEN, None until its INFO arrived
+        self._expected = 0  # next chunk index of the current OPEN
+        self._credited = 0  # chunk index the last ACK was sent at
+        self._nak_sent = None
+        self._last_progress = None
+
+    @property
+    def done(self):
+        return self.size is not None and self.received >= self.size
+
+    def open_message(self):
+        self._granted = None
+        self._expected = self._credited = 0
+        self._nak_sent = None
+        self._last_progress = self.clock()
+        self.opens += 1
+        return open_message(self.name, self.received, self.chunk_size, self.window)
+
+    def cancel_message(self):
+        return bytes([CANCEL])
+
+    def on_control(self, message):
+        if message[0] == ERROR:
+            raise BulkError(bytes(message[1:]).decode("utf-8", "replace"))
+        if message[0] == INFO and self._granted is None:
+            size, offset, _, window = struct.unpack_from("<IIHH", message, 1)
+            if self.size is not None and size != self.size:
+                raise BulkError("%s changed size from %d to %d bytes" % (self.name, self.size, size))
+            if offset != self.received:
+                raise BulkError("asked for offset %d, got %d" % (self.received, offset))
+            self.size = size
+            self._granted = window
+            self._last_progress = self.clock()
+        return []
+
+    def on_data(self, message):
+        if self._granted is None or len(message) < SEQ_HEADER:
+            return []
+        index = _unwrap(struct.unpack_from("<H", message)[0], self._expected)
+        if index != self._expected:
+            if index - self._expected > MAX_WINDOW:
+                self.duplicates += 1  # an old chunk sent again
+                return []
+            # A chunk went missing, ask once for everything from it again
+            if self._nak_sent == self._expected:
+                return []
+            self._nak_sent = self._expected
+            self.naks += 1
+            return [ack_message(self._expected, self.window, lost=True)]
+        chunk = message[SEQ_HEADER:]
+        if self.sink is not None:
+            self.sink.write(chunk)
+        else:
+            self.data += chunk
+        self.received += len(chunk)
+        self._expected += 1
+        self._nak_sent = None
+        self._last_progress = self.clock()
+        # Credit back in halves of the window, and at the end so the Pi lets go of the payload
+        if self.done or self._expected - self._credited >= max(1, self._granted // 2):
+            self._credited = self._expected
+            return [ack_message(self._expected, self.window)]
+        return []
+
+    def tick(self):
+        """Messages to recover from a lost INFO, chunk or credit when nothing arrived for timeout seconds."""
+        if self.done or self._last_progress is None:
+            return []
+        now = self.clock()
+        if now - self._last_progress < self.timeout:
+            return []
+        if self._granted is None:
+            return [self.open_message()]
+        self._last_progress = now
+        self.naks += 1
+        return [ack_message(self._expected, self.window, lost=True)]
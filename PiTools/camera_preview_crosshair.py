@@ -1,63 +1,751 @@
 """
 This script shows a live preview from the camera with a red cross overlay in the center.
 
-This script depends on tk, which can be installed by running the following command on the Raspberry Pi:
+The overlay is rasterized once into a mask and alpha-blended into each captured frame in
+place (see Overlay), instead of being drawn and composited with PIL on every frame.
+overlay_benchmark.py measures the per-frame cost of both.
+
+Frames are captured on their own thread into a small ring of preallocated buffers
+(FrameRing). The Tk loop is woken for every new frame and always shows the newest one,
+frames it had no time for are dropped instead of queueing up. The window shows the display
+rate, the number of dropped frames and the capture-to-display latency.
+
+The mjpeg sink serves the overlaid frames as MJPEG over HTTP to any number of browsers: each
+frame is JPEG-encoded once, off the capture thread, and the same bytes are sent to every
+client. A slow client skips to the newest frame instead of buffering older ones:
+    python3 camera_preview_crosshair.py --sink mjpeg --port 8000    # open http://<pi>:8000/
+mjpeg_benchmark.py measures the server CPU for each additional client.
+
+Frames come from the camera, a video file or a synthetic generator, and go to the Tk window
+or to a headless sink that runs the same overlay and conversion without a display, so the
+pipeline can be profiled on any Linux box. Both report sustained fps and per-stage timings:
+    python3 camera_preview_crosshair.py                          # camera to window
+    python3 camera_preview_crosshair.py --source video --video clip.mp4 --sink headless
+    python3 camera_preview_crosshair.py --source synthetic --size 1920x1080 --fps 0 --sink headless
+pipeline_benchmark.py runs the headless pipeline over a set of configurations.
+
+The Tk window depends on tk, which can be installed by running the following command on the Raspberry Pi:
     sudo apt-get install python3-pil.imagetk
+The video source depends on OpenCV (sudo apt-get install python3-opencv).
 
 """
 
-import tkinter as tk
-from PIL import Image, ImageTk, ImageDraw
-from picamera2 import Picamera2, Preview
+import argparse
+import collections
+import http.server
+import io
+import os
+import threading
+import time
+
 import numpy as np
+from PIL import Image, ImageDraw
+
+CROSS_COLOR = (255, 0, 0, 128)  # Red with 50% transparency
+CROSS_LENGTH = 32
+CROSS_WIDTH = 3
+
+
+# Draw the red cross in the center of an overlay of the given (width, height)
+def draw_cross(draw, size, color=CROSS_COLOR, length=CROSS_LENGTH, width=CROSS_WIDTH):
+    center_x, center_y = size[0] // 2, size[1] // 2
+    draw.line((center_x - length, center_y, center_x + length, center_y), fill=color, width=width)
+    draw.line((center_x, center_y - length, center_x, center_y + length), fill=color, width=width)
+
+
+class Overlay:
+    """
+    Semi-transparent overlay rasterized once and blended into frames in place.
+
+    Each draw function is called as draw_fn(ImageDraw, (width, height)) on a transparent RGBA
+    canvas, so crosses, reticles or grids are all drawn with the usual PIL primitives. Only the
+    bounding box of the drawn pixels is kept, as premultiplied color and inverse alpha, and
+    apply() blends it into the RGB channels of a frame with integer NumPy operations on
+    preallocated buffers: out = (src * (255 - a) + color * a) / 255, rounded.
+    """
+
+    def __init__(self, size, *draw_fns):
+        canvas = Image.new("RGBA", size, (0, 0, 0, 0))
+        draw = ImageDraw.Draw(canvas)
+        for draw_fn in draw_fns:
+            draw_fn(draw, size)
+        rgba = np.asarray(canvas)
+        ys, xs = np.nonzero(rgba[..., 3])
+        self.size = size
+        self.box = None
+        if len(ys) == 0:
+            return
+        self.box = (slice(ys.min(), ys.max() + 1), slice(xs.min(), xs.max() + 1))
+        alpha = rgba[self.box][..., 3:].astype(np.uint16)
+        self._inverse_alpha = 255 - alpha
+        # + 128 rounds the division by 255 in apply()
+        self._color = rgba[self.box][..., :3].astype(np.uint16) * alpha + 128
+        self._blend = np.empty(self._color.shape, np.uint16)
+        self._carry = np.empty(self._color.shape, np.uint16)
+
+    def apply(self, frame):
+        """Blend the overlay into the RGB channels of an (h, w, 3 or 4) uint8 frame, in place."""
+        if self.box is None:
+            return frame
+        roi = frame[self.box][..., :3]
+        blend = self._blend
+        np.multiply(roi, self._inverse_alpha, out=blend)
+        blend += self._color
+        # With the + 128 above, (x + (x >> 8)) >> 8 is x / 255 rounded for every x here
+        np.right_shift(blend, 8, out=self._carry)
+        blend += self._carry
+        blend >>= 8
+        np.copyto(roi, blend, casting="unsafe")
+        return frame
+
+
+class FrameRing:
+    """
+    Small ring of preallocated frame buffers between one capture thread and one consumer.
+
+    The writer always copies into a slot that holds neither the newest frame nor the frame being
+    read, so it never waits for the consumer. The consumer always gets the newest complete frame;
+    a frame overwritten before it was read is counted in `dropped`.
+    """
+
+    def __init__(self, slots=3):
+        if slots < 3:
+            raise ValueError("FrameRing needs at least 3 slots")
+        self._cond = threading.Condition()
+        self._slots = slots
+        self._buffers = None
+        self._seq = [0] * slots
+        self._stamps = [0.0] * slots
+        self._newest = None  # slot of the newest complete frame
+        self._reading = None  # slot held by the consumer
+        self._consumed = 0  # sequence number of the last frame handed out
+        self.written = 0
+        self.dropped = 0
+
+    def write(self, frame, timestamp=None):
+        """Copy frame into the ring, stamped with its capture time (time.monotonic())."""
+        with self._cond:
+            buffers = self._buffers
+            if buffers is None or buffers.shape[1:] != frame.shape or buffers.dtype != frame.dtype:
+                # The consumer may still hold a view of the old buffers, they stay alive until released.
+                buffers = self._buffers = np.empty((self._slots,) + frame.shape, frame.dtype)
+                self._newest = None
+            slot = next(i for i in range(self._slots) if i != self._newest and i != self._reading)
+        np.copyto(buffers[slot], frame)
+        with self._cond:
+            if buffers is not self._buffers:
+                return
+            if self._newest is not None and self._seq[self._newest] > self._consumed:
+                self.dropped += 1
+            self.written += 1
+            self._seq[slot] = self.written
+            self._stamps[slot] = time.monotonic() if timestamp is None else timestamp
+            self._newest = slot
+            self._cond.notify_all()
+
+    def acquire(self, timeout=None):
+        """
+        Newest frame not handed out yet as (frame, sequence number, capture time), or None after
+        timeout seconds. The frame stays valid, and may be modified, until release().
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._newest is not None and self._seq[self._newest] > self._consumed,
+                                       timeout):
+                return None
+            self._reading = self._newest
+            self._consumed = self._seq[self._reading]
+            return self._buffers[self._reading], self._consumed, self._stamps[self._reading]
+
+    def release(self):
+        with self._cond:
+            self._reading = None
+
+
+class CaptureThread(threading.Thread):
+    """
+    Calls capture(write) in a loop, where capture hands each new frame to write() while it is
+    valid (e.g. while a camera buffer is mapped). Frames go into ring and on_frame() is called
+    after each one.
+    """
+
+    def __init__(self, capture, ring, on_frame=None):
+        super().__init__(name="capture", daemon=True)
+        self.capture = capture
+        self.ring = ring
+        self.on_frame = on_frame
+        self.error = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        try:
+            while not self._stop_event.is_set():
+                self.capture(self._write)
+        except Exception as e:
+            # Reported by the sink; EOFError is how a source says it has no more frames.
+            self.error = e
+
+    def stop(self, timeout=1.0):
+        self._stop_event.set()
+        self.join(timeout)
+
+    def _write(self, frame):
+        self.ring.write(frame)
+        if self.on_frame is not None:
+            self.on_frame()
+
+
+class TimedCapture:
+    """
+    Wraps a capture function for CaptureThread, adding how long each capture took (including
+    waiting for the frame) and how long the copy into the ring took to stats.
+    """
+
+    def __init__(self, capture, stats):
+        self.capture = capture
+        self.stats = stats
 
-# Create the main window
-root = tk.Tk()
-root.title("Camera Preview with Overlay")
-
-# Initialize Picamera2
-picam2 = Picamera2()
-picam2.start_preview(Preview.QTGL)
-config = picam2.create_preview_configuration(main={"size": (640, 480)})
-picam2.configure(config)
-picam2.start()
-
-# Function to update the image on the label
-def update_image():
-    # Get an image from the camera
-    frame = picam2.capture_array()
-    
-    # Convert to PIL image for drawing (ensure it's RGBA for transparency support)
+    def __call__(self, write):
+        def timed_write(frame):
+            start = time.perf_counter()
+            write(frame)
+            self.stats.add_stage("copy", time.perf_counter() - start)
+
+        start = time.perf_counter()
+        self.capture(timed_write)
+        self.stats.add_stage("capture", time.perf_counter() - start)
+
+
+class PreviewStats:
+    """
+    Display rate and capture-to-display latency over the last `window` seconds, plus totals
+    since the start for the summary: frames displayed, latency and time spent per stage.
+    Stages are timed from both the capture thread and the display side.
+    """
+
+    def __init__(self, window=2.0):
+        self.window = window
+        self.started = time.monotonic()
+        self.displayed = 0
+        self._lock = threading.Lock()
+        self._displayed = collections.deque()  # (display time, latency)
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+        self._stages = {}  # name -> [count, total seconds]
+
+    def add_stage(self, name, seconds):
+        with self._lock:
+            stage = self._stages.setdefault(name, [0, 0.0])
+            stage[0] += 1
+            stage[1] += seconds
+
+    def frame_displayed(self, captured_at):
+        now = time.monotonic()
+        latency = now - captured_at
+        with self._lock:
+            self.displayed += 1
+            self._latency_total += latency
+            self._latency_max = max(self._latency_max, latency)
+            self._displayed.append((now, latency))
+            while self._displayed[0][0] < now - self.window:
+                self._displayed.popleft()
+
+    def snapshot(self):
+        with self._lock:
+            displayed = list(self._displayed)
+        if len(displayed) < 2:
+            return {"fps": 0.0, "latency_ms": 0.0, "latency_p95_ms": 0.0}
+        span = displayed[-1][0] - displayed[0][0]
+        latencies = sorted(latency for _, latency in displayed)
+        return {
+            "fps": (len(displayed) - 1) / span if span > 0 else 0.0,
+            "latency_ms": 1000 * sum(latencies) / len(latencies),
+            "latency_p95_ms": 1000 * latencies[int(0.95 * (len(latencies) - 1))],
+        }
+
+    def summary(self, ring):
+        """Totals since the start; stage times are mean milliseconds per frame through that stage."""
+        elapsed = time.monotonic() - self.started
+        with self._lock:
+            return {
+                "seconds": elapsed,
+                "captured": ring.written,
+                "displayed": self.displayed,
+                "dropped": ring.dropped,
+                "capture_fps": ring.written / elapsed if elapsed > 0 else 0.0,
+                "fps": self.displayed / elapsed if elapsed > 0 else 0.0,
+                "latency_ms": 1000 * self._latency_total / self.displayed if self.displayed else 0.0,
+                "latency_max_ms": 1000 * self._latency_max,
+                "stages_ms": {name: 1000 * total / count for name, (count, total) in self._stages.items()},
+            }
+
+
+# One line report of PreviewStats.summary()
+def format_summary(summary):
+    stages = " ".join("%s %.2f" % item for item in summary["stages_ms"].items())
+    return ("%.1f fps displayed, %.1f fps captured, %d/%d dropped, latency %.1f ms (max %.1f ms), "
+            "stage ms: %s" % (summary["fps"], summary["capture_fps"], summary["dropped"], summary["captured"],
+                              summary["latency_ms"], summary["latency_max_ms"], stages))
+
+
+# Blend the cross into frame, reusing overlay if it has the frame's size. Returns the overlay used.
+def apply_overlay(frame, overlay=None):
+    size = (frame.shape[1], frame.shape[0])
+    if overlay is None or overlay.size != size:
+        overlay = Overlay(size, draw_cross)
+    overlay.apply(frame)
+    return overlay
+
+
+# RGB image of its own for a display or an encoder
+def to_rgb_image(frame):
     image = Image.fromarray(frame)
-    
-    # Create a transparent overlay
-    overlay = Image.new("RGBA", image.size, (255, 255, 255, 0))
-    draw = ImageDraw.Draw(overlay)
-
-    # Draw the red cross overlay with half transparency
-    cross_color = (255, 0, 0, 128) # Red with 50% transparency
-    center_x, center_y = image.width // 2, image.height // 2
-    line_length = 32
-    draw.line((center_x - line_length, center_y, center_x + line_length, center_y), fill=cross_color, width=3)
-    draw.line((center_x, center_y - line_length, center_x, center_y + line_length), fill=cross_color, width=3)
-    
-    # Composite the overlay onto the image
-    image.paste(overlay, (0, 0), overlay)
-
-    # Convert the image for Tkinter
-    tk_image = ImageTk.PhotoImage(image=image.convert("RGB"))  # Convert back to RGB for Tkinter compatibility
-    
-    # Update the label with the new image
-    image_label.config(image=tk_image)
-    image_label.image = tk_image
-    image_label.after(16, update_image)  # Continue updating the image every 16 ms
-
-# Setup the image label
-image_label = tk.Label(root)
-image_label.pack()
-
-# Start the update process
-update_image()
-
-# Run the Tkinter main loop
-root.mainloop()
+    return image if image.mode == "RGB" else image.convert("RGB")
+
+
+class FrameBroadcaster:
+    """
+    Newest encoded frame, shared by reference with any number of client threads. Publishing never
+    waits for a client; a client busy sending picks up whatever is newest when it is done, so it
+    skips frames instead of queueing them.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._data = None
+        self._seq = 0
+        self._closed = False
+        self.clients = 0
+        self.served = 0
+        self.sent = 0
+
+    def publish(self, data):
+        with self._cond:
+            self._data = data
+            self._seq += 1
+            self._cond.notify_all()
+
+    def next_frame(self, after_seq, timeout=None):
+        """(sequence number, data) of the first frame newer than after_seq, None once closed or after timeout."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._closed or self._seq > after_seq, timeout) or self._closed:
+                return None
+            self.sent += 1
+            return self._seq, self._data
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def connect(self):
+        with self._cond:
+            self.clients += 1
+            self.served += 1
+
+    def disconnect(self):
+        with self._cond:
+            self.clients -= 1
+
+
+class MjpegHandler(http.server.BaseHTTPRequestHandler):
+    """/ is a page showing the stream, /stream.mjpg the MJPEG stream and /frame.jpg the newest frame."""
+
+    BOUNDARY = "frame"
+    PAGE = ("<html><head><title>Camera Preview with Overlay</title></head>"
+            "<body style=\"margin:0;background:#000\"><img src=\"stream.mjpg\" style=\"max-width:100%\"></body></html>")
+
+    def do_GET(self):
+        if self.path == "/":
+            self._send(200, "text/html; charset=utf-8", self.PAGE.encode())
+        elif self.path == "/stream.mjpg":
+            self._stream()
+        elif self.path == "/frame.jpg":
+            broadcaster = self.server.broadcaster
+            broadcaster.connect()
+            try:
+                frame = broadcaster.next_frame(0, timeout=5)
+            finally:
+                broadcaster.disconnect()
+            if frame is None:
+                self.send_error(503, "no frame yet")
+            else:
+                self._send(200, "image/jpeg", frame[1])
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self):
+        broadcaster = self.server.broadcaster
+        self.send_response(200)
+        self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=" + self.BOUNDARY)
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        broadcaster.connect()
+        seq = 0
+        try:
+            while True:
+                frame = broadcaster.next_frame(seq)
+                if frame is None:
+                    break
+                seq, data = frame
+                self.wfile.write(b"--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n"
+                                 % (self.BOUNDARY.encode(), len(data)))
+                self.wfile.write(data)
+                self.wfile.write(b"\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            broadcaster.disconnect()
+
+
+# Frame sources: capture(write) functions for CaptureThread with a close() method.
+
+class Picamera2Source:
+    """Camera frames, copied into the ring straight out of the mapped camera buffer."""
+
+    def __init__(self, size=(640, 480), qt_preview=False):
+        from picamera2 import MappedArray, Picamera2, Preview
+
+        self._mapped_array = MappedArray
+        self.picam2 = Picamera2()
+        if qt_preview:
+            self.picam2.start_preview(Preview.QTGL)
+        config = self.picam2.create_preview_configuration(main={"size": size})
+        self.picam2.configure(config)
+        self.picam2.start()
+
+    def __call__(self, write):
+        with self.picam2.captured_request() as request, self._mapped_array(request, "main") as mapped:
+            write(mapped.array)
+
+    def close(self):
+        self.picam2.stop()
+        self.picam2.close()
+
+
+class VideoFileSource:
+    """
+    RGB frames decoded from a video file with OpenCV, looping at the end. Frames are paced at
+    fps, the file's own rate when None, or delivered as fast as they decode when 0.
+    """
+
+    def __init__(self, path, fps=None, loop=True):
+        import cv2
+
+        self._cv2 = cv2
+        self.capture = cv2.VideoCapture(path)
+        if not self.capture.isOpened():
+            raise ValueError("cannot open video %s" % path)
+        self.loop = loop
+        self._pacer = Pacer(self.capture.get(cv2.CAP_PROP_FPS) if fps is None else fps)
+        self._bgr = None
+        self._rgb = None
+
+    def __call__(self, write):
+        ok, self._bgr = self.capture.read(self._bgr)
+        if not ok and self.loop:
+            self.capture.set(self._cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, self._bgr = self.capture.read(self._bgr)
+        if not ok:
+            raise EOFError("end of video")
+        self._rgb = self._cv2.cvtColor(self._bgr, self._cv2.COLOR_BGR2RGB, dst=self._rgb)
+        self._pacer.wait()
+        write(self._rgb)
+
+    def close(self):
+        self.capture.release()
+
+
+class SyntheticSource:
+    """
+    Generated XBGR8888-like (h, w, 4) frames at fps, or as fast as they are taken when 0: a few
+    precomputed noise frames with a moving bar, so frames differ without costing generation time.
+    """
+
+    def __init__(self, size=(640, 480), fps=30.0, seed=0):
+        width, height = size
+        rng = np.random.default_rng(seed)
+        self._frames = [rng.integers(0, 256, (height, width, 4), dtype=np.uint8) for _ in range(4)]
+        self._frame = np.empty((height, width, 4), np.uint8)
+        self._pacer = Pacer(fps)
+        self._count = 0
+
+    def __call__(self, write):
+        frame = self._frame
+        np.copyto(frame, self._frames[self._count % len(self._frames)])
+        bar = self._count * 8 % frame.shape[1]
+        frame[:, bar:bar + 8, :3] = 255
+        self._count += 1
+        self._pacer.wait()
+        write(frame)
+
+    def close(self):
+        pass
+
+
+class Pacer:
+    """Sleeps until the next frame is due at fps; does nothing for fps 0 (or unknown)."""
+
+    def __init__(self, fps):
+        self.interval = 1.0 / fps if fps and fps > 0 else 0.0
+        self._next = None
+
+    def wait(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if self._next is None or now - self._next > self.interval:
+            # First frame, or too far behind to catch up: restart the schedule.
+            self._next = now
+        elif self._next > now:
+            time.sleep(self._next - now)
+        self._next += self.interval
+
+
+class FrameNotifier:
+    """
+    Wakes the Tk event loop from the capture thread without calling into Tk from it: the thread
+    writes a byte to a pipe watched by the Tk loop. Wake-ups for frames arriving before the loop
+    got to the previous one are coalesced.
+    """
+
+    def __init__(self, root, callback):
+        import tkinter as tk
+
+        self._callback = callback
+        self._pending = threading.Event()
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._write_fd, False)
+        root.tk.createfilehandler(self._read_fd, tk.READABLE, self._readable)
+
+    def notify(self):
+        if not self._pending.is_set():
+            self._pending.set()
+            try:
+                os.write(self._write_fd, b"\0")
+            except BlockingIOError:
+                pass
+
+    def _readable(self, fd, mask):
+        os.read(fd, 4096)
+        self._pending.clear()
+        self._callback()
+
+
+# Frame source selected by the command line arguments
+def open_source(args):
+    if args.source == "picamera2":
+        return Picamera2Source(args.size, qt_preview=args.sink == "tk" and args.qt_preview)
+    if args.source == "video":
+        if not args.video:
+            raise SystemExit("--source video needs --video PATH")
+        return VideoFileSource(args.video, fps=args.fps)
+    return SyntheticSource(args.size, fps=30.0 if args.fps is None else args.fps)
+
+
+# Overlay and convert the newest frames without a display for duration seconds
+def run_headless(ring, stats, start_capture, duration):
+    capture_thread = start_capture()
+    overlay = None
+    end = time.monotonic() + (10.0 if duration is None else duration)
+    while time.monotonic() < end and capture_thread.is_alive():
+        item = ring.acquire(timeout=0.1)
+        if item is None:
+            continue
+        frame, _, captured_at = item
+        try:
+            start = time.perf_counter()
+            overlay = apply_overlay(frame, overlay)
+            overlaid = time.perf_counter()
+            to_rgb_image(frame)
+            converted = time.perf_counter()
+        finally:
+            ring.release()
+        stats.add_stage("overlay", overlaid - start)
+        stats.add_stage("convert", converted - overlaid)
+        stats.frame_displayed(captured_at)
+
+
+# Serve the newest frames as MJPEG on port for duration seconds, or until interrupted
+def run_mjpeg(ring, stats, start_capture, duration, port=8000, quality=80):
+    broadcaster = FrameBroadcaster()
+    server = http.server.ThreadingHTTPServer(("", port), MjpegHandler)
+    server.broadcaster = broadcaster
+    threading.Thread(target=server.serve_forever, name="mjpeg-server", daemon=True).start()
+    print("streaming on http://%s:%d/" % (os.uname().nodename, server.server_address[1]), flush=True)
+    capture_thread = start_capture()
+    overlay = None
+    buffer = io.BytesIO()
+    end = None if duration is None else time.monotonic() + duration
+    try:
+        while (end is None or time.monotonic() < end) and capture_thread.is_alive():
+            item = ring.acquire(timeout=0.1)
+            if item is None:
+                continue
+            frame, _, captured_at = item
+            if not broadcaster.clients:
+                # Nobody watching, nothing to encode.
+                ring.release()
+                continue
+            try:
+                start = time.perf_counter()
+                overlay = apply_overlay(frame, overlay)
+                overlaid = time.perf_counter()
+                image = to_rgb_image(frame)
+            finally:
+                ring.release()
+            converted = time.perf_counter()
+            buffer.seek(0)
+            buffer.truncate()
+            image.save(buffer, "JPEG", quality=quality)
+            broadcaster.publish(buffer.getvalue())
+            stats.add_stage("overlay", overlaid - start)
+            stats.add_stage("convert", converted - overlaid)
+            stats.add_stage("encode", time.perf_counter() - converted)
+            stats.frame_displayed(captured_at)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broadcaster.close()
+        server.shutdown()
+        server.server_close()
+    print("served %d clients, sent %d frames" % (broadcaster.served, broadcaster.sent))
+
+
+# Show the newest frames in a Tk window until it is closed
+def run_tk(ring, stats, start_capture):
+    import tkinter as tk
+    from PIL import ImageTk
+
+    # Create the main window
+    root = tk.Tk()
+    root.title("Camera Preview with Overlay")
+
+    # Setup the image label and the statistics below it
+    image_label = tk.Label(root)
+    image_label.pack()
+    stats_label = tk.Label(root, anchor="w")
+    stats_label.pack(fill="x")
+
+    overlay = None
+    tk_image = None
+
+    # Show the newest captured frame, called by the notifier for each new frame
+    def show_frame():
+        nonlocal overlay, tk_image
+        item = ring.acquire(timeout=0)
+        if item is None:
+            return
+        frame, _, captured_at = item
+        try:
+            start = time.perf_counter()
+            overlay = apply_overlay(frame, overlay)
+            size = overlay.size
+            overlaid = time.perf_counter()
+
+            # XBGR frames would make PIL treat the X byte as alpha, so the RGB copy the headless
+            # path encodes is pasted into the same Tk photo image
+            image = to_rgb_image(frame)
+            converted = time.perf_counter()
+            if tk_image is None or (tk_image.width(), tk_image.height()) != size:
+                tk_image = ImageTk.PhotoImage(image=image)
+                image_label.config(image=tk_image)
+                image_label.image = tk_image
+            else:
+                tk_image.paste(image)
+        finally:
+            ring.release()
+        image_label.update_idletasks()
+        stats.add_stage("overlay", overlaid - start)
+        stats.add_stage("convert", converted - overlaid)
+        stats.add_stage("display", time.perf_counter() - converted)
+        stats.frame_displayed(captured_at)
+
+    def show_stats():
+        snapshot = stats.snapshot()
+        error = " | capture stopped: %s" % capture_thread.error if capture_thread.error else ""
+        stats_label.config(text="%.1f fps | %d dropped | latency %.1f ms (p95 %.1f ms)%s" % (
+            snapshot["fps"], ring.dropped, snapshot["latency_ms"], snapshot["latency_p95_ms"], error))
+        root.after(1000, show_stats)
+
+    notifier = FrameNotifier(root, show_frame)
+    capture_thread = start_capture(notifier.notify)
+    show_stats()
+
+    # Run the Tkinter main loop
+    root.mainloop()
+
+
+# Run source -> ring -> sink and return PreviewStats.summary()
+def run_pipeline(source, sink="headless", duration=None, port=8000, quality=80):
+    ring = FrameRing()
+    stats = PreviewStats()
+    threads = []
+
+    # Called by the sink once it is ready for frames
+    def start_capture(on_frame=None):
+        capture_thread = CaptureThread(TimedCapture(source, stats), ring, on_frame=on_frame)
+        threads.append(capture_thread)
+        capture_thread.start()
+        return capture_thread
+
+    try:
+        if sink == "tk":
+            run_tk(ring, stats, start_capture)
+        elif sink == "mjpeg":
+            run_mjpeg(ring, stats, start_capture, duration, port, quality)
+        else:
+            run_headless(ring, stats, start_capture, duration)
+    finally:
+        for capture_thread in threads:
+            capture_thread.stop()
+    for capture_thread in threads:
+        if capture_thread.error is not None and not isinstance(capture_thread.error, EOFError):
+            print("capture stopped: %s" % capture_thread.error)
+    return stats.summary(ring)
+
+
+def parse_size(value):
+    try:
+        width, height = (int(v) for v in value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected WIDTHxHEIGHT, got %r" % value)
+    return width, height
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", choices=("picamera2", "video", "synthetic"), default="picamera2")
+    parser.add_argument("--video", help="video file for --source video")
+    parser.add_argument("--size", type=parse_size, default=(640, 480), help="camera and synthetic frame size")
+    parser.add_argument("--fps", type=float, default=None,
+                        help="source frame rate, 0 for as fast as possible (default: the video's rate, 30 synthetic)")
+    parser.add_argument("--sink", choices=("tk", "headless", "mjpeg"), default="tk")
+    parser.add_argument("--duration", type=float, default=None,
+                        help="seconds to run the headless (default 10) or mjpeg (default until interrupted) sink")
+    parser.add_argument("--port", type=int, default=8000, help="HTTP port of the mjpeg sink")
+    parser.add_argument("--quality", type=int, default=80, help="JPEG quality of the mjpeg sink")
+    parser.add_argument("--no-qt-preview", dest="qt_preview", action="store_false",
+                        help="do not open the Picamera2 QTGL preview next to the Tk window")
+    args = parser.parse_args()
+
+    source = open_source(args)
+    try:
+        summary = run_pipeline(source, args.sink, args.duration, args.port, args.quality)
+    finally:
+        source.close()
+    print(format_summary(summary))
+
+
+if __name__ == "__main__":
+    main()
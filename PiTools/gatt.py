@@ -0,0 +1,358 @@
+import os
+import time
+
+import dbus
+import dbus.exceptions
+import dbus.service
+
+# Small framework for BlueZ GATT applications.
+#
+# Services and characteristics are declared as classes:
+#
+#     class HelloCharacteristic(Characteristic):
+#         UUID = '...'
+#         FLAGS = ('read', 'notify')
+#
+#     class HelloService(Service):
+#         UUID = '...'
+#         CHARACTERISTICS = (HelloCharacteristic,)
+#
+#     app = Application(bus, '/org/bluez/example', (HelloService,))
+#     advertisement = Advertisement(bus, '/org/bluez/example/advertisement0', [HelloService.UUID])
+#     register_peripheral(bus, app, advertisement, mainloop.quit)
+#
+# Property dictionaries are built once per object, and a value is encoded once
+# when it is set, so Get, GetAll, ReadValue and GetManagedObjects only look
+# things up. Long values are read and written in slices following the offset
+# and mtu options BlueZ passes.
+#
+# register_peripheral() brings the adapter up and registers the application
+# and the advertisement with BlueZ in D-Bus calls that are all in flight at
+# once, logging when each step completed relative to process start.
+
+BLUEZ_SERVICE = 'org.bluez'
+ADAPTER_IFACE = 'org.bluez.Adapter1'
+GATT_MANAGER_IFACE = 'org.bluez.GattManager1'
+LE_ADVERTISING_MANAGER_IFACE = 'org.bluez.LEAdvertisingManager1'
+LE_ADVERTISEMENT_IFACE = 'org.bluez.LEAdvertisement1'
+GATT_SERVICE_IFACE = 'org.bluez.GattService1'
+GATT_CHRC_IFACE = 'org.bluez.GattCharacteristic1'
+DBUS_OM_IFACE = 'org.freedesktop.DBus.ObjectManager'
+DBUS_PROP_IFACE = 'org.freedesktop.DBus.Properties'
+
+# ATT read responses carry at most MTU - 1 bytes of value
+ATT_READ_HEADER = 1
+
+class InvalidArgs(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.freedesktop.DBus.Error.InvalidArgs'
+
+class NotSupported(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.NotSupported'
+
+class NotPermitted(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.NotPermitted'
+
+class InvalidOffset(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.InvalidOffset'
+
+class InvalidValueLength(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.InvalidValueLength'
+
+# Exported object with one interface whose properties are cached in a dictionary
+class GattObject(dbus.service.Object):
+    INTERFACE = None
+
+    def __init__(self, bus, path):
+        self.path = path
+        self.bus = bus
+        dbus.service.Object.__init__(self, bus, path)
+        self.properties = self.build_properties()
+
+    def build_properties(self):
+        raise NotImplementedError
+
+    def get_path(self):
+        return dbus.ObjectPath(self.path)
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature='ss', out_signature='v')
+    def Get(self, interface, prop):
+        if interface != self.INTERFACE:
+            raise InvalidArgs('Invalid interface')
+        try:
+            return self.properties[prop]
+        except KeyError:
+            raise InvalidArgs('Invalid property')
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature='s', out_signature='a{sv}')
+    def GetAll(self, interface):
+        if interface != self.INTERFACE:
+            raise InvalidArgs('Invalid interface')
+        return self.properties
+
+    @dbus.service.signal(DBUS_PROP_IFACE, signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+class Characteristic(GattObject):
+    INTERFACE = GATT_CHRC_IFACE
+    UUID = None
+    FLAGS = ('read',)
+    MAX_LENGTH = 512  # longest attribute value ATT allows
+
+    def __init__(self, bus, path, service, value=b''):
+        self.service = service
+        self.notifying = False
+        self.value = bytes(value)
+        self._encoded = dbus.ByteArray(self.value)
+        GattObject.__init__(self, bus, path)
+
+    def build_properties(self):
+        return {
+            'Service': self.service.get_path(),
+            'UUID': dbus.String(self.UUID),
+            'Flags': dbus.Array(self.FLAGS, signature='s'),
+            'Value': self._encoded,
+            'Notifying': dbus.Boolean(self.notifying),
+        }
+
+    # Replace the value; subscribers are notified when it changed
+    def set_value(self, value):
+        value = bytes(value)
+        if value == self.value:
+            return
+        self.value = value
+        self._encoded = dbus.ByteArray(value)
+        self.properties['Value'] = self._encoded
+        if self.notifying:
+            self.PropertiesChanged(GATT_CHRC_IFACE, {'Value': self._encoded}, [])
+
+    # Send value to subscribers without keeping it, for characteristics
+    # streaming messages rather than holding a value
+    def notify(self, value):
+        if self.notifying:
+            self.PropertiesChanged(GATT_CHRC_IFACE, {'Value': dbus.ByteArray(value)}, [])
+
+    # Called before a read from offset 0, e.g. to refresh the value; reads of
+    # the following slices of a long value get the same value.
+    def on_read(self, options):
+        pass
+
+    # Called with the whole value after a write; the default keeps it
+    def on_write(self, value, options):
+        self.set_value(value)
+
+    @dbus.service.method(GATT_CHRC_IFACE, in_signature='a{sv}', out_signature='ay')
+    def ReadValue(self, options):
+        if not {'read', 'encrypt-read', 'encrypt-authenticated-read', 'secure-read'} & set(self.FLAGS):
+            raise NotPermitted('Read not permitted')
+        offset = int(options.get('offset', 0))
+        if offset == 0:
+            self.on_read(options)
+        if offset > len(self.value):
+            raise InvalidOffset('Invalid offset')
+        if offset == 0 and 'mtu' not in options:
+            return self._encoded
+        end = len(self.value)
+        if 'mtu' in options:
+            end = min(end, offset + int(options['mtu']) - ATT_READ_HEADER)
+        return dbus.ByteArray(self.value[offset:end])
+
+    @dbus.service.method(GATT_CHRC_IFACE, in_signature='aya{sv}')
+    def WriteValue(self, value, options):
+        if not {'write', 'write-without-response', 'encrypt-write', 'encrypt-authenticated-write',
+                'secure-write', 'reliable-write'} & set(self.FLAGS):
+            raise NotPermitted('Write not permitted')
+        offset = int(options.get('offset', 0))
+        if offset > len(self.value):
+            raise InvalidOffset('Invalid offset')
+        # A long write arrives as slices at increasing offsets
+        value = self.value[:offset] + bytes(value)
+        if len(value) > self.MAX_LENGTH:
+            raise InvalidValueLength('Invalid value length')
+        self.on_write(value, options)
+
+    @dbus.service.method(GATT_CHRC_IFACE)
+    def StartNotify(self):
+        if not {'notify', 'indicate'} & set(self.FLAGS):
+            raise NotSupported('Notifications not supported')
+        self.notifying = True
+        self.properties['Notifying'] = dbus.Boolean(True)
+
+    @dbus.service.method(GATT_CHRC_IFACE)
+    def StopNotify(self):
+        self.notifying = False
+        self.properties['Notifying'] = dbus.Boolean(False)
+
+class Service(GattObject):
+    INTERFACE = GATT_SERVICE_IFACE
+    UUID = None
+    PRIMARY = True
+    CHARACTERISTICS = ()
+
+    def __init__(self, bus, path):
+        GattObject.__init__(self, bus, path)
+        self.characteristics = []
+        for characteristic_class in self.CHARACTERISTICS:
+            self.add_characteristic(characteristic_class)
+
+    def build_properties(self):
+        return {
+            'UUID': dbus.String(self.UUID),
+            'Primary': dbus.Boolean(self.PRIMARY),
+            'Characteristics': dbus.Array([], signature='o'),
+        }
+
+    # Create and export a characteristic of this service, returning it
+    def add_characteristic(self, characteristic_class, *args, **kwargs):
+        path = f'{self.path}/char{len(self.characteristics)}'
+        characteristic = characteristic_class(self.bus, path, self, *args, **kwargs)
+        self.characteristics.append(characteristic)
+        self.properties['Characteristics'].append(characteristic.get_path())
+        return characteristic
+
+class Application(dbus.service.Object):
+    def __init__(self, bus, path, services=()):
+        self.path = path
+        self.bus = bus
+        self.services = []
+        dbus.service.Object.__init__(self, bus, path)
+        for service_class in services:
+            self.add_service(service_class)
+
+    # Create and export a service of this application, returning it
+    def add_service(self, service_class, *args, **kwargs):
+        service = service_class(self.bus, f'{self.path}/service{len(self.services)}', *args, **kwargs)
+        self.services.append(service)
+        return service
+
+    # Objects and their (cached) property dictionaries, as BlueZ enumerates them
+    def managed_objects(self):
+        response = {}
+        for service in self.services:
+            response[service.get_path()] = {GATT_SERVICE_IFACE: service.properties}
+            for characteristic in service.characteristics:
+                response[characteristic.get_path()] = {GATT_CHRC_IFACE: characteristic.properties}
+        return response
+
+    def get_path(self):
+        return dbus.ObjectPath(self.path)
+
+    @dbus.service.method(DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
+    def GetManagedObjects(self):
+        return self.managed_objects()
+
+# Advertising data BlueZ sends while the advertisement is registered. Legacy
+# advertisements hold 31 bytes, room for the flags, one 128 bit service UUID
+# and a short name; BlueZ moves the name to the scan response if needed.
+class Advertisement(GattObject):
+    INTERFACE = LE_ADVERTISEMENT_IFACE
+
+    def __init__(self, bus, path, service_uuids=(), local_name=None, ad_type='peripheral'):
+        self.service_uuids = list(service_uuids)
+        self.local_name = local_name
+        self.ad_type = ad_type
+        GattObject.__init__(self, bus, path)
+
+    def build_properties(self):
+        properties = {
+            'Type': dbus.String(self.ad_type),
+            'ServiceUUIDs': dbus.Array(self.service_uuids, signature='s'),
+            'Discoverable': dbus.Boolean(True),
+        }
+        if self.local_name:
+            properties['LocalName'] = dbus.String(self.local_name)
+        return properties
+
+    # BlueZ dropped the advertisement, e.g. when bluetoothd stopped
+    @dbus.service.method(LE_ADVERTISEMENT_IFACE)
+    def Release(self):
+        print(f"Advertisement released: {self.path}")
+
+# monotonic() time the process started at, so startup phases include the
+# interpreter start and imports; the time of the first call without /proc
+def process_start_time():
+    try:
+        with open('/proc/self/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return time.monotonic() - (uptime - int(fields[19]) / os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError):
+        return time.monotonic()
+
+class StartupPhases:
+    """
+    Logs the milliseconds since process start at which each startup phase completed.
+
+    call() issues an asynchronous D-Bus call and logs the phase when its reply arrives, so calls
+    that do not depend on each other are in flight at the same time. A failed call is logged
+    with its D-Bus error; on_fatal is called for calls that are fatal. Once all phases passed to
+    expect() completed, the total is logged as ready.
+    """
+
+    def __init__(self, on_fatal=None, log=print):
+        self.origin = process_start_time()
+        self.on_fatal = on_fatal
+        self.log = log
+        self.completed = {}
+        self.failed = {}
+        self.expected = set()
+        self.ready = None
+
+    def elapsed(self):
+        return time.monotonic() - self.origin
+
+    def expect(self, *names):
+        self.expected.update(names)
+
+    def done(self, name):
+        self.completed[name] = self.elapsed()
+        self.log(f"[{self.completed[name] * 1000:7.1f} ms] {name}")
+        if self.ready is None and self.expected and self.expected <= self.completed.keys():
+            self.ready = self.completed[name]
+            self.log(f"[{self.ready * 1000:7.1f} ms] ready")
+
+    def fail(self, name, error, fatal=True):
+        self.failed[name] = error
+        error_name = error.get_dbus_name() if isinstance(error, dbus.exceptions.DBusException) else None
+        self.log(f"[{self.elapsed() * 1000:7.1f} ms] {name} failed: {error_name or type(error).__name__}: {error}")
+        if fatal and self.on_fatal is not None:
+            self.on_fatal()
+
+    # Call method(*args) asynchronously; then(*result) runs after the phase completed
+    def call(self, name, method, *args, then=None, fatal=True):
+        def reply(*result):
+            self.done(name)
+            if then is not None:
+                then(*result)
+
+        try:
+            method(*args, reply_handler=reply, error_handler=lambda error: self.fail(name, error, fatal))
+        except dbus.exceptions.DBusException as e:
+            self.fail(name, e, fatal)
+
+# Power the adapter and register app and advertisement without waiting on any
+# reply in between, apart from advertising only once the adapter is powered.
+# Discoverable stays on (no timeout) so dual mode hosts see the device as well;
+# failing to set it is not fatal. The adapter proxy is not introspected, which
+# would cost a blocking round trip to bluetoothd.
+def register_peripheral(bus, app, advertisement, on_fatal=None, adapter='hci0', phases=None):
+    if phases is None:
+        phases = StartupPhases(on_fatal)
+    adapter_object = bus.get_object(BLUEZ_SERVICE, f'/org/bluez/{adapter}', introspect=False)
+    properties = dbus.Interface(adapter_object, DBUS_PROP_IFACE)
+    gatt_manager = dbus.Interface(adapter_object, GATT_MANAGER_IFACE)
+    advertising_manager = dbus.Interface(adapter_object, LE_ADVERTISING_MANAGER_IFACE)
+    phases.expect('GATT application registered', 'advertising')
+
+    def powered():
+        # Sent back to back, so bluetoothd applies the timeout before discoverable
+        phases.call('discoverable timeout off', properties.Set, ADAPTER_IFACE, 'DiscoverableTimeout',
+                    dbus.UInt32(0), fatal=False)
+        phases.call('adapter discoverable', properties.Set, ADAPTER_IFACE, 'Discoverable',
+                    dbus.Boolean(True), fatal=False)
+        phases.call('advertising', advertising_manager.RegisterAdvertisement, advertisement.get_path(), {})
+
+    phases.call('adapter powered', properties.Set, ADAPTER_IFACE, 'Powered', dbus.Boolean(True), then=powered)
+    phases.call('GATT application registered', gatt_manager.RegisterApplication, app.get_path(), {})
+    return phases
@@ -1,168 +1,219 @@
 import dbus
 import dbus.mainloop.glib
-import dbus.service
 from gi.repository import GLib
+import argparse
+import fcntl
+import ipaddress
+import os
+import socket
+import struct
 import subprocess
+import sys
+import threading
+import time
+
+from bulk_transfer import BULK_CONTROL_UUID, BULK_DATA_UUID, BULK_SERVICE_UUID, BulkSender
+from gatt import Advertisement, Application, Characteristic, Service, StartupPhases, register_peripheral
 
 GATT_SERVICE_UUID = '12345678-1234-5678-1234-56789abcdef0'
 WIFI_CHARACTERISTIC_UUID = '87654321-4321-6789-4321-56789abcdef0'
 
-class WiFiCharacteristic(dbus.service.Object):
-    def __init__(self, bus, index, uuid, service):
-        self.path = f'/org/bluez/example/service{index}/char{index}'
-        self.bus = bus
-        self.uuid = uuid
-        self.service = service
-        self.flags = ['read']
-        dbus.service.Object.__init__(self, bus, self.path)
-        print(f"WiFiCharacteristic initialized: {self.path}")
-
-    def get_wifi_status(self):
+SIOCGIFADDR = 0x8915
+
+# Global IPv4 and IPv6 addresses of all interfaces but loopback, like `hostname -I`, without forking
+def read_ip_addresses():
+    addresses = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for _, name in socket.if_nameindex():
+            if name == 'lo':
+                continue
+            try:
+                request = fcntl.ioctl(sock.fileno(), SIOCGIFADDR, struct.pack('256s', name.encode()[:15]))
+            except OSError:
+                continue  # no IPv4 address
+            addresses.append(socket.inet_ntoa(request[20:24]))
+    try:
+        with open('/proc/net/if_inet6') as f:
+            for line in f:
+                fields = line.split()
+                if fields[3] == '00' and fields[5] != 'lo':  # global scope
+                    addresses.append(str(ipaddress.IPv6Address(bytes.fromhex(fields[0]))))
+    except OSError:
+        pass
+    return addresses
+
+# Operational state of each wireless interface, e.g. (('wlan0', 'up'),)
+def read_wireless_states():
+    states = []
+    for name in sorted(os.listdir('/sys/class/net')):
+        if os.path.isdir(f'/sys/class/net/{name}/wireless'):
+            try:
+                with open(f'/sys/class/net/{name}/operstate') as f:
+                    states.append((name, f.read().strip()))
+            except OSError:
+                pass
+    return tuple(states)
+
+# SSID the WiFi is connected to, None when it is not
+def read_ssid():
+    result = subprocess.run(['iwgetid', '-r'], capture_output=True, text=True)
+    if result.returncode != 0 or not result.stdout.strip():
+        return None
+    return result.stdout.strip()
+
+class WiFiMonitor:
+    """
+    WiFi status kept up to date by a background thread, so reading it is a lookup.
+
+    Every poll_interval seconds the thread reads the wireless interface states and the IP
+    addresses from /sys, /proc and an ioctl, which costs no process. iwgetid only runs when those
+    changed, and every ssid_interval seconds to catch a switch to another network without an
+    address change. Subscribers are called on the GLib main loop when the status changes.
+    """
+
+    def __init__(self, poll_interval=2.0, ssid_interval=30.0):
+        self.poll_interval = poll_interval
+        self.ssid_interval = ssid_interval
+        self.status = None
+        self.polls = 0
+        self.ssid_reads = 0
+        self.changes = 0
+        self._fingerprint = None
+        self._ssid = None
+        self._error = None
+        self._next_ssid_read = 0.0
+        self._subscribers = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='wifi-monitor', daemon=True)
+
+    def start(self):
+        self.refresh()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    # callback(status) is called on the main loop after each change
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def refresh(self):
+        self.polls += 1
         try:
-            result = subprocess.run(['iwgetid'], capture_output=True, text=True)
-            if result.returncode != 0:
-                return "Not connected"
-            ssid = result.stdout.strip().split('"')[1]
-            ip_address = subprocess.run(['hostname', '-I'], capture_output=True, text=True).stdout.strip()
-            return f"Connected to {ssid}, IP: {ip_address}"
+            fingerprint = (read_wireless_states(), tuple(read_ip_addresses()))
+            now = time.monotonic()
+            if fingerprint != self._fingerprint or now >= self._next_ssid_read:
+                # Set first, so a failing iwgetid is retried at the same rate
+                self._fingerprint = fingerprint
+                self._next_ssid_read = now + self.ssid_interval
+                self.ssid_reads += 1
+                self._ssid = self._error = None
+                self._ssid = read_ssid()
+            if self._ssid is None:
+                status = "Not connected"
+            else:
+                status = f"Connected to {self._ssid}, IP: {' '.join(fingerprint[1])}"
         except Exception as e:
-            return f"Error: {str(e)}"
-
-    @dbus.service.method(dbus.PROPERTIES_IFACE, in_signature='ss', out_signature='v')
-    def Get(self, interface, prop):
-        if interface != 'org.bluez.GattCharacteristic1':
-            raise dbus.exceptions.DBusException("Invalid interface", name='org.freedesktop.DBus.Error.InvalidArgs')
-
-        if prop == 'UUID':
-            return self.uuid
-        elif prop == 'Value':
-            value = self.get_wifi_status()
-            return dbus.Array([dbus.Byte(c) for c in value.encode()], signature='y')
-        elif prop == 'Flags':
-            return self.flags
-        else:
-            raise dbus.exceptions.DBusException("Invalid property", name='org.freedesktop.DBus.Error.InvalidArgs')
-
-    @dbus.service.method(dbus.PROPERTIES_IFACE, in_signature='s', out_signature='a{sv}')
-    def GetAll(self, interface):
-        if interface != 'org.bluez.GattCharacteristic1':
-            raise dbus.exceptions.DBusException("Invalid interface", name='org.freedesktop.DBus.Error.InvalidArgs')
-
-        return {
-            'UUID': self.uuid,
-            'Value': dbus.Array([dbus.Byte(c) for c in self.get_wifi_status().encode()], signature='y'),
-            'Flags': self.flags,
-        }
-
-class Service(dbus.service.Object):
-    def __init__(self, bus, index):
-        self.path = f'/org/bluez/example/service{index}'
-        self.bus = bus
-        self.uuid = GATT_SERVICE_UUID
-        self.primary = True
-        self.characteristics = []
-        dbus.service.Object.__init__(self, bus, self.path)
-        self.add_characteristic(WiFiCharacteristic(bus, 0, WIFI_CHARACTERISTIC_UUID, self))
-        print(f"Service initialized: {self.path}")
-
-    def add_characteristic(self, characteristic):
-        self.characteristics.append(characteristic)
-
-    @dbus.service.method(dbus.PROPERTIES_IFACE, in_signature='ss', out_signature='v')
-    def Get(self, interface, prop):
-        if interface != 'org.bluez.GattService1':
-            raise dbus.exceptions.DBusException("Invalid interface", name='org.freedesktop.DBus.Error.InvalidArgs')
-
-        if prop == 'UUID':
-            return self.uuid
-        elif prop == 'Primary':
-            return self.primary
-        elif prop == 'Characteristics':
-            return dbus.Array([char.path for char in self.characteristics], signature='o')
-        else:
-            raise dbus.exceptions.DBusException("Invalid property", name='org.freedesktop.DBus.Error.InvalidArgs')
-
-    @dbus.service.method(dbus.PROPERTIES_IFACE, in_signature='s', out_signature='a{sv}')
-    def GetAll(self, interface):
-        if interface != 'org.bluez.GattService1':
-            raise dbus.exceptions.DBusException("Invalid interface", name='org.freedesktop.DBus.Error.InvalidArgs')
-
-        return {
-            'UUID': self.uuid,
-            'Primary': self.primary,
-            'Characteristics': dbus.Array([char.path for char in self.characteristics], signature='o')
-        }
-
-class Application(dbus.service.Object):
-    def __init__(self, bus):
-        self.path = '/org/bluez/example'
-        self.services = []
-        dbus.service.Object.__init__(self, bus, self.path)
-        self.add_service(Service(bus, 0))
-        print("Application initialized")
-
-    def add_service(self, service):
-        self.services.append(service)
-
-    @dbus.service.method(dbus.PROPERTIES_IFACE, in_signature='ss', out_signature='v')
-    def Get(self, interface, prop):
-        raise dbus.exceptions.DBusException("Invalid interface", name='org.freedesktop.DBus.Error.InvalidArgs')
-
-    @dbus.service.method(dbus.PROPERTIES_IFACE, in_signature='s', out_signature='a{sv}')
-    def GetAll(self, interface):
-        return {}
-
-    @dbus.service.method('org.freedesktop.DBus.ObjectManager', in_signature='', out_signature='a{oa{sa{sv}}}')
-    def GetManagedObjects(self):
-        response = {}
-        for service in self.services:
-            service_path = service.path
-            response[service_path] = {
-                'org.bluez.GattService1': service.GetAll('org.bluez.GattService1')
-            }
-            for characteristic in service.characteristics:
-                char_path = characteristic.path
-                response[char_path] = {
-                    'org.bluez.GattCharacteristic1': characteristic.GetAll('org.bluez.GattCharacteristic1')
-                }
-        print(f"GetManagedObjects response: {response}")
-        return response
-
-def register_app_cb():
-    print("GATT application registered")
-    start_advertising()  # Start advertising after successful registration
-
-def register_app_error_cb(error):
-    print(f"Failed to register application: {error}")
-    mainloop.quit()
-
-def start_advertising():
-    print("Starting advertising...")
-    subprocess.run(['sudo', 'hciconfig', 'hci0', 'up'])
-    subprocess.run(['sudo', 'hciconfig', 'hci0', 'leadv', '3'])
-    subprocess.run(['sudo', 'hciconfig', 'hci0', 'noscan'])
-    subprocess.run('echo "advertise on" | sudo bluetoothctl', shell=True)
-    print("Advertising started")
-
-dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
-bus = dbus.SystemBus()
-
-adapter_path = '/org/bluez/hci0'
-adapter = dbus.Interface(bus.get_object('org.bluez', adapter_path), 'org.freedesktop.DBus.Properties')
-adapter.Set('org.bluez.Adapter1', 'Powered', dbus.Boolean(1))
-
-service_manager = dbus.Interface(bus.get_object('org.bluez', adapter_path), 'org.bluez.GattManager1')
-app = Application(bus)
-
-mainloop = GLib.MainLoop()
-try:
-    service_manager.RegisterApplication(app.path, {},
-                                        reply_handler=register_app_cb,
-                                        error_handler=register_app_error_cb)
-    print("RegisterApplication called")
-except Exception as e:
-    print(f"Failed to register application: {e}")
-    mainloop.quit()
-
-print("Entering main loop")
-mainloop.run()
+            self._error = f"Error: {str(e)}"
+        if self._error is not None:
+            status = self._error
+        if status != self.status:
+            self.status = status
+            self.changes += 1
+            for callback in self._subscribers:
+                GLib.idle_add(self._notify, callback, status)
+
+    def _run(self):
+        while not self._stop.wait(self.poll_interval):
+            self.refresh()
+
+    @staticmethod
+    def _notify(callback, status):
+        callback(status)
+        return False  # run once
+
+class WiFiCharacteristic(Characteristic):
+    UUID = WIFI_CHARACTERISTIC_UUID
+    FLAGS = ('read', 'notify')
+
+    def __init__(self, bus, path, service, monitor=None):
+        if monitor is None:
+            monitor = WiFiMonitor()
+            monitor.start()
+        self.monitor = monitor
+        Characteristic.__init__(self, bus, path, service, monitor.status.encode())
+        monitor.subscribe(self.wifi_changed)
+        print(f"WiFiCharacteristic initialized: {self.path}")
+
+    def wifi_changed(self, status):
+        print(f"WiFi status changed: {status}")
+        self.set_value(status.encode())
+
+class WiFiService(Service):
+    UUID = GATT_SERVICE_UUID
+    CHARACTERISTICS = (WiFiCharacteristic,)
+
+# Host writes of the bulk transfer protocol (see bulk_transfer.py); replies
+# are notified here, payload chunks on the data characteristic
+class BulkControlCharacteristic(Characteristic):
+    UUID = BULK_CONTROL_UUID
+    FLAGS = ('write', 'write-without-response', 'notify')
+
+    def on_write(self, value, options):
+        replies, chunks = self.service.sender.handle(value, int(options['mtu']) if 'mtu' in options else None)
+        for reply in replies:
+            self.notify(reply)
+        for chunk in chunks:
+            self.service.data.notify(chunk)
+
+class BulkDataCharacteristic(Characteristic):
+    UUID = BULK_DATA_UUID
+    FLAGS = ('notify',)
+
+# Streams named payloads to a host, e.g. with bulk_receiver.py. payloads maps
+# names to functions returning the bytes to send.
+class BulkTransferService(Service):
+    UUID = BULK_SERVICE_UUID
+    CHARACTERISTICS = (BulkControlCharacteristic, BulkDataCharacteristic)
+
+    def __init__(self, bus, path, payloads):
+        self.sender = BulkSender(payloads)
+        Service.__init__(self, bus, path)
+        self.control, self.data = self.characteristics
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def main():
+    phases = StartupPhases()
+    parser = argparse.ArgumentParser(description='GATT server with the WiFi status and bulk transfers')
+    parser.add_argument('--share', action='append', default=[], metavar='NAME=PATH',
+                        help='file the bulk transfer service sends as NAME, read on each request')
+    parser.add_argument('--adapter', default='hci0', help='Bluetooth adapter to advertise on')
+    parser.add_argument('--name', default=socket.gethostname(), help='local name to advertise')
+    args = parser.parse_args()
+    payloads = {}
+    for share in args.share:
+        name, _, path = share.partition('=')
+        payloads[name] = lambda path=path: read_file(path)
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.SystemBus()
+    phases.done('D-Bus connected')
+
+    app = Application(bus, '/org/bluez/example', (WiFiService,))
+    app.add_service(BulkTransferService, payloads)
+    # Only the WiFi service fits next to the name; clients discover the other one
+    advertisement = Advertisement(bus, '/org/bluez/example/advertisement0', [GATT_SERVICE_UUID], args.name)
+    phases.done('application initialized')
+
+    mainloop = GLib.MainLoop()
+    phases.on_fatal = mainloop.quit
+    register_peripheral(bus, app, advertisement, adapter=args.adapter, phases=phases)
+    mainloop.run()
+    if phases.failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
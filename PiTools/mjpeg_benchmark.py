@@ -0,0 +1,112 @@
+"""
+Server CPU per MJPEG client of camera_preview_crosshair.py --sink mjpeg.
+
+Starts the streaming server on synthetic frames in a child process, connects more and more
+clients that read the stream as fast as they can, and reads the server's CPU time from /proc
+over each measurement window. Frames are encoded once whatever the number of clients, so
+going from 0 to 1 client adds the encoding and every further client only its socket writes:
+    python3 mjpeg_benchmark.py --clients 0 1 2 4 8 16
+"""
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "camera_preview_crosshair.py")
+
+
+class StreamClient(threading.Thread):
+    """Reads /stream.mjpg and counts the frames received."""
+
+    def __init__(self, port):
+        super().__init__(daemon=True)
+        self.port = port
+        self.frames = 0
+        self.bytes = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        with socket.create_connection(("127.0.0.1", self.port)) as sock:
+            sock.sendall(b"GET /stream.mjpg HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            tail = b""
+            while not self._stop_event.is_set():
+                data = sock.recv(256 * 1024)
+                if not data:
+                    break
+                self.bytes += len(data)
+                # The boundary may straddle two reads.
+                chunk = tail + data
+                self.frames += chunk.count(b"--frame\r\n")
+                tail = chunk[-9:]
+
+    def stop(self):
+        self._stop_event.set()
+
+
+# CPU seconds used so far by process pid (Linux)
+def cpu_seconds(pid):
+    with open("/proc/%d/stat" % pid) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def wait_for_port(port, timeout=10.0):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("server did not start on port %d" % port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, nargs="+", default=(0, 1, 2, 4, 8, 16))
+    parser.add_argument("--size", default="1280x720", help="synthetic frame size")
+    parser.add_argument("--fps", type=float, default=30.0, help="synthetic frame rate")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per measurement")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    server = subprocess.Popen([sys.executable, SCRIPT, "--source", "synthetic", "--size", args.size,
+                               "--fps", str(args.fps), "--sink", "mjpeg", "--port", str(args.port)],
+                              stdout=subprocess.DEVNULL)
+    clients = []
+    try:
+        wait_for_port(args.port)
+        print(f"{'clients':>7}{'server CPU %':>14}{'per client %':>14}{'client fps':>12}{'MB/s':>8}")
+        baseline = None
+        for count in sorted(args.clients):
+            while len(clients) < count:
+                client = StreamClient(args.port)
+                client.start()
+                clients.append(client)
+            time.sleep(1.0)  # settle
+            received = [(client.frames, client.bytes) for client in clients]
+            cpu_start, start = cpu_seconds(server.pid), time.monotonic()
+            time.sleep(args.duration)
+            elapsed = time.monotonic() - start
+            cpu = 100 * (cpu_seconds(server.pid) - cpu_start) / elapsed
+            frames = sum(client.frames - before for client, (before, _) in zip(clients, received))
+            nbytes = sum(client.bytes - before for client, (_, before) in zip(clients, received))
+            # Marginal cost over the first client, which also pays for encoding
+            if count == 1:
+                baseline = cpu
+            per_client = (cpu - baseline) / (count - 1) if baseline is not None and count > 1 else float("nan")
+            print(f"{count:>7}{cpu:>14.1f}{per_client:>14.2f}{frames / elapsed / max(count, 1):>12.1f}"
+                  f"{nbytes / elapsed / 1e6:>8.1f}")
+    finally:
+        for client in clients:
+            client.stop()
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+"""
+Stand-in for bluetoothd on a private bus, so the PiTools BLE services run without Bluetooth
+hardware. Owns org.bluez and exports:
+
+    /                           ObjectManager with the adapter and its devices
+    /org/bluez                  AgentManager1
+    /org/bluez/hci0             Adapter1 properties, GattManager1, LEAdvertisingManager1
+    /org/bluez/hci0/dev_...     Device1 properties
+
+Like BlueZ, RegisterApplication reads the application's GetManagedObjects and
+RegisterAdvertisement the advertisement's properties before replying, and the adapter stops
+being discoverable DiscoverableTimeout seconds (180 by default) after it became discoverable,
+times --time-scale so tests need not wait minutes. The test interface
+org.bluez.test.Mock1 on /org/bluez reports registrations and counters, connects and
+disconnects devices and emits bursts of PropertiesChanged signals. Serves the bus in
+DBUS_SYSTEM_BUS_ADDRESS:
+    DBUS_SYSTEM_BUS_ADDRESS=unix:path=/tmp/bus python3 mock_bluez.py --devices 4 --time-scale 0.01
+"""
+
+import argparse
+import time
+
+import dbus
+import dbus.exceptions
+import dbus.mainloop.glib
+import dbus.service
+from gi.repository import GLib
+
+from gatt import (ADAPTER_IFACE, BLUEZ_SERVICE, DBUS_OM_IFACE, DBUS_PROP_IFACE, GATT_MANAGER_IFACE,
+                  LE_ADVERTISEMENT_IFACE, LE_ADVERTISING_MANAGER_IFACE, InvalidArgs)
+
+AGENT_MANAGER_IFACE = "org.bluez.AgentManager1"
+DEVICE_IFACE = "org.bluez.Device1"
+MOCK_IFACE = "org.bluez.test.Mock1"
+ADAPTER_PATH = "/org/bluez/hci0"
+
+
+def device_address(index):
+    return "00:00:00:00:01:%02X" % index
+
+
+def device_path(index):
+    return "%s/dev_%s" % (ADAPTER_PATH, device_address(index).replace(":", "_"))
+
+
+class AlreadyExists(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.bluez.Error.AlreadyExists"
+
+
+class DoesNotExist(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.bluez.Error.DoesNotExist"
+
+
+class PropertiesObject(dbus.service.Object):
+    """Object with one interface of writable properties, which emits PropertiesChanged."""
+
+    def __init__(self, bus, path, interface, properties):
+        dbus.service.Object.__init__(self, bus, path)
+        self.path = path
+        self.interface = interface
+        self.properties = properties
+        self.sets = []  # (name, value, monotonic time) of each Set call
+
+    def update(self, name, value):
+        self.properties[name] = value
+        self.PropertiesChanged(self.interface, {name: value}, [])
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature="ss", out_signature="v")
+    def Get(self, interface, name):
+        if interface != self.interface or name not in self.properties:
+            raise InvalidArgs("No such property %s.%s" % (interface, name))
+        return self.properties[name]
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature="s", out_signature="a{sv}")
+    def GetAll(self, interface):
+        if interface != self.interface:
+            raise InvalidArgs("No such interface %s" % interface)
+        return self.properties
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature="ssv")
+    def Set(self, interface, name, value):
+        if interface != self.interface or name not in self.properties:
+            raise InvalidArgs("No such property %s.%s" % (interface, name))
+        self.sets.append((name, value, time.monotonic()))
+        if value != self.properties[name]:
+            self.update(name, value)
+
+    @dbus.service.signal(DBUS_PROP_IFACE, signature="sa{sv}as")
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+
+class Adapter(PropertiesObject):
+    def __init__(self, bus, path, time_scale=1.0):
+        PropertiesObject.__init__(self, bus, path, ADAPTER_IFACE, self.defaults())
+        self.time_scale = time_scale
+        self.registrations = {}  # "application" and "advertisement": sender, path, time, objects
+        self.discoverable_timeouts = 0
+        self._discoverable_timer = None
+
+    @staticmethod
+    def defaults():
+        return {
+            "Address": dbus.String("00:00:00:00:00:00"),
+            "Name": dbus.String("mock"),
+            "Class": dbus.UInt32(0),
+            "Powered": dbus.Boolean(False),
+            "Discoverable": dbus.Boolean(False),
+            "DiscoverableTimeout": dbus.UInt32(180),
+        }
+
+    def reset(self):
+        self.properties.update(self.defaults())
+        self.registrations.clear()
+        self.sets = []
+        self.discoverable_timeouts = 0
+        self._arm_discoverable_timeout()
+
+    def update(self, name, value):
+        PropertiesObject.update(self, name, value)
+        if name in ("Discoverable", "DiscoverableTimeout"):
+            self._arm_discoverable_timeout()
+
+    # As bluetoothd: a new timeout or becoming discoverable restarts the countdown
+    def _arm_discoverable_timeout(self):
+        if self._discoverable_timer is not None:
+            GLib.source_remove(self._discoverable_timer)
+            self._discoverable_timer = None
+        timeout = self.properties["DiscoverableTimeout"]
+        if self.properties["Discoverable"] and timeout:
+            self._discoverable_timer = GLib.timeout_add(max(1, int(timeout * self.time_scale * 1000)),
+                                                        self._discoverable_timed_out)
+
+    def _discoverable_timed_out(self):
+        self._discoverable_timer = None
+        self.discoverable_timeouts += 1
+        self.update("Discoverable", dbus.Boolean(False))
+        return False  # run once
+
+    # Read what was registered before replying, as bluetoothd does
+    @dbus.service.method(GATT_MANAGER_IFACE, in_signature="oa{sv}", sender_keyword="sender",
+                         async_callbacks=("reply", "error"))
+    def RegisterApplication(self, path, options, sender, reply, error):
+        if "application" in self.registrations:
+            raise AlreadyExists("Already Exists")
+        application = self.connection.get_object(sender, path, introspect=False)
+
+        def objects_read(objects):
+            self._registered("application", sender, path, len(objects))
+            reply()
+
+        application.GetManagedObjects(dbus_interface=DBUS_OM_IFACE, reply_handler=objects_read, error_handler=error)
+
+    @dbus.service.method(GATT_MANAGER_IFACE, in_signature="o")
+    def UnregisterApplication(self, path):
+        if self.registrations.pop("application", {}).get("path") != path:
+            raise DoesNotExist("Does Not Exist")
+
+    @dbus.service.method(LE_ADVERTISING_MANAGER_IFACE, in_signature="oa{sv}", sender_keyword="sender",
+                         async_callbacks=("reply", "error"))
+    def RegisterAdvertisement(self, path, options, sender, reply, error):
+        if "advertisement" in self.registrations:
+            raise AlreadyExists("Already Exists")
+        if not self.properties["Powered"]:
+            raise dbus.exceptions.DBusException("Not Powered", name="org.bluez.Error.NotReady")
+        advertisement = self.connection.get_object(sender, path, introspect=False)
+
+        def properties_read(properties):
+            if "Type" not in properties:
+                error(dbus.exceptions.DBusException("No Type", name="org.bluez.Error.InvalidArguments"))
+                return
+            self._registered("advertisement", sender, path, len(properties))
+            reply()
+
+        advertisement.GetAll(LE_ADVERTISEMENT_IFACE, dbus_interface=DBUS_PROP_IFACE,
+                             reply_handler=properties_read, error_handler=error)
+
+    @dbus.service.method(LE_ADVERTISING_MANAGER_IFACE, in_signature="o")
+    def UnregisterAdvertisement(self, path):
+        if self.registrations.pop("advertisement", {}).get("path") != path:
+            raise DoesNotExist("Does Not Exist")
+
+    def _registered(self, name, sender, path, objects):
+        self.registrations[name] = {
+            "sender": dbus.String(sender),
+            "path": dbus.ObjectPath(path),
+            "time": dbus.Double(time.monotonic()),
+            "objects": dbus.UInt32(objects),
+        }
+
+
+class ObjectManager(dbus.service.Object):
+    def __init__(self, bus, objects):
+        dbus.service.Object.__init__(self, bus, "/")
+        self.objects = objects
+
+    @dbus.service.method(DBUS_OM_IFACE, out_signature="a{oa{sa{sv}}}")
+    def GetManagedObjects(self):
+        return {obj.path: {obj.interface: obj.properties} for obj in self.objects}
+
+
+class MockBluez(dbus.service.Object):
+    """AgentManager1 and the test interface, on /org/bluez."""
+
+    def __init__(self, bus, devices=4, time_scale=1.0):
+        dbus.service.Object.__init__(self, bus, "/org/bluez")
+        self.adapter = Adapter(bus, ADAPTER_PATH, time_scale)
+        self.devices = []
+        for index in range(devices):
+            self.devices.append(PropertiesObject(bus, device_path(index), DEVICE_IFACE, {
+                "Address": dbus.String(device_address(index)),
+                "Connected": dbus.Boolean(False),
+                "RSSI": dbus.Int16(-60),
+            }))
+        self.object_manager = ObjectManager(bus, [self.adapter] + self.devices)
+        self.agent = None
+        self.signals_emitted = 0
+
+    @dbus.service.method(AGENT_MANAGER_IFACE, in_signature="os", sender_keyword="sender")
+    def RegisterAgent(self, path, capability, sender):
+        if self.agent is not None:
+            raise AlreadyExists("Already Exists")
+        self.agent = {"sender": dbus.String(sender), "path": dbus.ObjectPath(path),
+                      "time": dbus.Double(time.monotonic()), "objects": dbus.UInt32(0)}
+
+    @dbus.service.method(AGENT_MANAGER_IFACE, in_signature="o")
+    def RequestDefaultAgent(self, path):
+        if self.agent is None or self.agent["path"] != path:
+            raise DoesNotExist("Does Not Exist")
+        self.agent["time"] = dbus.Double(time.monotonic())
+
+    @dbus.service.method(AGENT_MANAGER_IFACE, in_signature="o")
+    def UnregisterAgent(self, path):
+        self.agent = None
+
+    @dbus.service.method(MOCK_IFACE, out_signature="a{sa{sv}}")
+    def Registrations(self):
+        registrations = dict(self.adapter.registrations)
+        if self.agent is not None:
+            registrations["agent"] = self.agent
+        return registrations
+
+    # Back to a powered off adapter without registrations and with all devices
+    # disconnected, for the next process
+    @dbus.service.method(MOCK_IFACE)
+    def Reset(self):
+        self.adapter.reset()
+        self.agent = None
+        for device in self.devices:
+            device.properties["Connected"] = dbus.Boolean(False)
+
+    @dbus.service.method(MOCK_IFACE, out_signature="a{sv}")
+    def Stats(self):
+        discoverable_sets = [t for name, _, t in self.adapter.sets if name == "Discoverable"]
+        return {
+            "powered": self.adapter.properties["Powered"],
+            "discoverable": self.adapter.properties["Discoverable"],
+            "discoverable_timeout": self.adapter.properties["DiscoverableTimeout"],
+            "discoverable_timeouts": dbus.UInt32(self.adapter.discoverable_timeouts),
+            "discoverable_sets": dbus.UInt32(len(discoverable_sets)),
+            "last_discoverable_set": dbus.Double(discoverable_sets[-1] if discoverable_sets else 0.0),
+            "signals_emitted": dbus.UInt32(self.signals_emitted),
+        }
+
+    # Connect or disconnect a device, returning the time its signal went out
+    @dbus.service.method(MOCK_IFACE, in_signature="ub", out_signature="d")
+    def SetConnected(self, index, connected):
+        self.devices[index].update("Connected", dbus.Boolean(connected))
+        self.signals_emitted += 1
+        return time.monotonic()
+
+    # Emit count device signals, mostly RSSI changes, with every connect_every-th one
+    # connecting or disconnecting device 0 and noise adapter signals in between, as a busy bus
+    # carries. Returns the number of noise signals.
+    @dbus.service.method(MOCK_IFACE, in_signature="uuu", out_signature="u")
+    def EmitSignals(self, count, connect_every, noise_per_signal):
+        noise = 0
+        for n in range(count):
+            device = self.devices[n % len(self.devices)]
+            if connect_every and n % connect_every == 0:
+                device = self.devices[0]
+                device.update("Connected", dbus.Boolean(not device.properties["Connected"]))
+            else:
+                device.update("RSSI", dbus.Int16(-40 - n % 40))
+            for _ in range(noise_per_signal):
+                self.adapter.PropertiesChanged(ADAPTER_IFACE, {"Class": dbus.UInt32(n)}, [])
+                noise += 1
+        self.signals_emitted += count + noise
+        return noise
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=4, help="devices the adapter knows")
+    parser.add_argument("--time-scale", type=float, default=1.0,
+                        help="factor applied to DiscoverableTimeout, e.g. 0.001 turns 180 s into 180 ms")
+    args = parser.parse_args()
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.SystemBus()
+    mock = MockBluez(bus, args.devices, args.time_scale)  # objects stay exported while referenced
+    name = dbus.service.BusName(BLUEZ_SERVICE, bus, do_not_queue=True)
+    print("ready", flush=True)
+    GLib.MainLoop().run()
+
+
+if __name__ == "__main__":
+    main()
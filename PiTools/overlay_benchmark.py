@@ -0,0 +1,86 @@
+"""
+Headless micro-benchmark of the per-frame overlay cost of camera_preview_crosshair.py.
+
+"before" draws the cross on a new RGBA overlay and pastes it with alpha on every frame, as the
+preview used to. "after" blends the precomputed Overlay into the captured array in place. The
+blend columns time just that; the RGB columns add the conversion to an RGB image both paths
+need for display, done the same way for both. Frames are random XBGR8888-like (h, w, 4) arrays,
+so neither a camera nor a display is needed:
+    python3 overlay_benchmark.py --frames 200
+"""
+
+import argparse
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from camera_preview_crosshair import CROSS_COLOR, CROSS_LENGTH, CROSS_WIDTH, Overlay, draw_cross, to_rgb_image
+
+RESOLUTIONS = ((640, 480), (1920, 1080))
+
+
+# The per-frame overlay blend the preview used before Overlay, as an RGBA image
+def blend_before(frame):
+    image = Image.fromarray(frame)
+    overlay = Image.new("RGBA", image.size, (255, 255, 255, 0))
+    draw = ImageDraw.Draw(overlay)
+    center_x, center_y = image.width // 2, image.height // 2
+    draw.line((center_x - CROSS_LENGTH, center_y, center_x + CROSS_LENGTH, center_y), fill=CROSS_COLOR,
+              width=CROSS_WIDTH)
+    draw.line((center_x, center_y - CROSS_LENGTH, center_x, center_y + CROSS_LENGTH), fill=CROSS_COLOR,
+              width=CROSS_WIDTH)
+    image.paste(overlay, (0, 0), overlay)
+    return image
+
+
+def blend_after(frame, overlay):
+    return overlay.apply(frame)
+
+
+def overlay_before(frame):
+    return to_rgb_image(np.asarray(blend_before(frame)))
+
+
+def overlay_after(frame, overlay):
+    return to_rgb_image(blend_after(frame, overlay))
+
+
+def time_per_frame(fn, frames):
+    fn(frames[0])  # warm up
+    start = time.perf_counter()
+    for frame in frames:
+        fn(frame)
+    return (time.perf_counter() - start) / len(frames)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=200, help="frames per measurement")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'':<12}{'blend ms':^30}{'blend + RGB ms':^30}")
+    print(f"{'resolution':<12}" + f"{'before':>11}{'after':>10}{'speedup':>9}" * 2 + f"{'max diff':>10}")
+    for width, height in RESOLUTIONS:
+        # A few distinct frames cycled through, as fresh captures would be
+        source = [rng.integers(0, 256, (height, width, 4), dtype=np.uint8) for _ in range(4)]
+        source = [source[i % len(source)] for i in range(args.frames)]
+        overlay = Overlay((width, height), draw_cross)
+
+        columns = ""
+        for before_fn, after_fn in ((blend_before, blend_after), (overlay_before, overlay_after)):
+            before = time_per_frame(before_fn, source)
+            frames = [frame.copy() for frame in source]
+            after = time_per_frame(lambda frame: after_fn(frame, overlay), frames)
+            columns += f"{before * 1000:>11.3f}{after * 1000:>10.3f}{before / after:>8.1f}x"
+
+        # Both paths must produce the same picture
+        expected = np.asarray(overlay_before(source[0]))
+        actual = np.asarray(overlay_after(source[0].copy(), overlay))
+        diff = int(np.abs(expected.astype(np.int16) - actual).max())
+        print(f"{width}x{height:<7}{columns}{diff:>10}")
+
+
+if __name__ == "__main__":
+    main()
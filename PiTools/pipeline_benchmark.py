@@ -0,0 +1,56 @@
+"""
+Headless benchmark of the capture -> overlay -> convert pipeline of camera_preview_crosshair.py.
+
+Each configuration runs the real pipeline (capture thread, frame ring, overlay, RGB conversion)
+with the headless sink and reports sustained fps and the mean time per stage. Synthetic frames
+are used by default, so neither a camera nor a display is needed:
+    python3 pipeline_benchmark.py --duration 5
+    python3 pipeline_benchmark.py --video clip.mp4
+    python3 pipeline_benchmark.py --picamera2
+"capture" includes waiting for the next frame, so at a fixed source rate it is mostly idle time.
+"""
+
+import argparse
+
+from camera_preview_crosshair import Picamera2Source, SyntheticSource, VideoFileSource, parse_size, run_pipeline
+
+SIZES = ((640, 480), (1280, 720), (1920, 1080))
+STAGES = ("capture", "copy", "overlay", "convert")
+
+
+# (name, source factory) of every configuration to run
+def configurations(args):
+    for size in args.sizes:
+        for fps in (30.0, 0.0):
+            yield ("synthetic %dx%d @%s" % (size + ("max" if not fps else "%g" % fps,)),
+                   lambda size=size, fps=fps: SyntheticSource(size, fps=fps))
+    if args.video:
+        yield "video %s" % args.video, lambda: VideoFileSource(args.video, fps=0)
+    if args.picamera2:
+        for size in args.sizes:
+            yield "picamera2 %dx%d" % size, lambda size=size: Picamera2Source(size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per configuration")
+    parser.add_argument("--sizes", type=parse_size, nargs="+", default=SIZES, help="frame sizes, WIDTHxHEIGHT")
+    parser.add_argument("--video", help="also run a video file, decoded as fast as possible")
+    parser.add_argument("--picamera2", action="store_true", help="also run the camera at each size")
+    args = parser.parse_args()
+
+    print(f"{'configuration':<28}{'fps':>7}{'captured':>10}{'dropped':>9}{'latency':>9}"
+          + "".join(f"{stage + ' ms':>12}" for stage in STAGES))
+    for name, open_source in configurations(args):
+        source = open_source()
+        try:
+            summary = run_pipeline(source, "headless", args.duration)
+        finally:
+            source.close()
+        stages = summary["stages_ms"]
+        print(f"{name:<28}{summary['fps']:>7.1f}{summary['capture_fps']:>10.1f}{summary['dropped']:>9d}"
+              f"{summary['latency_ms']:>9.1f}" + "".join(f"{stages.get(stage, 0.0):>12.2f}" for stage in STAGES))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,7 @@ import dbus
 import dbus.mainloop.glib
 import dbus.service
 import logging
-import os
+import signal
 from gi.repository import GLib
 
 logging.basicConfig(level=logging.INFO)
@@ -12,6 +12,12 @@ BUS_NAME = 'org.bluez'
 AGENT_INTERFACE = 'org.bluez.Agent1'
 AGENT_PATH = '/test/agent'
 CAPABILITY = 'NoInputNoOutput'
+ADAPTER_PATH = '/org/bluez/hci0'
+ADAPTER_INTERFACE = 'org.bluez.Adapter1'
+DEVICE_INTERFACE = 'org.bluez.Device1'
+PROPERTIES_INTERFACE = 'org.freedesktop.DBus.Properties'
+OBJECT_MANAGER_INTERFACE = 'org.freedesktop.DBus.ObjectManager'
+DEBOUNCE_MS = 500
 
 class Agent(dbus.service.Object):
     def __init__(self, bus, path):
@@ -67,23 +73,106 @@ def register_agent():
 
     logging.info("Agent registered")
 
-def connection_handler(interface, changed, invalidated, path):
-    if 'Connected' in changed:
+class ConnectionTracker:
+    """
+    Keeps the adapter discoverable while no device is connected.
+
+    Connected devices are counted from the PropertiesChanged signals of org.bluez.Device1, and
+    discoverable mode only changes when the count moves between 0 and 1 and stays there for
+    debounce_ms, so a device reconnecting or a second device coming and going does not toggle
+    it. The adapter property is set asynchronously, so agent calls are answered meanwhile.
+    """
+
+    def __init__(self, adapter, debounce_ms=DEBOUNCE_MS):
+        self.adapter = adapter  # org.freedesktop.DBus.Properties proxy of the adapter
+        self.debounce_ms = debounce_ms
+        self.connected = set()
+        self.discoverable = None  # state last set on the adapter, None when unknown
+        self.signals_received = 0
+        self.signals_acted_on = 0
+        self.toggles = 0
+        self._timer = None
+
+    # Start from the devices connected now, given GetManagedObjects of org.bluez
+    def reset(self, objects):
+        self.connected = {path for path, interfaces in objects.items()
+                          if interfaces.get(DEVICE_INTERFACE, {}).get('Connected')}
+        self._schedule(0)
+
+    def properties_changed(self, interface, changed, invalidated, path=None):
+        self.signals_received += 1
+        if interface != DEVICE_INTERFACE or 'Connected' not in changed:
+            return
+        count = len(self.connected)
         if changed['Connected']:
-            logging.info("Device connected, stopping discoverable mode")
-            os.system("btmgmt -i hci0 discoverable no")
+            self.connected.add(path)
         else:
-            logging.info("Device disconnected, starting discoverable mode")
-            os.system("btmgmt -i hci0 discoverable yes")
+            self.connected.discard(path)
+        if len(self.connected) == count:
+            return  # already known, e.g. a second signal for the same connection
+        self.signals_acted_on += 1
+        if not count or not self.connected:
+            self._schedule(self.debounce_ms)
+
+    def _schedule(self, delay_ms):
+        if self._timer is not None:
+            GLib.source_remove(self._timer)
+        self._timer = GLib.timeout_add(delay_ms, self._apply)
+
+    def _apply(self):
+        self._timer = None
+        discoverable = not self.connected
+        if discoverable != self.discoverable:
+            self.discoverable = discoverable
+            self.toggles += 1
+            logging.info(f"{len(self.connected)} devices connected, "
+                         f"{'starting' if discoverable else 'stopping'} discoverable mode")
+            if discoverable:
+                # bluetoothd turns discoverable off after DiscoverableTimeout (180 s by
+                # default), btmgmt did not; sent first, so it applies to this Set
+                self.adapter.Set(ADAPTER_INTERFACE, 'DiscoverableTimeout', dbus.UInt32(0),
+                                 reply_handler=lambda: None, error_handler=self._set_failed)
+            self.adapter.Set(ADAPTER_INTERFACE, 'Discoverable', dbus.Boolean(discoverable),
+                             reply_handler=lambda: None, error_handler=self._set_failed)
+        return False  # run once
+
+    def _set_failed(self, error):
+        logging.warning(f"Setting discoverable mode failed: {error}")
+        self.discoverable = None  # retried at the next transition
+
+    def stats(self):
+        return {
+            'signals_received': self.signals_received,
+            'signals_acted_on': self.signals_acted_on,
+            'toggles': self.toggles,
+            'connected': len(self.connected),
+        }
+
+def track_connections(bus, adapter_path=ADAPTER_PATH):
+    adapter = dbus.Interface(bus.get_object(BUS_NAME, adapter_path, introspect=False), PROPERTIES_INTERFACE)
+    tracker = ConnectionTracker(adapter)
+    # Matched by the bus daemon, so signals of other interfaces and services never wake us
+    bus.add_signal_receiver(tracker.properties_changed,
+                            dbus_interface=PROPERTIES_INTERFACE,
+                            signal_name="PropertiesChanged",
+                            bus_name=BUS_NAME,
+                            arg0=DEVICE_INTERFACE,
+                            path_keyword="path")
+    manager = dbus.Interface(bus.get_object(BUS_NAME, '/', introspect=False), OBJECT_MANAGER_INTERFACE)
+    manager.GetManagedObjects(reply_handler=tracker.reset,
+                              error_handler=lambda error: logging.warning(f"GetManagedObjects failed: {error}"))
+    return tracker
+
+def log_stats(tracker):
+    logging.info(" ".join(f"{name} {value}" for name, value in tracker.stats().items()))
+    return True  # keep the handler
 
 if __name__ == '__main__':
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 
     bus = dbus.SystemBus()
-    bus.add_signal_receiver(connection_handler,
-                            dbus_interface="org.freedesktop.DBus.Properties",
-                            signal_name="PropertiesChanged",
-                            path_keyword="path")
+    tracker = track_connections(bus)
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, log_stats, tracker)
 
     register_agent()
     mainloop = GLib.MainLoop()